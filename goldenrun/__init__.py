@@ -1,18 +1,32 @@
-from typing import ContextManager, Optional
-
-from goldenrun.config import Config, get_default_config
-from goldenrun.tracing import trace_calls
-
-
-def trace(config: Optional[Config] = None) -> ContextManager[None]:
-    """Context manager to trace and log all calls.
-
-    Simple wrapper around `goldenrun.tracing.trace_calls` that uses trace
-    logger, code filter, and sample rate from given (or default) config.
-    """
-    if config is None:
-        config = get_default_config()
-    return trace_calls(
-        logger=config.trace_logger(),
-        code_filter=config.code_filter(),
-    )
+from typing import TYPE_CHECKING, ContextManager, Optional
+
+# Submodules are imported when they are used, so that importing goldenrun,
+# and starting the CLI, stays fast
+if TYPE_CHECKING:
+    from goldenrun.config import Config
+
+
+def trace(config: "Optional[Config]" = None) -> ContextManager[None]:
+    """Context manager to trace and log all calls.
+
+    Simple wrapper around `goldenrun.tracing.trace_calls` that uses trace
+    logger, code filter, and sample rate from given (or default) config.
+    """
+    from goldenrun.config import get_default_config
+    from goldenrun.stats import enable_stats
+    from goldenrun.tracing import trace_calls
+
+    if config is None:
+        config = get_default_config()
+    if config.collect_stats():
+        # Before the logger and store are created, so they count too
+        enable_stats()
+    return trace_calls(
+        logger=config.trace_logger(),
+        code_filter=config.code_filter(),
+        sample_rate=config.sample_rate(),
+        backend=config.tracing_backend(),
+        lazy=config.lazy_tracing(),
+        max_yields=config.max_yields(),
+        snapshot_args=config.snapshot_args(),
+    )
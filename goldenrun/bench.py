@@ -0,0 +1,525 @@
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import (IO, Any, Callable, Dict, Iterator, List, NamedTuple,
+                    Optional, Sequence)
+
+from goldenrun.config import CompiledCodeFilter
+from goldenrun.db import make_store
+from goldenrun.db.base import FuncRecordStore, SerializedFuncRecord
+from goldenrun.serialization import (DEFAULT_CODEC, Codec, CompressedCodec,
+                                     OutOfBandPickleCodec, PickleCodec)
+from goldenrun.tracing import (BACKEND_MONITORING, BACKEND_SETPROFILE,
+                               HAS_MONITORING, FuncRecord, FuncRecordLogger,
+                               record, trace_calls)
+
+
+class BenchResult(NamedTuple):
+    """The timing of one benchmark.
+
+    `seconds` is the best time over the repeats to run `ops` operations, and
+    `metrics` holds figures derived from it, such as the overhead over a
+    baseline.
+    """
+
+    suite: str
+    name: str
+    params: Dict[str, Any]
+    seconds: float
+    ops: int
+    metrics: Optional[Dict[str, float]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "suite": self.suite,
+            "name": self.name,
+            "params": self.params,
+            "seconds": self.seconds,
+            "ops": self.ops,
+            "ns_per_op": self.seconds / self.ops * 1e9,
+            "ops_per_sec": self.ops / self.seconds if self.seconds else None,
+            **(self.metrics or {}),
+        }
+
+
+class BenchOptions(NamedTuple):
+    # Number of runs of each benchmark, the best of which is kept
+    repeat: int = 5
+    # Factor applied to the size of the workloads
+    scale: float = 1.0
+
+    def count(self, n: int) -> int:
+        return max(1, int(n * self.scale))
+
+
+def best_of(
+    repeat: int, run: Callable[[], Any], setup: Optional[Callable[[], Any]] = None
+) -> float:
+    """Return the shortest time taken by `run` over `repeat` runs, calling
+    `setup` untimed before each of them."""
+    best = float("inf")
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class CountingLogger(FuncRecordLogger):
+    def __init__(self) -> None:
+        self.count = 0
+
+    def log(self, trace: FuncRecord) -> None:
+        self.count += 1
+
+
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+def library_calls(n: int) -> None:
+    # json.dumps lives in the stdlib and is rejected by the default code filter
+    for i in range(n):
+        json.dumps([i, i])
+
+
+def user_calls(n: int) -> None:
+    total = 0
+    for i in range(n):
+        total = add(total, i)
+
+
+@record
+def recorded(a: int, b: int) -> int:
+    return add(a, b)
+
+
+def recorded_calls(n: int) -> None:
+    for i in range(n):
+        recorded(i, i)
+
+
+TRACING_WORKLOADS: Dict[str, Callable[[int], None]] = {
+    "filtered": library_calls,
+    "unfiltered": user_calls,
+    "recorded": recorded_calls,
+}
+
+
+def run_traced(
+    workload: Callable[[int], None],
+    calls: int,
+    code_filter: CompiledCodeFilter,
+    backend: str,
+    lazy: bool,
+) -> None:
+    with trace_calls(CountingLogger(), code_filter, backend=backend, lazy=lazy):
+        workload(calls)
+
+
+def bench_tracing(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time calls that the code filter rejects, traced calls and `@record`
+    calls, untraced and under each tracing backend, eager and lazy."""
+    calls = options.count(100_000)
+    # This module may live in site-packages, which the default filter rejects
+    code_filter = CompiledCodeFilter.from_environment(
+        include=[os.path.abspath(__file__)]
+    )
+    backends = [BACKEND_SETPROFILE]
+    if HAS_MONITORING:
+        backends.append(BACKEND_MONITORING)
+
+    for name, workload in TRACING_WORKLOADS.items():
+        baseline = best_of(options.repeat, functools.partial(workload, calls))
+        yield BenchResult("tracing", f"{name}/none", {"calls": calls}, baseline, calls)
+        for backend in backends:
+            for lazy in (False, True):
+                run = functools.partial(run_traced, workload, calls, code_filter, backend, lazy)
+                elapsed = best_of(options.repeat, run)
+                yield BenchResult(
+                    "tracing",
+                    f"{name}/{backend}{'-lazy' if lazy else ''}",
+                    {"calls": calls, "backend": backend, "lazy": lazy},
+                    elapsed,
+                    calls,
+                    {
+                        "overhead_ns_per_call": (elapsed - baseline) / calls * 1e9,
+                        "slowdown": elapsed / baseline,
+                    },
+                )
+
+
+PAYLOAD_SIZES = (16, 1024, 64 * 1024)
+STORE_BACKENDS = ("sqlite", "binlog")
+
+
+def close_store(store: FuncRecordStore) -> None:
+    from goldenrun.db.binlog import BinaryLogStore
+    from goldenrun.db.sqlite import SQLiteStore
+
+    if isinstance(store, SQLiteStore):
+        store.conn.close()
+    elif isinstance(store, BinaryLogStore):
+        store.close()
+
+
+def open_next_store(stores: List[FuncRecordStore], directory: str, backend: str) -> None:
+    """Close the stores opened so far, and append a new empty one to stores."""
+    for store in stores:
+        close_store(store)
+    path = os.path.join(directory, f"bench{len(stores)}.db")
+    stores.append(make_store(f"{backend}:{path}"))
+
+
+def add_to_last_store(stores: List[FuncRecordStore], traces: List[FuncRecord]) -> None:
+    stores[-1].add(traces)
+
+
+def read_last_store(stores: List[FuncRecordStore]) -> None:
+    for thunk in stores[-1].get_records("func", limit=None):
+        thunk.to_trace()
+
+
+def bench_store(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time `add` and reading every record back with `get_records`, for each
+    store backend and payload size, then ingestion throughput, see
+    `bench_ingest`.
+
+    Payloads are random, so neither compression nor deduplication kicks in.
+    """
+    for backend in STORE_BACKENDS:
+        for size in PAYLOAD_SIZES:
+            # Write about the same number of bytes whatever the size
+            count = options.count(min(10_000, 32 * 1024 * 1024 // size))
+            traces = [
+                FuncRecord.from_stored("bench", "func", {"payload": os.urandom(size)}, i)
+                for i in range(count)
+            ]
+            params = {"backend": backend, "payload_bytes": size, "records": count}
+            with tempfile.TemporaryDirectory() as tmp:
+                stores: List[FuncRecordStore] = []
+                setup = functools.partial(open_next_store, stores, tmp, backend)
+                write = functools.partial(add_to_last_store, stores, traces)
+                read = functools.partial(read_last_store, stores)
+                operations = (("add", write, setup), ("get_records", read, None))
+                for operation, run, prepare in operations:
+                    elapsed = best_of(options.repeat, run, prepare)
+                    yield BenchResult(
+                        "store",
+                        f"{operation}/{backend}/{size}",
+                        params,
+                        elapsed,
+                        count,
+                        {"mb_per_sec": count * size / elapsed / 1e6},
+                    )
+                for store in stores:
+                    close_store(store)
+    yield from bench_ingest(options)
+
+
+# Number of records ingested at once by the throughput benchmark
+INGEST_COUNTS = (10_000, 100_000, 1_000_000)
+# Ingesting more records than this is timed once rather than `repeat` times
+INGEST_REPEAT_LIMIT = 100_000
+
+
+def ingest_records(count: int) -> List[SerializedFuncRecord]:
+    """Small records of 100 functions, serialized with the default codec."""
+    now = datetime.now()
+    return [
+        SerializedFuncRecord(
+            "bench",
+            f"func_{i % 100}",
+            now,
+            DEFAULT_CODEC.encode({"a": i, "b": str(i)}),
+            DEFAULT_CODEC.encode(i * 2),
+            DEFAULT_CODEC.tag,
+        )
+        for i in range(count)
+    ]
+
+
+def add_serialized_to_last_store(
+    stores: List[FuncRecordStore], records: List[SerializedFuncRecord]
+) -> None:
+    stores[-1].add_serialized(records)
+
+
+def bench_ingest(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time storing 10k, 100k and 1M small records (at scale 1) with
+    `add_serialized`, for each store backend.
+
+    Records are serialized up front, so only the time spent in the store is
+    measured.
+    """
+    for count in (options.count(n) for n in INGEST_COUNTS):
+        records = ingest_records(count)
+        repeat = options.repeat if count <= INGEST_REPEAT_LIMIT else 1
+        for backend in STORE_BACKENDS:
+            with tempfile.TemporaryDirectory() as tmp:
+                stores: List[FuncRecordStore] = []
+                setup = functools.partial(open_next_store, stores, tmp, backend)
+                write = functools.partial(add_serialized_to_last_store, stores, records)
+                elapsed = best_of(repeat, write, setup)
+                for store in stores:
+                    close_store(store)
+            yield BenchResult(
+                "store",
+                f"ingest/{backend}/{count}",
+                {"backend": backend, "records": count},
+                elapsed,
+                count,
+                {"records_per_sec": count / elapsed},
+            )
+
+
+SERIALIZATION_PAYLOADS: Dict[str, Callable[[], Any]] = {
+    "small_dict": lambda: {"id": 42, "name": "goldenrun", "tags": ["a", "b"]},
+    "int_list": lambda: list(range(10_000)),
+    "text": lambda: "goldenrun " * 100_000,
+    "random_bytes": lambda: os.urandom(1024 * 1024),
+    "bytearray": lambda: bytearray(os.urandom(1024 * 1024)),
+}
+
+
+def serialization_codecs() -> Dict[str, Codec]:
+    return {
+        "pickle": PickleCodec(),
+        "pickle5": OutOfBandPickleCodec(),
+        "default": DEFAULT_CODEC,
+        "lzma+pickle5": CompressedCodec(OutOfBandPickleCodec(), "lzma"),
+    }
+
+
+def encode_repeatedly(codec: Codec, value: Any, count: int) -> None:
+    for _ in range(count):
+        codec.encode(value)
+
+
+def decode_repeatedly(codec: Codec, data: bytes, count: int) -> None:
+    for _ in range(count):
+        codec.decode(data)
+
+
+def bench_serialization(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time encoding and decoding typical argument values with each codec."""
+    for payload_name, make_payload in SERIALIZATION_PAYLOADS.items():
+        value = make_payload()
+        # Large payloads are encoded fewer times
+        count = options.count(1000 if payload_name in ("small_dict", "int_list") else 20)
+        for codec_name, codec in serialization_codecs().items():
+            data = codec.encode(value)
+            params = {"codec": codec_name, "payload": payload_name, "values": count}
+            metrics = {"encoded_bytes": float(len(data))}
+            encode = functools.partial(encode_repeatedly, codec, value, count)
+            decode = functools.partial(decode_repeatedly, codec, data, count)
+            for operation, run in (("encode", encode), ("decode", decode)):
+                yield BenchResult(
+                    "serialization",
+                    f"{operation}/{codec_name}/{payload_name}",
+                    params,
+                    best_of(options.repeat, run),
+                    count,
+                    metrics,
+                )
+
+
+RECORD_WORKLOAD = """\
+from goldenrun.tracing import record
+
+
+def helper(x):
+    return x * 2
+
+
+@record
+def handle(i):
+    return sum(helper(j) for j in range(i % 50))
+
+
+def untraced(i):
+    return sum(j * 2 for j in range(i % 50))
+
+
+for i in range({calls}):
+    handle(i)
+    untraced(i)
+"""
+
+
+def bench_record(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time a synthetic script run as is and under `goldenrun record`, each in
+    a fresh interpreter."""
+    calls = options.count(20_000)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "workload.py")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(RECORD_WORKLOAD.format(calls=calls))
+        env = dict(
+            os.environ,
+            PYTHONPATH=os.pathsep.join(
+                filter(None, [package_root, os.environ.get("PYTHONPATH")])
+            ),
+            GR_DB_PATH=os.path.join(tmp, "goldenrun.sqlite3"),
+        )
+        plain = [sys.executable, script]
+        under_record = [
+            sys.executable,
+            "-c",
+            "from goldenrun.cli import entry_point_main; entry_point_main()",
+            "record",
+            script,
+        ]
+
+        def run(command: List[str]) -> Callable[[], None]:
+            return lambda: subprocess.run(command, env=env, cwd=tmp, check=True)
+
+        baseline = best_of(options.repeat, run(plain))
+        yield BenchResult("record", "script/plain", {"calls": calls}, baseline, calls)
+        elapsed = best_of(options.repeat, run(under_record))
+        yield BenchResult(
+            "record",
+            "script/goldenrun-record",
+            {"calls": calls},
+            elapsed,
+            calls,
+            {"slowdown": elapsed / baseline},
+        )
+
+
+# Cumulative import time allowed for each module, in milliseconds. Most of it
+# goes to `typing` and the stdlib modules it pulls in
+IMPORT_BUDGETS_MS = {
+    "goldenrun": 25.0,
+    "goldenrun.cli": 50.0,
+}
+# Modules that only the commands and backends that need them should import
+HEAVY_MODULES = (
+    "asyncio",
+    "dataclasses",
+    "inspect",
+    "lzma",
+    "opcode",
+    "pathlib",
+    "pickle",
+    "sqlite3",
+    "sysconfig",
+)
+IMPORT_PROBE = """\
+import sys
+import {module}
+print(",".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def import_time_us(output: str, module: str) -> int:
+    """Return the cumulative import time of module from `-X importtime` output."""
+    for line in output.splitlines():
+        fields = line.split("|")
+        # Modules imported by others are indented, top level ones are not
+        if len(fields) == 3 and fields[2].rstrip() == f" {module}":
+            return int(fields[1])
+    raise ValueError(f"no import time for {module!r} in output")
+
+
+def bench_import(options: BenchOptions) -> Iterator[BenchResult]:
+    """Time importing the package and the CLI in a fresh interpreter with
+    `-X importtime`, and compare it with `IMPORT_BUDGETS_MS`.
+
+    Results have `over_budget` set to 1 when the best time is over budget, and
+    `heavy_modules` to the number of `HEAVY_MODULES` the import loaded.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            filter(None, [package_root, os.environ.get("PYTHONPATH")])
+        ),
+    )
+    for module, budget_ms in IMPORT_BUDGETS_MS.items():
+        best_us = None
+        heavy = ""
+        for _ in range(max(options.repeat, 1)):
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "-X",
+                    "importtime",
+                    "-c",
+                    IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES),
+                ],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            elapsed_us = import_time_us(process.stderr, module)
+            best_us = elapsed_us if best_us is None else min(best_us, elapsed_us)
+            heavy = process.stdout.strip()
+        assert best_us is not None
+        elapsed = best_us / 1e6
+        yield BenchResult(
+            "import",
+            module,
+            {"module": module, "heavy_modules_loaded": heavy.split(",") if heavy else []},
+            elapsed,
+            1,
+            {
+                "budget_ms": budget_ms,
+                "over_budget": float(elapsed * 1e3 > budget_ms),
+                "heavy_modules": float(len(heavy.split(",")) if heavy else 0),
+            },
+        )
+
+
+def over_budget(report: Dict[str, Any]) -> List[str]:
+    """Return the names of the results of a report that went over budget."""
+    return [
+        f"{result['suite']}/{result['name']}"
+        for result in report["results"]
+        if result.get("over_budget")
+    ]
+
+
+SUITES: Dict[str, Callable[[BenchOptions], Iterator[BenchResult]]] = {
+    "tracing": bench_tracing,
+    "store": bench_store,
+    "serialization": bench_serialization,
+    "record": bench_record,
+    "import": bench_import,
+}
+
+
+def run_benchmarks(
+    suites: Sequence[str], options: BenchOptions, progress: Optional[IO[str]] = None
+) -> Dict[str, Any]:
+    """Run the given suites and return their results with a description of
+    the environment they ran in, ready to be dumped as JSON."""
+    started_at = datetime.now().isoformat()
+    results = []
+    for suite in suites:
+        for result in SUITES[suite](options):
+            if progress is not None:
+                print(
+                    f"{result.suite:<14} {result.name:<40} "
+                    f"{result.seconds / result.ops * 1e9:>14,.0f} ns/op",
+                    file=progress,
+                )
+            results.append(result.to_dict())
+    return {
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "options": options._asdict(),
+        "results": results,
+    }
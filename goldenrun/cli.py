@@ -1,150 +1,575 @@
-import argparse
-import os
-import os.path
-import runpy
-import sys
-from typing import IO, List, NoReturn, Optional, Tuple
-
-from goldenrun import trace
-from goldenrun.config import Config
-from goldenrun.db.base import FuncRecordStore
-from goldenrun.exceptions import GoldenRunError
-from goldenrun.util import get_name_in_module
-
-
-def module_path(path: str) -> Tuple[str, Optional[str]]:
-    """Parse <module>[:<qualname>] into its constituent parts."""
-    parts = path.split(":", 1)
-    module = parts.pop(0)
-    qualname = parts[0] if parts else None
-    if os.sep in module:  # Smells like a path
-        raise argparse.ArgumentTypeError(
-            f"{module} does not look like a valid Python import path"
-        )
-
-    return module, qualname
-
-
-def module_path_with_qualname(path: str) -> Tuple[str, str]:
-    """Require that path be of the form <module>:<qualname>."""
-    module, qualname = module_path(path)
-    if qualname is None:
-        raise argparse.ArgumentTypeError("must be of the form <module>:<qualname>")
-    return module, qualname
-
-
-def get_goldenrun_config(path: str) -> Config:
-    """Imports the config instance specified by path.
-
-    Path should be in the form module:qualname. Optionally, path may end with (),
-    in which case we will call/instantiate the given class/function.
-    """
-    should_call = False
-    if path.endswith("()"):
-        should_call = True
-        path = path[:-2]
-    module, qualname = module_path_with_qualname(path)
-    try:
-        config = get_name_in_module(module, qualname)
-    except GoldenRunError as mte:
-        raise argparse.ArgumentTypeError(f"cannot import {path}: {mte}")
-    if should_call:
-        config = config()
-    return config  # type: ignore[no-any-return]
-
-
-def record_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> None:
-    # remove initial `goldenrun record`
-    old_argv = sys.argv.copy()
-    try:
-        with trace(args.config):
-            sys.argv = [args.script_path] + args.script_args
-            if args.m:
-                runpy.run_module(args.script_path, run_name="__main__", alter_sys=True)
-            else:
-                runpy.run_path(args.script_path, run_name="__main__")
-    finally:
-        sys.argv = old_argv
-
-
-def replay_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> None:
-    trace_store: FuncRecordStore = args.config.trace_store()
-    for arg in args.functions:
-        records = trace_store.get_records(arg)
-        # grab function
-        # load current function in memory
-        # mock related functions
-        # run function with all existing paramenters
-        # assert output is the same
-
-
-def main(argv: List[str], stdout: IO[str], stderr: IO[str]) -> int:
-    parser = argparse.ArgumentParser(description="Generate and run golden image tests.")
-    parser.add_argument(
-        "--config",
-        "-c",
-        type=str,
-        default="goldenrun.config:get_default_config()",
-        help=(
-            "The <module>:<qualname> of the config to use"
-            " (default: goldenrun_config:CONFIG if it exists, "
-            "else goldenrun.config:DefaultConfig())"
-        ),
-    )
-
-    subparsers = parser.add_subparsers(title="commands", dest="command")
-
-    record_parser = subparsers.add_parser(
-        "record",
-        help="Run a Python script under GoldenRun tracing",
-        description="Run a Python script under GoldenRun tracing",
-    )
-    record_parser.add_argument(
-        "script_path",
-        type=str,
-        help="""Filesystem path to a Python script file to run under tracing""",
-    )
-    record_parser.add_argument(
-        "-m", action="store_true", help="Run a library module as a script"
-    )
-    record_parser.add_argument(
-        "script_args",
-        nargs=argparse.REMAINDER,
-    )
-    record_parser.set_defaults(handler=record_handler)
-
-    replay_parser = subparsers.add_parser(
-        "replay",
-        help="Replay a recorded Python function",
-        description="Replay a recorded Python function",
-    )
-    replay_parser.add_argument(
-        "functions",
-        nargs=argparse.REMAINDER,
-    )
-    replay_parser.set_defaults(handler=replay_handler)
-
-    args = parser.parse_args(argv)
-    args.config = get_goldenrun_config(args.config)
-
-    handler = getattr(args, "handler", None)
-    if handler is None:
-        parser.print_help(file=stderr)
-        return 1
-
-    with args.config.cli_context(args.command):
-        handler(args, stdout, stderr)
-
-    return 0
-
-
-def entry_point_main() -> "NoReturn":
-    # Since goldenrun needs to import the user's code (and possibly config
-    # code), the user's code must be on the Python path. But when running the
-    # CLI script, it won't be. So we add the current working directory to the
-    # Python path ourselves.
-    sys.path.insert(0, os.getcwd())
-    sys.exit(main(sys.argv[1:], sys.stdout, sys.stderr))
-
-
-entry_point_main()  # REMOVE LATER
+import argparse
+import os
+import os.path
+import runpy
+import sys
+from datetime import timedelta
+from typing import IO, TYPE_CHECKING, List, NoReturn, Optional, Tuple
+
+from goldenrun import trace
+from goldenrun.config import Config, DefaultConfig
+from goldenrun.exceptions import GoldenRunError
+from goldenrun.util import get_name_in_module
+
+# Handlers import what they need, so that every command doesn't pay for the
+# imports of all the others
+if TYPE_CHECKING:
+    from goldenrun.compare import CompareOptions
+    from goldenrun.db.base import FuncRecordStore
+
+
+def module_path(path: str) -> Tuple[str, Optional[str]]:
+    """Parse <module>[:<qualname>] into its constituent parts."""
+    parts = path.split(":", 1)
+    module = parts.pop(0)
+    qualname = parts[0] if parts else None
+    if os.sep in module:  # Smells like a path
+        raise argparse.ArgumentTypeError(
+            f"{module} does not look like a valid Python import path"
+        )
+
+    return module, qualname
+
+
+def module_path_with_qualname(path: str) -> Tuple[str, str]:
+    """Require that path be of the form <module>:<qualname>."""
+    module, qualname = module_path(path)
+    if qualname is None:
+        raise argparse.ArgumentTypeError("must be of the form <module>:<qualname>")
+    return module, qualname
+
+
+def qualname_path(path: str) -> Tuple[Optional[str], str]:
+    """Parse [<module>:]<qualname> into its constituent parts."""
+    if ":" not in path:
+        return None, path
+    module, qualname = module_path_with_qualname(path)
+    return module, qualname
+
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def size_in_bytes(size: str) -> int:
+    """Parse a number of bytes with an optional K, M or G suffix."""
+    unit = size[-1:].upper() if size[-1:].isalpha() else ""
+    try:
+        return int(float(size[: len(size) - len(unit)]) * SIZE_UNITS[unit])
+    except (KeyError, ValueError):
+        raise argparse.ArgumentTypeError(f"{size} is not a size, e.g. 512M")
+
+
+def get_goldenrun_config(path: str) -> Config:
+    """Imports the config instance specified by path.
+
+    Path should be in the form module:qualname. Optionally, path may end with (),
+    in which case we will call/instantiate the given class/function.
+    """
+    should_call = False
+    if path.endswith("()"):
+        should_call = True
+        path = path[:-2]
+    module, qualname = module_path_with_qualname(path)
+    try:
+        config = get_name_in_module(module, qualname)
+    except GoldenRunError as mte:
+        raise argparse.ArgumentTypeError(f"cannot import {path}: {mte}")
+    if should_call:
+        config = config()
+    return config  # type: ignore[no-any-return]
+
+
+def record_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> None:
+    from goldenrun.stats import enable_stats, get_stats
+
+    # remove initial `goldenrun record`
+    old_argv = sys.argv.copy()
+    if args.sharded:
+        # Also seen by the processes the script starts
+        os.environ[DefaultConfig.SHARDED_VAR] = "1"
+    if args.collector:
+        os.environ[DefaultConfig.COLLECTOR_VAR] = args.collector
+    if args.async_log:
+        os.environ[DefaultConfig.ASYNC_LOG_VAR] = args.async_log
+    if args.stats or args.stats_json:
+        enable_stats()
+    try:
+        with trace(args.config):
+            sys.argv = [args.script_path] + args.script_args
+            if args.m:
+                runpy.run_module(args.script_path, run_name="__main__", alter_sys=True)
+            else:
+                runpy.run_path(args.script_path, run_name="__main__")
+    finally:
+        sys.argv = old_argv
+        stats = get_stats()
+        if stats is not None:
+            print(stats.report(), file=stderr)
+            if args.stats_json:
+                with open(args.stats_json, "w", encoding="utf-8") as f:
+                    stats.dump(f)
+
+
+def replay_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    from goldenrun.replay import ReplayCache, ReplayEngine
+
+    trace_store: "FuncRecordStore" = args.config.trace_store()
+    cache = None
+    if args.incremental:
+        cache = ReplayCache(args.cache or args.config.replay_cache_path())
+    compare: "CompareOptions" = args.config.compare_options()
+    overrides = {
+        "rel_tol": args.rel_tol,
+        "abs_tol": args.abs_tol,
+        "max_differences": args.max_differences,
+    }
+    compare = compare._replace(
+        ignore=compare.ignore + tuple(args.ignore),
+        **{name: value for name, value in overrides.items() if value is not None},
+    )
+    engine = ReplayEngine(
+        trace_store,
+        args.workers,
+        args.chunk_size,
+        mock=args.mock,
+        cache=cache,
+        code_filter=args.config.code_filter(),
+        compare=compare,
+    )
+    status = 0
+    for module, qualname in args.functions:
+        results = engine.replay(qualname, module)
+        if not results:
+            print(f"{qualname}: no records found", file=stderr)
+            status = 1
+        for result in results:
+            print(result, file=stdout)
+            for failure in result.failures:
+                print(f"  {failure.status}: {failure.detail}", file=stdout)
+            if not result.ok:
+                status = 1
+    return status
+
+
+def merge_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    from goldenrun.db.sqlite import (ShardedSQLiteStore, SQLiteStore,
+                                     find_shards, remove_database)
+
+    trace_store: "FuncRecordStore" = args.config.trace_store()
+    if isinstance(trace_store, ShardedSQLiteStore):
+        trace_store = trace_store.merged
+    if not isinstance(trace_store, SQLiteStore) or trace_store.path is None:
+        print("merge: the configured trace store is not a SQLite database", file=stderr)
+        return 1
+    shards = args.shards or find_shards(trace_store.path)
+    total = 0
+    for shard in shards:
+        count = trace_store.merge_shard(shard)
+        total += count
+        if not args.keep:
+            remove_database(shard)
+        print(f"{shard}: {count} records", file=stdout)
+    print(
+        f"Merged {total} records from {len(shards)} shards into {trace_store.path}",
+        file=stdout,
+    )
+    return 0
+
+
+def compact_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    from goldenrun.db import make_store
+    from goldenrun.db.binlog import BinaryLogStore
+
+    trace_store: "FuncRecordStore" = args.config.trace_store()
+    if not isinstance(trace_store, BinaryLogStore):
+        print("compact: the configured trace store is not a binary log", file=stderr)
+        return 1
+    if args.export:
+        count = trace_store.export(make_store(args.export))
+        print(f"Exported {count} records to {args.export}", file=stdout)
+    else:
+        dropped = trace_store.compact()
+        print(f"Dropped {dropped} duplicated records from {trace_store.path}", file=stdout)
+    return 0
+
+
+def vacuum_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    trace_store: "FuncRecordStore" = args.config.trace_store()
+    overrides = {
+        "max_records": args.max_records,
+        "max_age": None if args.max_age is None else timedelta(days=args.max_age),
+        "max_bytes": args.max_bytes,
+    }
+    trace_store.retention = trace_store.retention._replace(
+        **{name: value for name, value in overrides.items() if value is not None}
+    )
+    stats = trace_store.vacuum()
+    print(
+        f"Deleted {stats.records_deleted} records, "
+        f"{stats.size_before:,} -> {stats.size_after:,} bytes",
+        file=stdout,
+    )
+    return 0
+
+
+def collector_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    import signal
+
+    from goldenrun.collector import Collector
+
+    address = args.listen or args.config.collector_address()
+    collector = Collector(
+        args.config.trace_store(),
+        address,
+        flush_size=args.flush_size,
+        flush_interval=args.flush_interval,
+    )
+    # Stop on SIGTERM as on Ctrl+C, storing what has been received
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"Collecting traces on {address}", file=stderr)
+    try:
+        collector.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+    print(
+        f"Stored {collector.records_stored} traces in {collector.commits} transactions "
+        f"from {len(collector.stored_seqs)} processes",
+        file=stderr,
+    )
+    return 0
+
+
+def stats_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    from goldenrun.stats import Stats
+
+    stats = Stats()
+    for path in args.files:
+        with open(path, encoding="utf-8") as f:
+            stats.update(Stats.load(f))
+    print(stats.report(), file=stdout)
+    return 0
+
+
+def bench_suite(name: str) -> str:
+    from goldenrun.bench import SUITES
+
+    if name not in SUITES:
+        raise argparse.ArgumentTypeError(
+            f"unknown suite {name!r} (choose from {', '.join(sorted(SUITES))})"
+        )
+    return name
+
+
+def bench_handler(args: argparse.Namespace, stdout: IO[str], stderr: IO[str]) -> int:
+    import json
+
+    from goldenrun.bench import (SUITES, BenchOptions, over_budget,
+                                 run_benchmarks)
+
+    report = run_benchmarks(
+        args.suite or list(SUITES), BenchOptions(args.repeat, args.scale), progress=stderr
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, stdout, indent=2)
+        print(file=stdout)
+    failed = over_budget(report)
+    if failed:
+        print(f"Over budget: {', '.join(failed)}", file=stderr)
+        return 1
+    return 0
+
+
+def main(argv: List[str], stdout: IO[str], stderr: IO[str]) -> int:
+    parser = argparse.ArgumentParser(description="Generate and run golden image tests.")
+    parser.add_argument(
+        "--config",
+        "-c",
+        type=str,
+        default="goldenrun.config:get_default_config()",
+        help=(
+            "The <module>:<qualname> of the config to use"
+            " (default: goldenrun_config:CONFIG if it exists, "
+            "else goldenrun.config:DefaultConfig())"
+        ),
+    )
+
+    subparsers = parser.add_subparsers(title="commands", dest="command")
+
+    record_parser = subparsers.add_parser(
+        "record",
+        help="Run a Python script under GoldenRun tracing",
+        description="Run a Python script under GoldenRun tracing",
+    )
+    record_parser.add_argument(
+        "script_path",
+        type=str,
+        help="""Filesystem path to a Python script file to run under tracing""",
+    )
+    record_parser.add_argument(
+        "-m", action="store_true", help="Run a library module as a script"
+    )
+    record_parser.add_argument(
+        "--sharded",
+        action="store_true",
+        help="Have each process write to a shard file of its own, "
+        "to be consolidated with `goldenrun merge`",
+    )
+    record_parser.add_argument(
+        "--collector",
+        metavar="ADDRESS",
+        help="Send traces to the `goldenrun collector` listening on ADDRESS "
+        "instead of writing them to the store",
+    )
+    record_parser.add_argument(
+        "--async-log",
+        nargs="?",
+        const="1",
+        metavar="SETTINGS",
+        help="Store traces from a background thread. SETTINGS are comma "
+        "separated, e.g. backpressure=drop-oldest,flush_size=500,flush_interval=0.5 "
+        "(backpressure is block, drop-oldest or drop-newest)",
+    )
+    record_parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Count calls, records, serialized bytes and flush times, "
+        "and print them once the script ends",
+    )
+    record_parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Also write those counters to FILE as JSON (implies --stats)",
+    )
+    record_parser.add_argument(
+        "script_args",
+        nargs=argparse.REMAINDER,
+    )
+    record_parser.set_defaults(handler=record_handler)
+
+    replay_parser = subparsers.add_parser(
+        "replay",
+        help="Replay a recorded Python function",
+        description="Replay a recorded Python function",
+    )
+    replay_parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=None,
+        help="Number of worker processes (default: number of CPUs, 1 replays in-process)",
+    )
+    replay_parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=100,
+        help="Number of records sent to a worker at a time (default: 100)",
+    )
+    replay_parser.add_argument(
+        "--mock",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="Answer calls the replayed functions make to functions matching this "
+        "<module>:<qualname> glob with their recorded results, e.g. 'myapp.db:*' "
+        "('*' for all of them). Can be repeated",
+    )
+    replay_parser.add_argument(
+        "--rel-tol",
+        type=float,
+        help="Relative tolerance of float comparisons (default: 0, exact)",
+    )
+    replay_parser.add_argument(
+        "--abs-tol",
+        type=float,
+        help="Absolute tolerance of float comparisons (default: 0, exact)",
+    )
+    replay_parser.add_argument(
+        "--ignore",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Don't compare values at paths matching this glob, e.g. '*.created_at' "
+        "or 'return.items.*.id'. Can be repeated",
+    )
+    replay_parser.add_argument(
+        "--max-differences",
+        type=int,
+        help="Number of differences reported per value (default: 10)",
+    )
+    replay_parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help="Skip records that already passed against the current code of their "
+        "function and its callees",
+    )
+    replay_parser.add_argument(
+        "--cache",
+        metavar="PATH",
+        help="Database of the records that passed, for --incremental "
+        "(default: $GR_REPLAY_CACHE or goldenrun-replay.sqlite3)",
+    )
+    replay_parser.add_argument(
+        "functions",
+        nargs="+",
+        type=qualname_path,
+        help="[<module>:]<qualname> of the recorded functions to replay",
+    )
+    replay_parser.set_defaults(handler=replay_handler)
+
+    merge_parser = subparsers.add_parser(
+        "merge",
+        help="Merge the shards written by a sharded recording",
+        description="Merge the shards written by a sharded recording into the "
+        "configured database",
+    )
+    merge_parser.add_argument(
+        "--keep",
+        action="store_true",
+        help="Keep the shard files once merged (default: delete them)",
+    )
+    merge_parser.add_argument(
+        "shards",
+        nargs="*",
+        help="Shard files to merge (default: all shards of the configured database)",
+    )
+    merge_parser.set_defaults(handler=merge_handler)
+
+    compact_parser = subparsers.add_parser(
+        "compact",
+        help="Compact or export a binary log trace store",
+        description="Rewrite the configured binary log without duplicated records, "
+        "or copy its records to another store",
+    )
+    compact_parser.add_argument(
+        "--export",
+        metavar="CONNECTION_STRING",
+        help="Copy the records to this store instead, e.g. 'traces.sqlite3' "
+        "(SQLite) or 'binlog:other.log'",
+    )
+    compact_parser.set_defaults(handler=compact_handler)
+
+    vacuum_parser = subparsers.add_parser(
+        "vacuum",
+        help="Apply the retention policy to the trace store",
+        description="Delete the records the retention policy of the configured "
+        "trace store doesn't keep, and reclaim their space",
+    )
+    vacuum_parser.add_argument(
+        "--max-records",
+        type=int,
+        metavar="N",
+        help="Keep a random sample of at most N records per function",
+    )
+    vacuum_parser.add_argument(
+        "--max-age",
+        type=float,
+        metavar="DAYS",
+        help="Delete records older than this many days",
+    )
+    vacuum_parser.add_argument(
+        "--max-bytes",
+        type=size_in_bytes,
+        metavar="SIZE",
+        help="Delete the oldest records until the store fits in SIZE, e.g. 512M",
+    )
+    vacuum_parser.set_defaults(handler=vacuum_handler)
+
+    collector_parser = subparsers.add_parser(
+        "collector",
+        help="Store the traces sent by `goldenrun record --collector`",
+        description="Listen for traces sent by recording processes, and write them "
+        "to the trace store, committing those received together at once. Stops "
+        "on Ctrl+C or SIGTERM.",
+    )
+    collector_parser.add_argument(
+        "--listen",
+        metavar="ADDRESS",
+        help="unix:PATH or tcp:HOST:PORT to listen on "
+        "(default: $GR_COLLECTOR, else unix:goldenrun-collector.sock)",
+    )
+    collector_parser.add_argument(
+        "--flush-size",
+        type=int,
+        default=10000,
+        help="Number of received traces that are stored at once (default: 10000)",
+    )
+    collector_parser.add_argument(
+        "--flush-interval",
+        type=float,
+        default=0.1,
+        help="Seconds traces wait for others to be stored with (default: 0.1)",
+    )
+    collector_parser.set_defaults(handler=collector_handler)
+
+    stats_parser = subparsers.add_parser(
+        "stats",
+        help="Print counters saved by `goldenrun record --stats-json`",
+        description="Print the counters saved by `goldenrun record --stats-json`. "
+        "The counters of several files, e.g. of several processes, are added up",
+    )
+    stats_parser.add_argument("files", nargs="+", metavar="FILE")
+    stats_parser.set_defaults(handler=stats_handler)
+
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark tracing, storage and serialization",
+        description="Benchmark tracing overhead, trace store throughput, "
+        "serialization and `goldenrun record`, reporting results as JSON",
+    )
+    bench_parser.add_argument(
+        "--suite",
+        action="append",
+        type=bench_suite,
+        help="Suite to run: tracing, store, serialization, record or import "
+        "(default: all of them). Can be repeated",
+    )
+    bench_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of runs of each benchmark, the best of which is reported (default: 5)",
+    )
+    bench_parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Factor applied to the size of the workloads, e.g. 0.1 for a quick run",
+    )
+    bench_parser.add_argument(
+        "--output",
+        "-o",
+        help="File to write the JSON report to (default: standard output)",
+    )
+    bench_parser.set_defaults(handler=bench_handler)
+
+    args = parser.parse_args(argv)
+    args.config = get_goldenrun_config(args.config)
+
+    handler = getattr(args, "handler", None)
+    if handler is None:
+        parser.print_help(file=stderr)
+        return 1
+
+    with args.config.cli_context(args.command):
+        status = handler(args, stdout, stderr)
+
+    return status or 0
+
+
+def entry_point_main() -> "NoReturn":
+    # Since goldenrun needs to import the user's code (and possibly config
+    # code), the user's code must be on the Python path. But when running the
+    # CLI script, it won't be. So we add the current working directory to the
+    # Python path ourselves.
+    sys.path.insert(0, os.getcwd())
+    sys.exit(main(sys.argv[1:], sys.stdout, sys.stderr))
+
+
+if __name__ == "__main__":
+    entry_point_main()
@@ -0,0 +1,649 @@
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+from typing import (Any, Deque, Dict, List, NamedTuple, Optional, Set,
+                    Tuple, Union)
+
+from goldenrun.db.base import (FuncRecordStore, SerializedFuncRecord,
+                               reset_after_fork, serialize_record)
+from goldenrun.db.binlog import FRAME_HEADER, frame, read_frames
+from goldenrun.serialization import DEFAULT_CODEC, Codec
+from goldenrun.stats import get_stats
+from goldenrun.tracing import FuncRecord, FuncRecordLogger
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = "unix:goldenrun-collector.sock"
+
+# Messages are frames, as in the binary log, whose payload starts with their
+# kind. A client sends HELLO with its id once per connection, then BATCHes of
+# framed records, each with a sequence number. The collector ACKs the last
+# batch of a connection it has stored
+HELLO = b"H"
+BATCH = b"B"
+ACK = b"A"
+# Ids are drawn by each recording process
+CLIENT_ID_SIZE = 16
+SEQ = struct.Struct("<Q")
+# Seconds to wait for a client to have room for an acknowledgement
+ACK_TIMEOUT = 5.0
+# Clients send a batch once its records take that many bytes, whatever their
+# number, and the collector drops clients sending larger messages than
+# MAX_MESSAGE_SIZE
+BATCH_BYTES = 4 * 1024 * 1024
+MAX_MESSAGE_SIZE = 1024 * 1024 * 1024
+
+# Fields of a call on the wire, besides its strings and bytes: creation time
+# and yield count
+CALL = struct.Struct("<dq")
+# Length of a string or bytes field on the wire, -1 for None
+LENGTH = struct.Struct("<q")
+COUNT = struct.Struct("<I")
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Tuple[int, Address]:
+    """Return the socket family and address of a collector address.
+
+    'tcp:HOST:PORT' is a TCP address, 'unix:PATH' or a plain path a Unix
+    domain socket.
+    """
+    scheme, sep, location = address.partition(":")
+    if sep and scheme == "tcp":
+        host, _, port = location.rpartition(":")
+        host = host.strip("[]") or "127.0.0.1"
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        return family, (host, int(port))
+    if sep and scheme == "unix":
+        return socket.AF_UNIX, location
+    return socket.AF_UNIX, address
+
+
+def _put(parts: List[bytes], value: Optional[bytes]) -> None:
+    if value is None:
+        parts.append(LENGTH.pack(-1))
+    else:
+        parts.append(LENGTH.pack(len(value)))
+        parts.append(value)
+
+
+def _put_str(parts: List[bytes], value: Optional[str]) -> None:
+    _put(parts, None if value is None else value.encode())
+
+
+def _encode_call(parts: List[bytes], record: SerializedFuncRecord) -> None:
+    parts.append(CALL.pack(record.created_at.timestamp(), record.yield_count or 0))
+    _put_str(parts, record.module)
+    _put_str(parts, record.qualname)
+    _put(parts, record.serialized_args)
+    _put(parts, record.serialized_return)
+    _put_str(parts, record.codec)
+    _put(parts, record.serialized_yields)
+    _put_str(parts, record.exception_type)
+    _put_str(parts, record.exception_message)
+    _put(parts, record.fingerprint)
+
+
+def encode_record(record: SerializedFuncRecord) -> bytes:
+    """Encode a record and its children for the collector.
+
+    Unlike the binary log, records are not pickled, so the collector never
+    unpickles what clients send it.
+    """
+    parts: List[bytes] = []
+    _encode_call(parts, record)
+    parts.append(COUNT.pack(len(record.children)))
+    for child in record.children:
+        _encode_call(parts, child)
+    return b"".join(parts)
+
+
+def _get(data: memoryview, offset: int) -> Tuple[Optional[bytes], int]:
+    (length,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    if length < 0:
+        return None, offset
+    if offset + length > len(data):
+        raise ValueError("truncated record")
+    return bytes(data[offset : offset + length]), offset + length
+
+
+def _get_str(data: memoryview, offset: int) -> Tuple[Optional[str], int]:
+    value, offset = _get(data, offset)
+    return None if value is None else value.decode(), offset
+
+
+def _decode_call(data: memoryview, offset: int) -> Tuple[SerializedFuncRecord, int]:
+    timestamp, yield_count = CALL.unpack_from(data, offset)
+    offset += CALL.size
+    module, offset = _get_str(data, offset)
+    qualname, offset = _get_str(data, offset)
+    serialized_args, offset = _get(data, offset)
+    serialized_return, offset = _get(data, offset)
+    codec, offset = _get_str(data, offset)
+    serialized_yields, offset = _get(data, offset)
+    exception_type, offset = _get_str(data, offset)
+    exception_message, offset = _get_str(data, offset)
+    fingerprint, offset = _get(data, offset)
+    if module is None or qualname is None:
+        raise ValueError("record without a function name")
+    record = SerializedFuncRecord(
+        module,
+        qualname,
+        datetime.fromtimestamp(timestamp),
+        serialized_args or b"",
+        serialized_return or b"",
+        codec,
+        serialized_yields,
+        yield_count,
+        exception_type,
+        exception_message,
+        fingerprint=fingerprint,
+    )
+    return record, offset
+
+
+def decode_record(data: memoryview) -> SerializedFuncRecord:
+    """Decode a record encoded by `encode_record`."""
+    record, offset = _decode_call(data, 0)
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    children = []
+    for _ in range(count):
+        child, offset = _decode_call(data, offset)
+        children.append(child)
+    if offset != len(data):
+        raise ValueError("trailing data after record")
+    return record._replace(children=tuple(children))
+
+
+def _decode_batch(payload: memoryview, start: int) -> List[SerializedFuncRecord]:
+    records = []
+    end = start
+    for offset, data in read_frames(payload, start):
+        records.append(decode_record(data))
+        end = offset + FRAME_HEADER.size + len(data)
+    if end != len(payload):
+        raise ValueError("corrupted record in batch")
+    return records
+
+
+def _split_frames(buffer: bytearray) -> List[bytes]:
+    """Remove the complete frames at the start of buffer and return their payloads."""
+    payloads = []
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(buffer):
+        length, crc = FRAME_HEADER.unpack_from(buffer, offset)
+        end = offset + FRAME_HEADER.size + length
+        if end > len(buffer):
+            break
+        payload = bytes(buffer[offset + FRAME_HEADER.size : end])
+        if zlib.crc32(payload) != crc:
+            raise ValueError("corrupted message")
+        payloads.append(payload)
+        offset = end
+    del buffer[:offset]
+    return payloads
+
+
+def _read_message(stream: Any) -> Optional[bytes]:
+    """Read a frame from a binary file, return its payload, or None at the end."""
+    header = stream.read(FRAME_HEADER.size)
+    if not header:
+        return None
+    if len(header) < FRAME_HEADER.size:
+        raise ValueError("truncated message")
+    length, crc = FRAME_HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"message of {length} bytes is too large")
+    payload = stream.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        raise ValueError("truncated or corrupted message")
+    return payload  # type: ignore[no-any-return]
+
+
+class CollectorLogger(FuncRecordLogger):
+    """A FuncRecordLogger that sends traces to a `goldenrun collector`.
+
+    The collector writes them to its store, so the recording process only
+    serializes them, and many processes, on many hosts, can record to one
+    store without taking turns on it.
+
+    Traces are serialized with `codec` as they are logged, and sent in
+    batches of `batch_size` records, or of `BATCH_BYTES`. Up to
+    `max_in_flight` batches are sent without waiting for the collector to
+    acknowledge them: past that, `log` blocks until it does, or for at most
+    `timeout` seconds. `flush` sends the
+    pending records and waits for all of them to be acknowledged, also for
+    at most `timeout` seconds.
+
+    When the collector can't be reached, records are kept and the connection
+    is tried again at most every `reconnect_interval` seconds, then the
+    batches it didn't acknowledge are sent again. Past `max_pending` records
+    waiting for the collector, the oldest batches are discarded, and counted
+    in `dropped`.
+    """
+
+    def __init__(
+        self,
+        address: str = DEFAULT_ADDRESS,
+        codec: Optional[Codec] = None,
+        batch_size: int = 100,
+        max_in_flight: int = 64,
+        max_pending: int = 100_000,
+        reconnect_interval: float = 1.0,
+        timeout: float = 30.0,
+    ) -> None:
+        self.address = address
+        self.family, self.sock_address = parse_address(address)
+        self.codec = codec or DEFAULT_CODEC
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.reconnect_interval = reconnect_interval
+        self.timeout = timeout
+        self.stats = get_stats()
+        self._reset()
+        reset_after_fork(self)
+
+    def _reset(self) -> None:
+        self.client_id = os.urandom(CLIENT_ID_SIZE)
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._next_connect = 0.0
+        # Whether the last connection attempt failed, to warn only once
+        self._unreachable = False
+        self._acks = bytearray()
+        # Framed records not sent yet
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._seq = 0
+        # Batches sent and not acknowledged yet: sequence number, message and
+        # number of records
+        self._unacked: Deque[Tuple[int, bytes, int]] = deque()
+        self._unacked_records = 0
+
+    def after_fork(self) -> None:
+        """Connect to the collector as a new client: the connection and the
+        traces logged by the parent process are the parent's."""
+        if self._sock is not None:
+            # Only closes our copy, the parent stays connected
+            self._sock.close()
+        self._reset()
+
+    def log(self, trace: FuncRecord) -> None:
+        try:
+            record = serialize_record(trace, self.codec, self.stats)
+        except Exception:
+            logger.exception("Can't serialize a trace of %s:%s", trace.module, trace.qualname)
+            return
+        data = frame(encode_record(record))
+        with self._lock:
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+            if len(self._pending) >= self.batch_size or self._pending_bytes >= BATCH_BYTES:
+                self._send_pending()
+
+    def flush(self) -> None:
+        """Send pending traces and wait until the collector has stored them."""
+        start = time.perf_counter_ns() if self.stats is not None else 0
+        with self._lock:
+            self._send_pending()
+            deadline = time.monotonic() + self.timeout
+            while self._unacked:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self._sock is None:
+                    self._connect()
+                    if self._sock is None:
+                        time.sleep(min(self.reconnect_interval, remaining))
+                        continue
+                self._read_acks(min(remaining, 1.0))
+            if self._unacked:
+                logger.warning(
+                    "%d traces not stored by the collector at %s yet",
+                    self._unacked_records,
+                    self.address,
+                )
+        if self.stats is not None:
+            self.stats.add_flush(time.perf_counter_ns() - start)
+
+    def close(self) -> None:
+        """Flush pending traces and disconnect from the collector."""
+        self.flush()
+        with self._lock:
+            self._disconnect()
+
+    def _send_pending(self) -> None:
+        if self._pending:
+            self._seq += 1
+            message = frame(BATCH + SEQ.pack(self._seq) + b"".join(self._pending))
+            self._unacked.append((self._seq, message, len(self._pending)))
+            self._unacked_records += len(self._pending)
+            self._pending = []
+            self._pending_bytes = 0
+            if self._sock is None:
+                # Sends every batch not acknowledged yet, this one included
+                self._connect()
+            else:
+                try:
+                    self._sock.sendall(message)
+                except OSError as exc:
+                    self._disconnect(exc)
+        self._read_acks(0.0)
+        while self._sock is not None and len(self._unacked) > self.max_in_flight:
+            if not self._read_acks(self.timeout):
+                self._disconnect(TimeoutError("no acknowledgement from the collector"))
+        while self._unacked_records > self.max_pending:
+            _, _, count = self._unacked.popleft()
+            self._unacked_records -= count
+            self.dropped += count
+
+    def _connect(self) -> None:
+        if time.monotonic() < self._next_connect:
+            return
+        try:
+            if self.family == socket.AF_UNIX:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.sock_address)
+                except OSError:
+                    sock.close()
+                    raise
+            else:
+                sock = socket.create_connection(
+                    self.sock_address, timeout=self.timeout  # type: ignore[arg-type]
+                )
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            sock.sendall(frame(HELLO + self.client_id))
+            for _, message, _ in self._unacked:
+                sock.sendall(message)
+        except OSError as exc:
+            self._disconnect(exc)
+        else:
+            self._unreachable = False
+
+    def _disconnect(self, exc: Optional[BaseException] = None) -> None:
+        if exc is not None:
+            if self._unreachable:
+                logger.debug("Can't connect to the collector at %s: %s", self.address, exc)
+            else:
+                logger.warning(
+                    "Lost connection to the collector at %s: %s", self.address, exc
+                )
+            self._unreachable = True
+            self._next_connect = time.monotonic() + self.reconnect_interval
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._acks.clear()
+
+    def _read_acks(self, timeout: float) -> bool:
+        """Read the acknowledgements the collector sent, waiting at most
+        `timeout` seconds for the first one, and forget acknowledged batches.
+
+        Returns whether any was read.
+        """
+        sock = self._sock
+        if sock is None:
+            return False
+        try:
+            ready, _, _ = select.select([sock], [], [], timeout)
+            if not ready:
+                return False
+            while ready:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionResetError("connection closed by the collector")
+                self._acks.extend(data)
+                ready, _, _ = select.select([sock], [], [], 0)
+            messages = _split_frames(self._acks)
+        except (OSError, ValueError) as exc:
+            self._disconnect(exc)
+            return False
+        for message in messages:
+            if message[:1] == ACK:
+                (seq,) = SEQ.unpack_from(message, 1)
+                while self._unacked and self._unacked[0][0] <= seq:
+                    _, _, count = self._unacked.popleft()
+                    self._unacked_records -= count
+        return True
+
+
+class _Connection:
+    """A client connected to the collector."""
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.client_id: Optional[bytes] = None
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def acknowledge(self, seq: int) -> None:
+        with self.lock:
+            if self.closed:
+                # The client sends the batch again when it reconnects
+                return
+            try:
+                # Don't hold up every other client on one that stopped reading
+                _, writable, _ = select.select([], [self.sock], [], ACK_TIMEOUT)
+                if not writable:
+                    raise TimeoutError("client not reading acknowledgements")
+                self.sock.sendall(frame(ACK + SEQ.pack(seq)))
+            except OSError:
+                self.close()
+
+    def close(self) -> None:
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _Batch(NamedTuple):
+    connection: _Connection
+    seq: int
+    records: List[SerializedFuncRecord]
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: "_Server"
+
+    def handle(self) -> None:
+        self.server.collector._serve(self.request)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.BaseServer):
+    daemon_threads = True
+    collector: "Collector"
+
+
+class _UnixServer(_Server, socketserver.UnixStreamServer):
+    pass
+
+
+class _TCPServer(_Server, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+_STOP = object()
+
+
+class Collector:
+    """Stores the traces CollectorLoggers send it in a FuncRecordStore.
+
+    This is what `goldenrun collector` runs. It listens on `address`, a Unix
+    domain socket or a TCP address, see `parse_address`. TCP lets processes
+    of several hosts record to one store, and should only be reachable from
+    trusted hosts.
+
+    Each client connection is read by a thread of its own, and records are
+    written by a single writer thread. The writer stores whatever has been
+    received in one `add_serialized` call once `flush_size` records are
+    waiting or `flush_interval` seconds have passed since the first of them,
+    then acknowledges the batches it stored. At most `max_queue_size`
+    batches wait for the writer, then clients wait for room.
+
+    Batches a client sends again after reconnecting are only stored once, as
+    long as the collector keeps running: it remembers the last batch stored
+    for each client.
+    """
+
+    def __init__(
+        self,
+        store: FuncRecordStore,
+        address: str = DEFAULT_ADDRESS,
+        flush_size: int = 10000,
+        flush_interval: float = 0.1,
+        max_queue_size: int = 1000,
+    ) -> None:
+        self.store = store
+        self.address = address
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # Last batch stored for each client
+        self.stored_seqs: Dict[bytes, int] = {}
+        self.records_stored = 0
+        self.commits = 0
+        self.connections: Set[_Connection] = set()
+        self.queue: "queue.Queue[Union[_Batch, object]]" = queue.Queue(max_queue_size)
+        family, sock_address = parse_address(address)
+        if family == socket.AF_UNIX:
+            assert isinstance(sock_address, str)
+            if os.path.exists(sock_address):
+                # Left behind by a collector that didn't shut down
+                os.unlink(sock_address)
+            self.server: _Server = _UnixServer(sock_address, _Handler)
+        elif family == socket.AF_INET6:
+            self.server = _TCP6Server(sock_address, _Handler)
+        else:
+            self.server = _TCPServer(sock_address, _Handler)
+        self.server.collector = self
+        self._writer = threading.Thread(
+            target=self._run, name="goldenrun-collector", daemon=True
+        )
+        self._writer.start()
+
+    def serve_forever(self) -> None:
+        """Accept clients until `shutdown` is called from another thread."""
+        self.server.serve_forever()
+
+    def shutdown(self) -> None:
+        self.server.shutdown()
+
+    def close(self) -> None:
+        """Stop accepting clients, then store the records received so far."""
+        self.server.server_close()
+        for connection in list(self.connections):
+            connection.close()
+        if self.server.address_family == socket.AF_UNIX:
+            try:
+                os.unlink(self.server.server_address)  # type: ignore[arg-type]
+            except OSError:
+                pass
+        self.queue.put(_STOP)
+        self._writer.join()
+
+    def _serve(self, sock: socket.socket) -> None:
+        connection = _Connection(sock)
+        self.connections.add(connection)
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = sock.makefile("rb")
+        try:
+            while True:
+                message = _read_message(stream)
+                if message is None:
+                    break
+                kind = message[:1]
+                if kind == HELLO:
+                    connection.client_id = message[1 : 1 + CLIENT_ID_SIZE]
+                elif kind == BATCH and connection.client_id is not None:
+                    (seq,) = SEQ.unpack_from(message, 1)
+                    records = _decode_batch(memoryview(message), 1 + SEQ.size)
+                    self.queue.put(_Batch(connection, seq, records))
+                else:
+                    raise ValueError(f"unexpected message {kind!r}")
+        except (OSError, ValueError, struct.error) as exc:
+            logger.warning("Dropping client: %s", exc)
+        finally:
+            with connection.lock:
+                # The server closes the socket once this returns
+                connection.closed = True
+            self.connections.discard(connection)
+            stream.close()
+
+    def _store(self, batches: List[_Batch]) -> None:
+        stored_seqs = dict(self.stored_seqs)
+        records: List[SerializedFuncRecord] = []
+        acks: Dict[_Connection, int] = {}
+        for batch in batches:
+            client_id = batch.connection.client_id
+            assert client_id is not None
+            # Skip batches sent again after a reconnection
+            if batch.seq > stored_seqs.get(client_id, 0):
+                records.extend(batch.records)
+                stored_seqs[client_id] = batch.seq
+            acks[batch.connection] = max(acks.get(batch.connection, 0), batch.seq)
+        if records:
+            try:
+                self.store.add_serialized(records)
+            except Exception:
+                logger.exception("Failed storing %d traces", len(records))
+                # Have the clients send them again
+                for connection in acks:
+                    connection.close()
+                return
+            self.records_stored += len(records)
+            self.commits += 1
+        self.stored_seqs = stored_seqs
+        for connection, seq in acks.items():
+            connection.acknowledge(seq)
+
+    def _run(self) -> None:
+        batches: List[_Batch] = []
+        count = 0
+        deadline: Optional[float] = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, _Batch):
+                batches.append(item)
+                count += len(item.records)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if count < self.flush_size and time.monotonic() < deadline:
+                    continue
+            if batches:
+                self._store(batches)
+            batches = []
+            count = 0
+            deadline = None
+            if item is _STOP:
+                try:
+                    self.store.sync()
+                except Exception:
+                    logger.exception("Failed syncing the trace store")
+                return
@@ -0,0 +1,385 @@
+import array
+import dataclasses
+import fnmatch
+import itertools
+import math
+import re
+import sys
+from typing import (Any, Iterable, Iterator, List, NamedTuple, Optional,
+                    Pattern, Set, Tuple)
+
+from goldenrun.serialization import Codec
+
+# Length of the values shown in differences
+MAX_REPR = 80
+
+
+class CompareOptions(NamedTuple):
+    """How replayed values are compared with recorded ones.
+
+    Floats are equal when `math.isclose` says so with `rel_tol` and `abs_tol`,
+    and NaN equals NaN. Values at a path matching one of the `ignore` globs
+    are not compared, see `iter_differences` for the paths. At most
+    `max_differences` differences are reported per value.
+    """
+
+    rel_tol: float = 0.0
+    abs_tol: float = 0.0
+    ignore: Tuple[str, ...] = ()
+    max_differences: int = 10
+
+    @property
+    def exact(self) -> bool:
+        return not (self.rel_tol or self.abs_tol or self.ignore)
+
+
+DEFAULT_COMPARE_OPTIONS = CompareOptions()
+
+
+class Difference(NamedTuple):
+    path: str
+    detail: str
+
+    def __str__(self) -> str:
+        return f"{self.path}: {self.detail}"
+
+
+def short_repr(value: Any) -> str:
+    try:
+        text = repr(value)
+    except Exception as exc:
+        text = f"<{type(value).__qualname__}, repr failed: {exc!r}>"
+    if len(text) > MAX_REPR:
+        text = text[: MAX_REPR - 3] + "..."
+    return text
+
+
+def _mismatch(expected: Any, actual: Any) -> str:
+    return f"expected {short_repr(expected)}, got {short_repr(actual)}"
+
+
+class GoldenValue:
+    """A recorded value, decoded only if it is needed."""
+
+    def __init__(self, serialized: bytes, codec: Codec) -> None:
+        self.serialized = serialized
+        self.codec = codec
+        self._value: Any = _UNDECODED
+
+    @property
+    def value(self) -> Any:
+        if self._value is _UNDECODED:
+            self._value = self.codec.decode(self.serialized)
+        return self._value
+
+
+_UNDECODED = object()
+
+
+def _is_ndarray(value: Any) -> bool:
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def _is_buffer(value: Any) -> bool:
+    """Whether value is an array of numbers compared as a whole."""
+    if isinstance(value, (array.array, memoryview)) or _is_ndarray(value):
+        return True
+    if isinstance(value, NOT_BUFFERS):
+        return False
+    try:
+        memoryview(value)
+    except TypeError:
+        return False
+    return True
+
+
+# Common types checked before trying to get a memoryview of a value
+NOT_BUFFERS = (
+    type(None), bool, int, str, bytes, bytearray, dict, list, tuple, set, frozenset
+)
+FLOAT_FORMATS = {"f", "d", "e"}
+
+
+def _buffer_difference(
+    expected: Any, actual: Any, options: CompareOptions
+) -> Optional[str]:
+    """Compare two buffers as vectors and describe how they differ, if they do.
+
+    numpy arrays are compared with numpy, other buffers through memoryviews,
+    and elements are only looked at one by one when they are not equal.
+    """
+    if _is_ndarray(expected) and _is_ndarray(actual):
+        return _ndarray_difference(expected, actual, options)
+    try:
+        left, right = memoryview(expected), memoryview(actual)
+    except TypeError:
+        return _mismatch(expected, actual)
+    if (left.format, left.shape) != (right.format, right.shape):
+        return (
+            f"expected {left.format!r} buffer of shape {left.shape}, "
+            f"got {right.format!r} buffer of shape {right.shape}"
+        )
+    if left == right:
+        return None
+    floats = left.format.lstrip("@=<>!") in FLOAT_FORMATS
+    left_items, right_items = _flatten(left.tolist()), _flatten(right.tolist())
+    mismatched = [
+        i
+        for i, (e, a) in enumerate(zip(left_items, right_items))
+        if not (_floats_close(e, a, options) if floats else e == a)
+    ]
+    if not mismatched:
+        return None
+    return _vector_summary(mismatched, left_items, right_items, len(left_items))
+
+
+def _ndarray_difference(expected: Any, actual: Any, options: CompareOptions) -> Optional[str]:
+    numpy = sys.modules["numpy"]
+    if (expected.dtype, expected.shape) != (actual.dtype, actual.shape):
+        return (
+            f"expected {expected.dtype} array of shape {expected.shape}, "
+            f"got {actual.dtype} array of shape {actual.shape}"
+        )
+    if expected.dtype.kind in "fc":
+        close = numpy.isclose(
+            expected, actual, rtol=options.rel_tol, atol=options.abs_tol, equal_nan=True
+        )
+    else:
+        close = expected == actual
+    if close.all():
+        return None
+    mismatched = numpy.flatnonzero(~close)
+    flat_expected, flat_actual = expected.ravel(), actual.ravel()
+    return _vector_summary(
+        mismatched[: options.max_differences].tolist(),
+        flat_expected,
+        flat_actual,
+        expected.size,
+        len(mismatched),
+    )
+
+
+def _vector_summary(
+    mismatched: List[int],
+    expected: Any,
+    actual: Any,
+    size: int,
+    count: Optional[int] = None,
+) -> str:
+    count = len(mismatched) if count is None else count
+    shown = ", ".join(
+        f"[{i}] {short_repr(expected[i])} != {short_repr(actual[i])}" for i in mismatched[:3]
+    )
+    return f"{count} of {size} elements differ: {shown}" + (", ..." if count > 3 else "")
+
+
+def _flatten(items: Any) -> List[Any]:
+    if not isinstance(items, list):
+        return [items]
+    if not items or not isinstance(items[0], list):
+        return items
+    return [item for row in items for item in _flatten(row)]
+
+
+def _floats_close(expected: Any, actual: Any, options: CompareOptions) -> bool:
+    if expected == actual:
+        return True
+    try:
+        if math.isnan(expected) and math.isnan(actual):
+            return True
+        return math.isclose(expected, actual, rel_tol=options.rel_tol, abs_tol=options.abs_tol)
+    except TypeError:
+        return False
+
+
+def _compile_ignore(patterns: Iterable[str]) -> Optional[Pattern[str]]:
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+
+def _attributes(value: Any) -> Optional[List[Tuple[str, Any]]]:
+    """The state compared attribute by attribute for objects without `__eq__`
+    or dataclasses, None for other values."""
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return [(f.name, getattr(value, f.name)) for f in dataclasses.fields(value)]
+    if type(value).__eq__ is not object.__eq__:
+        return None
+    state = getattr(value, "__dict__", None)
+    if state is not None:
+        return sorted(state.items())
+    slots = []
+    for klass in type(value).__mro__:
+        names = getattr(klass, "__slots__", ())
+        for name in (names,) if isinstance(names, str) else names:
+            if hasattr(value, name):
+                slots.append(name)
+    return [(name, getattr(value, name)) for name in slots] if slots else None
+
+
+def iter_differences(
+    expected: Any,
+    actual: Any,
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+    path: str = "return",
+) -> Iterator[Difference]:
+    """Yield the differences between two values, as they are found.
+
+    Values are walked depth first. The path of a value is that of its
+    container followed by a dot and its key, index or attribute name, e.g.
+    `return.items.3.price`. Ignore globs are matched against those paths, so
+    `*.created_at` ignores `created_at` at any depth.
+
+    Containers are compared with `==` first when `options` are exact, and only
+    walked when they differ. Objects that don't define `__eq__` and
+    dataclasses are compared attribute by attribute, other objects with `==`.
+    A pair of values met again inside itself, as in cyclic structures, isn't
+    walked again.
+    """
+    ignore = _compile_ignore(options.ignore)
+    exact = options.exact
+    # Entries with a None path mark the end of the children of a pair
+    stack: List[Tuple[Optional[str], Any, Any]] = [(path, expected, actual)]
+    # Pairs of values being walked, by id
+    on_path: Set[Tuple[int, int]] = set()
+    while stack:
+        entry_path, expected, actual = stack.pop()
+        if entry_path is None:
+            on_path.discard(expected)
+            continue
+        path = entry_path
+        if expected is actual or (ignore is not None and ignore.match(path)):
+            continue
+        key = (id(expected), id(actual))
+        if key in on_path:
+            continue
+        if isinstance(expected, float) or isinstance(actual, float):
+            if not (
+                isinstance(expected, (int, float))
+                and isinstance(actual, (int, float))
+                and _floats_close(expected, actual, options)
+            ):
+                yield Difference(path, _mismatch(expected, actual))
+            continue
+        if _is_buffer(expected) or _is_buffer(actual):
+            detail = _buffer_difference(expected, actual, options)
+            if detail is not None:
+                yield Difference(path, detail)
+            continue
+        if type(expected) is not type(actual):
+            try:
+                if expected == actual:
+                    continue
+            except Exception:
+                pass
+            yield Difference(
+                path,
+                f"expected {type(expected).__qualname__} {short_repr(expected)}, "
+                f"got {type(actual).__qualname__} {short_repr(actual)}",
+            )
+            continue
+        children: List[Tuple[str, Any, Any]] = []
+        if isinstance(expected, dict):
+            if exact and _equal(expected, actual):
+                continue
+            for key in expected:
+                child_path = f"{path}.{key}"
+                if key not in actual:
+                    if ignore is None or not ignore.match(child_path):
+                        yield Difference(child_path, "missing")
+                else:
+                    children.append((child_path, expected[key], actual[key]))
+            for key in actual:
+                child_path = f"{path}.{key}"
+                if key not in expected and (ignore is None or not ignore.match(child_path)):
+                    yield Difference(child_path, f"unexpected {short_repr(actual[key])}")
+        elif isinstance(expected, (list, tuple)):
+            if exact and _equal(expected, actual):
+                continue
+            if len(expected) != len(actual):
+                yield Difference(
+                    path, f"expected {len(expected)} items, got {len(actual)}"
+                )
+            children = [
+                (f"{path}.{i}", e, a) for i, (e, a) in enumerate(zip(expected, actual))
+            ]
+        elif isinstance(expected, (set, frozenset)):
+            if expected != actual:
+                missing, extra = expected - actual, actual - expected
+                yield Difference(
+                    path,
+                    f"missing {short_repr(sorted(missing, key=repr))}, "
+                    f"unexpected {short_repr(sorted(extra, key=repr))}",
+                )
+            continue
+        else:
+            attributes = _attributes(expected)
+            if attributes is None:
+                if not _equal(expected, actual):
+                    yield Difference(path, _mismatch(expected, actual))
+                continue
+            actual_attributes = dict(_attributes(actual) or ())
+            for name, value in attributes:
+                child_path = f"{path}.{name}"
+                if name not in actual_attributes:
+                    if ignore is None or not ignore.match(child_path):
+                        yield Difference(child_path, "missing")
+                else:
+                    children.append((child_path, value, actual_attributes[name]))
+        if children:
+            on_path.add(key)
+            stack.append((None, key, None))
+            # Reversed, so that differences come out in order
+            stack.extend(reversed(children))
+
+
+def _equal(expected: Any, actual: Any) -> bool:
+    try:
+        return bool(expected == actual)
+    except Exception:
+        return False
+
+
+def differences(
+    expected: Any,
+    actual: Any,
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+    path: str = "return",
+) -> List[Difference]:
+    """Return the first `options.max_differences` differences between two
+    values, and one more if there are more."""
+    return list(
+        itertools.islice(
+            iter_differences(expected, actual, options, path), options.max_differences + 1
+        )
+    )
+
+
+def compare_golden(
+    golden: GoldenValue,
+    actual: Any,
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+    path: str = "return",
+) -> List[Difference]:
+    """Compare a value with a recorded one, see `differences`.
+
+    The value is first serialized with the codec of the recorded one: when
+    both serialize the same, they are equal and the recorded value isn't even
+    decoded.
+    """
+    try:
+        if golden.codec.encode(actual) == golden.serialized:
+            return []
+    except Exception:
+        # Not serializable, compare the values
+        pass
+    return differences(golden.value, actual, options, path)
+
+
+def format_differences(differences: List[Difference], max_differences: int) -> str:
+    lines = [str(d) for d in differences[:max_differences]]
+    if len(differences) > max_differences:
+        lines.append("...")
+    return "\n    ".join(lines)
@@ -1,125 +1,449 @@
-import functools
-import os
-import pathlib
-import sys
-import sysconfig
-from abc import ABCMeta, abstractmethod
-from contextlib import contextmanager
-from types import CodeType
-from typing import Iterator, Optional
-
-from goldenrun.db.base import FuncRecordStore, FuncRecordStoreLogger
-from goldenrun.db.sqlite import SQLiteStore
-from goldenrun.tracing import CodeFilter, FuncRecordLogger
-
-
-class Config(metaclass=ABCMeta):
-    """A Config ties together concrete implementations of the different abstractions
-    that make up a typical deployment of GoldenRun.
-    """
-
-    @abstractmethod
-    def trace_store(self) -> FuncRecordStore:
-        """Return the FuncRecordStore for storage/retrieval of call traces."""
-        pass
-
-    @contextmanager
-    def cli_context(self, command: str) -> Iterator[None]:
-        """Lifecycle hook that is called once right after the CLI
-        starts.
-
-        `command` is the name of the command passed to goldenrun
-        ('run', 'apply', etc).
-        """
-        yield
-
-    def trace_logger(self) -> FuncRecordLogger:
-        """Return the FuncRecordLogger for logging call traces.
-
-        By default, returns a FuncRecordStoreLogger that logs to the configured
-        trace store.
-        """
-        return FuncRecordStoreLogger(self.trace_store())
-
-    def code_filter(self) -> Optional[CodeFilter]:
-        """Return the (optional) CodeFilter predicate for triaging calls.
-
-        A CodeFilter is a callable that takes a code object and returns a
-        boolean determining whether the call should be traced or not. If None is
-        returned, all calls will be traced and logged.
-        """
-        return None
-
-
-lib_paths = {sysconfig.get_path(n) for n in ["stdlib", "purelib", "platlib"]}
-# if in a virtualenv, also exclude the real stdlib location
-venv_real_prefix = getattr(sys, "real_prefix", None)
-if venv_real_prefix:
-    lib_paths.add(
-        sysconfig.get_path("stdlib", vars={"installed_base": venv_real_prefix})
-    )
-LIB_PATHS = tuple(pathlib.Path(p).resolve() for p in lib_paths if p is not None)
-
-
-def _startswith(a: pathlib.Path, b: pathlib.Path) -> bool:
-    try:
-        return bool(a.relative_to(b))
-    except ValueError:
-        return False
-
-
-@functools.lru_cache(maxsize=8192)
-def default_code_filter(code: CodeType) -> bool:
-    """A CodeFilter to exclude stdlib and site-packages."""
-    # Filter code without a source file
-    if not code.co_filename or code.co_filename[0] == "<":
-        return False
-
-    filename = pathlib.Path(code.co_filename).resolve()
-    # if GOLDENRUN_TRACE_MODULES is defined, trace only specified packages or modules
-    trace_modules_str = os.environ.get("GOLDENRUN_TRACE_MODULES")
-    if trace_modules_str is not None:
-        trace_modules = trace_modules_str.split(",")
-        # try to remove lib_path to only check package and module names
-        for lib_path in LIB_PATHS:
-            try:
-                filename = filename.relative_to(lib_path)
-                break
-            except ValueError:
-                pass
-        return any(m == filename.stem or m in filename.parts for m in trace_modules)
-    else:
-        return not any(_startswith(filename, lib_path) for lib_path in LIB_PATHS)
-
-
-class DefaultConfig(Config):
-    DB_PATH_VAR = "GR_DB_PATH"
-
-    # def type_rewriter(self) -> TypeRewriter:
-    #     return DEFAULT_REWRITER
-
-    def trace_store(self) -> FuncRecordStore:
-        """By default we store traces in a local SQLite database.
-
-        The path to this database file can be customized via the `GR_DB_PATH`
-        environment variable.
-        """
-        db_path = os.environ.get(self.DB_PATH_VAR, "goldenrun.sqlite3")
-        return SQLiteStore.make_store(db_path)
-
-    def code_filter(self) -> CodeFilter:
-        """Default code filter excludes standard library & site-packages."""
-        return default_code_filter
-
-
-def get_default_config() -> Config:
-    """Use goldenrun_config.CONFIG if it exists, otherwise DefaultConfig().
-
-    goldenrun_config is not a module that is part of the goldenrun
-    distribution, it must be created by the user.
-    """
-    try:
-        import goldenrun_config  # type: ignore[import-not-found]
-    except ImportError:
-        return DefaultConfig()
-    return goldenrun_config.CONFIG  # type: ignore[no-any-return]
+import fnmatch
+import os
+import re
+import sys
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from types import CodeType
+from typing import (TYPE_CHECKING, Any, Dict, Iterable, Iterator, List,
+                    Optional, Pattern, Set, Tuple)
+
+from goldenrun.db import parse_connection_string
+
+# Store backends, codecs and the tracer are imported when first used, which
+# keeps the CLI quick to start
+if TYPE_CHECKING:
+    import pathlib
+
+    from goldenrun.compare import CompareOptions
+    from goldenrun.db.base import (AsyncLogProfile, FuncRecordStore,
+                                   RetentionPolicy)
+    from goldenrun.db.binlog import LogProfile
+    from goldenrun.db.sqlite import SQLiteProfile
+    from goldenrun.serialization import Codec
+    from goldenrun.tracing import CodeFilter, FuncRecordLogger, SampleRate
+
+
+class Config(metaclass=ABCMeta):
+    """A Config ties together concrete implementations of the different abstractions
+    that make up a typical deployment of GoldenRun.
+    """
+
+    @abstractmethod
+    def trace_store(self) -> "FuncRecordStore":
+        """Return the FuncRecordStore for storage/retrieval of call traces."""
+        pass
+
+    @contextmanager
+    def cli_context(self, command: str) -> Iterator[None]:
+        """Lifecycle hook that is called once right after the CLI
+        starts.
+
+        `command` is the name of the command passed to goldenrun
+        ('run', 'apply', etc).
+        """
+        yield
+
+    def trace_logger(self) -> "FuncRecordLogger":
+        """Return the FuncRecordLogger for logging call traces.
+
+        By default, returns a FuncRecordStoreLogger that logs to the configured
+        trace store, or an AsyncFuncRecordStoreLogger if `async_log_profile`
+        returns settings for one.
+        """
+        from goldenrun.db.base import (AsyncFuncRecordStoreLogger,
+                                       FuncRecordStoreLogger)
+
+        profile = self.async_log_profile()
+        if profile is not None:
+            return AsyncFuncRecordStoreLogger(self.trace_store(), **profile._asdict())
+        return FuncRecordStoreLogger(self.trace_store())
+
+    def async_log_profile(self) -> "Optional[AsyncLogProfile]":
+        """Settings for writing traces to the trace store from a background thread.
+
+        If None is returned, traces are stored by the thread that flushes the
+        logger. See `goldenrun.db.base.AsyncFuncRecordStoreLogger` for what
+        each setting does.
+        """
+        return None
+
+    def sqlite_profile(self) -> "SQLiteProfile":
+        """Connection settings for the SQLite trace store.
+
+        Defaults to WAL journaling with `synchronous=NORMAL`, so concurrent
+        recorders and replay runs don't block each other.
+        """
+        from goldenrun.db.sqlite import DEFAULT_PROFILE
+
+        return DEFAULT_PROFILE
+
+    def log_profile(self) -> "LogProfile":
+        """Settings of the binary log trace store.
+
+        Defaults to syncing the log to disk at most once per second.
+        """
+        from goldenrun.db.binlog import DEFAULT_LOG_PROFILE
+
+        return DEFAULT_LOG_PROFILE
+
+    def record_dedupe(self) -> Optional[str]:
+        """How the SQLite trace store handles repeated calls.
+
+        None keeps every call. `goldenrun.db.sqlite.DEDUPE_DISTINCT` keeps one
+        record per distinct arguments and return value, and
+        `goldenrun.db.sqlite.DEDUPE_COUNT` also counts the calls it stands for.
+        """
+        return None
+
+    def retention(self) -> "RetentionPolicy":
+        """Limits on the records kept by the trace store.
+
+        None by default. `goldenrun vacuum` enforces them, and can override
+        them from the command line.
+        """
+        from goldenrun.db.base import NO_RETENTION
+
+        return NO_RETENTION
+
+    def codec(self) -> "Codec":
+        """Codec used to serialize recorded arguments and return values.
+
+        Defaults to pickle protocol 5 with out-of-band buffers, zlib-compressed
+        when larger than 4 KiB. See `goldenrun.serialization` for the others.
+        """
+        from goldenrun.serialization import DEFAULT_CODEC
+
+        return DEFAULT_CODEC
+
+    def code_filter(self) -> "Optional[CodeFilter]":
+        """Return the (optional) CodeFilter predicate for triaging calls.
+
+        A CodeFilter is a callable that takes a code object and returns a
+        boolean determining whether the call should be traced or not. If None is
+        returned, all calls will be traced and logged.
+        """
+        return None
+
+    def sample_rate(self) -> "Optional[SampleRate]":
+        """Return the sample rate for calls to `@record` functions.
+
+        Either a global rate between 0 and 1, or a `goldenrun.tracing.Sampler` for
+        per-function rates and hash-of-args sampling. If None is returned, every
+        call is recorded unless its `@record` decorator sets a rate.
+        """
+        return None
+
+    def tracing_backend(self) -> Optional[str]:
+        """Return the tracing backend used to collect calls.
+
+        One of `goldenrun.tracing.BACKEND_MONITORING` or
+        `goldenrun.tracing.BACKEND_SETPROFILE`. If None is returned,
+        `sys.monitoring` is used when available and `sys.setprofile` otherwise.
+        """
+        return None
+
+    def lazy_tracing(self) -> bool:
+        """Whether to trace only while a `@record` function is running.
+
+        Lazy tracing leaves code outside of recorded calls running at native
+        speed, at the cost of installing the tracer on every recorded call.
+        """
+        return False
+
+    def max_yields(self) -> Optional[int]:
+        """Return the number of yielded values kept per call to a generator.
+
+        Values yielded past this many are counted but not stored. If None is
+        returned, `goldenrun.tracing.DEFAULT_MAX_YIELDS` is used.
+        """
+        return None
+
+    def snapshot_args(self) -> bool:
+        """Whether to copy the arguments of traced calls when they start.
+
+        By default arguments are captured by reference, so a call that mutates
+        its arguments is recorded with the mutated values. Copying avoids that at
+        the cost of a deep copy per traced call.
+        """
+        return False
+
+    def collect_stats(self) -> bool:
+        """Whether to count the work done while recording, see `goldenrun.stats`.
+
+        Off by default, as counting slows tracing down slightly.
+        """
+        return False
+
+    def compare_options(self) -> "CompareOptions":
+        """How replayed return and yielded values are compared with recorded ones.
+
+        Exact by default. Float tolerances and ignored paths can also be given
+        to `goldenrun replay`, see `goldenrun.compare.CompareOptions`.
+        """
+        from goldenrun.compare import DEFAULT_COMPARE_OPTIONS
+
+        return DEFAULT_COMPARE_OPTIONS
+
+    def replay_cache_path(self) -> str:
+        """Path of the database where `goldenrun replay --incremental`
+        remembers the records that passed."""
+        return "goldenrun-replay.sqlite3"
+
+    def collector_address(self) -> str:
+        """Address `goldenrun collector` listens on, see
+        `goldenrun.collector.parse_address`."""
+        from goldenrun.collector import DEFAULT_ADDRESS
+
+        return DEFAULT_ADDRESS
+
+
+_lib_paths: Optional[Tuple[List[str], Tuple["pathlib.Path", ...]]] = None
+
+
+def get_lib_paths() -> Tuple[List[str], Tuple["pathlib.Path", ...]]:
+    """Return the stdlib and site-packages directories, as configured and resolved.
+
+    Computed on first use, as sysconfig is slow to import.
+    """
+    global _lib_paths
+    if _lib_paths is None:
+        import pathlib
+        import sysconfig
+
+        paths: Set[Optional[str]] = {
+            sysconfig.get_path(n) for n in ["stdlib", "purelib", "platlib"]
+        }
+        # if in a virtualenv, also exclude the real stdlib location
+        venv_real_prefix = getattr(sys, "real_prefix", None)
+        if venv_real_prefix:
+            paths.add(
+                sysconfig.get_path("stdlib", vars={"installed_base": venv_real_prefix})
+            )
+        configured = [p for p in paths if p is not None]
+        _lib_paths = configured, tuple(pathlib.Path(p).resolve() for p in configured)
+    return _lib_paths
+
+
+def __getattr__(name: str) -> Any:
+    # `lib_paths` and `LIB_PATHS` used to be computed on import
+    if name == "lib_paths":
+        return set(get_lib_paths()[0])
+    if name == "LIB_PATHS":
+        return get_lib_paths()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class CompiledCodeFilter:
+    """A CodeFilter compiled once from configuration.
+
+    Decisions are made on plain string prefixes of normalized file names, so no
+    filesystem call is made per code object, and are cached per file name for
+    the lifetime of the filter. A code object is traced if its file:
+    - doesn't match any of the `exclude` globs, and
+    - matches one of the `include` globs, or
+    - when `trace_modules` is given, belongs to one of those packages or modules,
+    - otherwise, is not under one of the `lib_paths`.
+    """
+
+    def __init__(
+        self,
+        lib_paths: Iterable[str],
+        trace_modules: Optional[Iterable[str]] = None,
+        include: Iterable[str] = (),
+        exclude: Iterable[str] = (),
+    ) -> None:
+        self.lib_prefixes = tuple(
+            sorted(
+                {os.path.join(os.path.normcase(p), "") for p in lib_paths},
+                key=len,
+                reverse=True,
+            )
+        )
+        self.trace_modules = None if trace_modules is None else set(trace_modules)
+        self.include = _compile_globs(include)
+        self.exclude = _compile_globs(exclude)
+        self.decisions: Dict[str, bool] = {}
+
+    def __call__(self, code: CodeType) -> bool:
+        filename = code.co_filename
+        decision = self.decisions.get(filename)
+        if decision is None:
+            decision = self.decisions[filename] = self._decide(filename)
+        return decision
+
+    def _decide(self, filename: str) -> bool:
+        # Filter code without a source file
+        if not filename or filename[0] == "<":
+            return False
+        path = os.path.normcase(os.path.abspath(filename))
+        if self.exclude and self.exclude.match(path):
+            return False
+        if self.include and self.include.match(path):
+            return True
+        lib_prefix = next((p for p in self.lib_prefixes if path.startswith(p)), None)
+        if self.trace_modules is not None:
+            # only check package and module names below the lib path
+            relative = path[len(lib_prefix) :] if lib_prefix else path
+            parts = relative.split(os.sep)
+            stem = os.path.splitext(parts[-1])[0]
+            return any(m == stem or m in parts for m in self.trace_modules)
+        return lib_prefix is None
+
+    @classmethod
+    def from_environment(
+        cls, include: Iterable[str] = (), exclude: Iterable[str] = ()
+    ) -> "CompiledCodeFilter":
+        """Build the default filter, excluding stdlib and site-packages.
+
+        If GOLDENRUN_TRACE_MODULES is defined, only the comma separated packages
+        or modules it lists are traced.
+        """
+        trace_modules_str = os.environ.get("GOLDENRUN_TRACE_MODULES")
+        trace_modules = None if trace_modules_str is None else trace_modules_str.split(",")
+        # Match both the configured and the resolved lib paths, so file names
+        # don't need to be resolved
+        configured, resolved = get_lib_paths()
+        paths = configured + [str(p) for p in resolved]
+        return cls(paths, trace_modules, include, exclude)
+
+
+def _compile_globs(patterns: Iterable[str]) -> Optional[Pattern[str]]:
+    patterns = [os.path.normcase(p) for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+
+_default_code_filter: Optional[CompiledCodeFilter] = None
+
+
+def default_code_filter(code: CodeType) -> bool:
+    """A CodeFilter to exclude stdlib and site-packages.
+
+    Compiled from the environment on first use, see
+    `CompiledCodeFilter.from_environment`.
+    """
+    global _default_code_filter
+    if _default_code_filter is None:
+        _default_code_filter = CompiledCodeFilter.from_environment()
+    return _default_code_filter(code)
+
+
+class DefaultConfig(Config):
+    DB_PATH_VAR = "GR_DB_PATH"
+    SHARDED_VAR = "GR_SHARDED"
+    STATS_VAR = "GR_STATS"
+    REPLAY_CACHE_VAR = "GR_REPLAY_CACHE"
+    COLLECTOR_VAR = "GR_COLLECTOR"
+    ASYNC_LOG_VAR = "GR_ASYNC_LOG"
+    TRACE_INCLUDE_VAR = "GOLDENRUN_TRACE_INCLUDE"
+    TRACE_EXCLUDE_VAR = "GOLDENRUN_TRACE_EXCLUDE"
+
+    # def type_rewriter(self) -> TypeRewriter:
+    #     return DEFAULT_REWRITER
+
+    def trace_store(self) -> "FuncRecordStore":
+        """By default we store traces in a local SQLite database.
+
+        The path to this database file can be customized via the `GR_DB_PATH`
+        environment variable. When `sharded` is true, each process writes to
+        its own shard of that database instead.
+
+        Prefixing the path with 'binlog:' stores traces in an append-only
+        binary log instead, see `goldenrun.db.binlog.BinaryLogStore`. Several
+        processes can write to the same log, so it is never sharded.
+        """
+        scheme, db_path = parse_connection_string(
+            os.environ.get(self.DB_PATH_VAR, "goldenrun.sqlite3")
+        )
+        if scheme == "binlog":
+            from goldenrun.db.binlog import BinaryLogStore
+
+            return BinaryLogStore.make_store(
+                db_path, self.log_profile(), self.codec(), self.retention()
+            )
+        from goldenrun.db.sqlite import ShardedSQLiteStore, SQLiteStore
+
+        store_class = ShardedSQLiteStore if self.sharded() else SQLiteStore
+        return store_class.make_store(
+            db_path,
+            self.sqlite_profile(),
+            self.record_dedupe(),
+            self.codec(),
+            self.retention(),
+        )
+
+    def trace_logger(self) -> "FuncRecordLogger":
+        """Send traces to a `goldenrun collector` when the `GR_COLLECTOR`
+        environment variable holds its address, which `goldenrun record
+        --collector` sets, otherwise store them in the trace store, from a
+        background thread if `async_log_profile` says so."""
+        address = os.environ.get(self.COLLECTOR_VAR)
+        if address:
+            from goldenrun.collector import CollectorLogger
+
+            return CollectorLogger(address, self.codec())
+        return super().trace_logger()
+
+    def async_log_profile(self) -> "Optional[AsyncLogProfile]":
+        """Enabled by setting the `GR_ASYNC_LOG` environment variable, or with
+        `goldenrun record --async-log`.
+
+        Its value is "1" for the default settings, or comma separated settings
+        such as "backpressure=drop-oldest,flush_size=500,flush_interval=0.5",
+        see `goldenrun.db.base.parse_async_log_profile`.
+        """
+        options = os.environ.get(self.ASYNC_LOG_VAR, "")
+        if options in ("", "0"):
+            return None
+        from goldenrun.db.base import parse_async_log_profile
+
+        return parse_async_log_profile(options)
+
+    def collector_address(self) -> str:
+        """Customized via the `GR_COLLECTOR` environment variable."""
+        return os.environ.get(self.COLLECTOR_VAR) or super().collector_address()
+
+    def sharded(self) -> bool:
+        """Whether each recording process writes to a shard file of its own.
+
+        Enabled by setting the `GR_SHARDED` environment variable, which
+        `goldenrun record --sharded` does. Shards are consolidated with
+        `goldenrun merge`.
+        """
+        return os.environ.get(self.SHARDED_VAR, "") not in ("", "0")
+
+    def collect_stats(self) -> bool:
+        """Enabled by setting the `GR_STATS` environment variable, or with
+        `goldenrun record --stats`."""
+        return os.environ.get(self.STATS_VAR, "") not in ("", "0")
+
+    def replay_cache_path(self) -> str:
+        """Customized via the `GR_REPLAY_CACHE` environment variable."""
+        return os.environ.get(self.REPLAY_CACHE_VAR, super().replay_cache_path())
+
+    def code_filter(self) -> "CodeFilter":
+        """Default code filter excludes standard library & site-packages.
+
+        Files matching one of the comma separated globs in
+        `GOLDENRUN_TRACE_INCLUDE` are always traced, and files matching
+        `GOLDENRUN_TRACE_EXCLUDE` never are.
+        """
+        return CompiledCodeFilter.from_environment(
+            include=os.environ.get(self.TRACE_INCLUDE_VAR, "").split(","),
+            exclude=os.environ.get(self.TRACE_EXCLUDE_VAR, "").split(","),
+        )
+
+
+def get_default_config() -> Config:
+    """Use goldenrun_config.CONFIG if it exists, otherwise DefaultConfig().
+
+    goldenrun_config is not a module that is part of the goldenrun
+    distribution, it must be created by the user.
+    """
+    try:
+        import goldenrun_config  # type: ignore[import-not-found]
+    except ImportError:
+        return DefaultConfig()
+    return goldenrun_config.CONFIG  # type: ignore[no-any-return]
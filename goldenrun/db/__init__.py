@@ -0,0 +1,43 @@
+import importlib
+from typing import TYPE_CHECKING, Any, Dict, Tuple, Type
+
+if TYPE_CHECKING:
+    from goldenrun.db.base import FuncRecordStore
+
+# Store backends by connection string scheme, imported when first used
+STORE_BACKENDS: Dict[str, str] = {
+    "sqlite": "goldenrun.db.sqlite:SQLiteStore",
+    "binlog": "goldenrun.db.binlog:BinaryLogStore",
+}
+DEFAULT_SCHEME = "sqlite"
+
+
+def parse_connection_string(connection_string: str) -> Tuple[str, str]:
+    """Split a connection string into its backend scheme and the location of
+    the store, e.g. 'binlog:traces.log' into ('binlog', 'traces.log').
+
+    Strings that don't start with a known scheme, such as plain paths, are
+    SQLite databases.
+    """
+    scheme, sep, location = connection_string.partition(":")
+    if not sep or scheme not in STORE_BACKENDS:
+        return DEFAULT_SCHEME, connection_string
+    if location.startswith("//"):
+        location = location[2:]
+    return scheme, location
+
+
+def store_backend(scheme: str) -> "Type[FuncRecordStore]":
+    """Return the FuncRecordStore class handling a connection string scheme."""
+    module, _, name = STORE_BACKENDS[scheme].partition(":")
+    return getattr(importlib.import_module(module), name)  # type: ignore[no-any-return]
+
+
+def make_store(connection_string: str, **options: Any) -> "FuncRecordStore":
+    """Create the store a connection string points to, with the backend
+    selected by its scheme.
+
+    `options` are passed on to the `make_store` of the backend.
+    """
+    scheme, location = parse_connection_string(connection_string)
+    return store_backend(scheme).make_store(location, **options)  # type: ignore[call-arg]
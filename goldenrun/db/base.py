@@ -1,63 +1,573 @@
-from abc import ABCMeta, abstractmethod
-from typing import Iterable, List
-
-from goldenrun.tracing import FuncRecord, FuncRecordLogger
-
-
-class FuncRecordThunk(metaclass=ABCMeta):
-    """A deferred computation that produces a FuncRecord or raises an error."""
-
-    @abstractmethod
-    def to_trace(self) -> FuncRecord:
-        """Produces the FuncRecord."""
-
-
-class FuncRecordStore(metaclass=ABCMeta):
-    """An interface that all concrete FuncRecord storage backends must implement."""
-
-    @abstractmethod
-    def add(self, traces: Iterable[FuncRecord]) -> None:
-        """Store the supplied call traces in the backing store"""
-
-    @abstractmethod
-    def get_records(
-        self, func_qualname: str, limit: int = 2000
-    ) -> List[FuncRecordThunk]:
-        """Query the backing store for any traces that match the supplied query.
-
-        By returning a list of thunks we let the caller get a partial result in the
-        event that decoding one or more call traces fails.
-        """
-
-    @classmethod
-    def make_store(cls, connection_string: str) -> "FuncRecordStore":
-        """Create a new store instance.
-
-        This is a factory function that is intended to be used by the CLI.
-        """
-        raise NotImplementedError(
-            f"Your FuncRecordStore ({cls.__module__}.{cls.__name__}) "
-            f"does not implement make_store()"
-        )
-
-    def list_modules(self) -> List[str]:
-        """List of traced modules from the backing store"""
-        raise NotImplementedError(
-            f"Your FuncRecordStore ({self.__class__.__module__}.{self.__class__.__name__}) "
-            f"does not implement list_modules()"
-        )
-
-
-class FuncRecordStoreLogger(FuncRecordLogger):
-    """A FuncRecordLogger that stores logged traces in a FuncRecordStore."""
-
-    def __init__(self, store: FuncRecordStore) -> None:
-        self.store = store
-        self.traces: List[FuncRecord] = []
-
-    def log(self, trace: FuncRecord) -> None:
-        self.traces.append(trace)
-
-    def flush(self) -> None:
-        self.store.add(self.traces)
-        self.traces = []
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import weakref
+from abc import ABCMeta, abstractmethod
+from datetime import datetime, timedelta
+from typing import (TYPE_CHECKING, Any, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Tuple, Union)
+
+from goldenrun.serialization import (DEFAULT_CODEC, Codec, PickleCodec,
+                                     Unserializable, get_codec)
+from goldenrun.stats import Stats, get_stats
+from goldenrun.tracing import FuncRecord, FuncRecordLogger, RaisedException
+
+if TYPE_CHECKING:
+    from goldenrun.collector import CollectorLogger
+
+logger = logging.getLogger(__name__)
+
+
+class FuncRecordThunk(metaclass=ABCMeta):
+    """A deferred computation that produces a FuncRecord or raises an error."""
+
+    @abstractmethod
+    def to_trace(self) -> FuncRecord:
+        """Produces the FuncRecord."""
+
+
+class SerializedFuncRecord(NamedTuple):
+    """A FuncRecord whose arguments and return value have already been serialized.
+
+    Holds no reference to the live objects of the traced call, so it can be
+    queued or buffered without keeping them alive.
+    """
+
+    module: str
+    qualname: str
+    created_at: datetime
+    serialized_args: bytes
+    serialized_return: bytes
+    # Tag of the codec that serialized args and return value, None for values
+    # stored before codecs were recorded
+    codec: Optional[str] = PickleCodec.tag
+    # Values kept from those yielded by a generator, None for other functions
+    serialized_yields: Optional[bytes] = None
+    yield_count: int = 0
+    # The exception raised by the call, if any
+    exception_type: Optional[str] = None
+    exception_message: Optional[str] = None
+    # The calls made by this call, in order. Their own children are not included
+    children: Tuple["SerializedFuncRecord", ...] = ()
+    # Digest of the code of the function and its callees when it was recorded
+    fingerprint: Optional[bytes] = None
+
+
+def decode_record(record: SerializedFuncRecord, decode_return: bool = True) -> FuncRecord:
+    """Decode a SerializedFuncRecord and its children.
+
+    If `decode_return` is False, the return value of the record itself is left
+    undecoded and set to None.
+    """
+    codec = get_codec(record.codec)
+    return FuncRecord.from_stored(
+        record.module,
+        record.qualname,
+        codec.decode(record.serialized_args),
+        codec.decode(record.serialized_return) if decode_return else None,
+        None if record.serialized_yields is None else codec.decode(record.serialized_yields),
+        record.yield_count or 0,
+        None
+        if record.exception_type is None
+        else RaisedException(record.exception_type, record.exception_message or ""),
+        [decode_record(child) for child in record.children] if record.children else None,
+    )
+
+
+def serialize_record(
+    trace: FuncRecord, codec: Codec, stats: Optional[Stats] = None
+) -> SerializedFuncRecord:
+    """Serialize a call trace and its children with codec.
+
+    A child whose values can't be encoded is kept with placeholders in their
+    place, rather than failing the whole record.
+    """
+    record = _serialize_call(trace, codec, stats)
+    if trace.children:
+        children = tuple(_serialize_child(child, codec, stats) for child in trace.children)
+        record = record._replace(children=children)
+    return record
+
+
+def _serialize_child(
+    trace: FuncRecord, codec: Codec, stats: Optional[Stats]
+) -> SerializedFuncRecord:
+    try:
+        return _serialize_call(trace, codec, stats)
+    except Exception:
+        logger.debug(
+            "Can't serialize all values of %s:%s", trace.module, trace.qualname,
+            exc_info=True,
+        )
+    # Not kept on the trace: the trace may be stored on its own, where its
+    # values must be encoded or fail
+    return SerializedFuncRecord(
+        trace.module,
+        trace.qualname,
+        datetime.now(),
+        codec.encode(
+            {name: _encodable(value, codec) for name, value in trace.args.items()}
+        ),
+        codec.encode(_encodable(trace.return_value, codec)),
+        codec.tag,
+        None if trace.yields is None else codec.encode(_encodable(trace.yields, codec)),
+        trace.yield_count,
+        None if trace.exception is None else trace.exception.type,
+        None if trace.exception is None else trace.exception.message,
+        fingerprint=trace.fingerprint,
+    )
+
+
+def _encodable(value: Any, codec: Codec) -> Any:
+    """Return value, or a placeholder for it if codec can't encode it."""
+    try:
+        codec.encode(value)
+    except Exception as exc:
+        return Unserializable.of(value, exc)
+    return value
+
+
+def _serialize_call(
+    trace: FuncRecord, codec: Codec, stats: Optional[Stats]
+) -> SerializedFuncRecord:
+    """Serialize a call trace without its children.
+
+    Children are serialized before their parent and once more as part of
+    it, so the result is kept on the trace.
+    """
+    record = trace.serialized
+    if record is None or record.codec != codec.tag:
+        start = time.perf_counter_ns() if stats is not None else 0
+        record = trace.serialized = SerializedFuncRecord(
+            trace.module,
+            trace.qualname,
+            datetime.now(),
+            codec.encode(trace.args),
+            codec.encode(trace.return_value),
+            codec.tag,
+            None if trace.yields is None else codec.encode(trace.yields),
+            trace.yield_count,
+            None if trace.exception is None else trace.exception.type,
+            None if trace.exception is None else trace.exception.message,
+            fingerprint=trace.fingerprint,
+        )
+        if stats is not None:
+            stats.serialize_ns += time.perf_counter_ns() - start
+            stats.bytes_serialized += (
+                len(record.serialized_args)
+                + len(record.serialized_return)
+                + len(record.serialized_yields or b"")
+            )
+    return record
+
+
+class SerializedFuncRecordThunk(FuncRecordThunk):
+    """A FuncRecordThunk that decodes a SerializedFuncRecord on demand."""
+
+    def __init__(self, record: SerializedFuncRecord) -> None:
+        self.record = record
+
+    @property
+    def module(self) -> str:
+        return self.record.module
+
+    @property
+    def qualname(self) -> str:
+        return self.record.qualname
+
+    @property
+    def created_at(self) -> datetime:
+        return self.record.created_at
+
+    def to_trace(self) -> FuncRecord:
+        return decode_record(self.record)
+
+
+class RetentionPolicy(NamedTuple):
+    """Limits on the records a FuncRecordStore keeps.
+
+    `max_records` caps the number of records kept per function. Calls past
+    that many are sampled so that every call has the same chance of being kept
+    (reservoir sampling). `max_age` drops records older than that, and
+    `max_bytes` drops the oldest records until the store fits in that many
+    bytes. Stores enforce these limits when vacuumed, and may sample calls
+    as they are added.
+    """
+
+    max_records: Optional[int] = None
+    max_age: Optional[timedelta] = None
+    max_bytes: Optional[int] = None
+
+
+NO_RETENTION = RetentionPolicy()
+
+
+class VacuumStats(NamedTuple):
+    """What `FuncRecordStore.vacuum` removed, and the size of the store in bytes
+    before and after."""
+
+    records_deleted: int
+    size_before: int
+    size_after: int
+
+
+class FuncRecordStore(metaclass=ABCMeta):
+    """An interface that all concrete FuncRecord storage backends must implement."""
+
+    # Codec used by `serialize`
+    codec: Codec = DEFAULT_CODEC
+    # Limits on the records kept
+    retention: RetentionPolicy = NO_RETENTION
+    # Where serialization and writes are counted, None when stats are off
+    stats: Optional[Stats] = None
+
+    @abstractmethod
+    def add(self, traces: Iterable[FuncRecord]) -> None:
+        """Store the supplied call traces in the backing store"""
+
+    @abstractmethod
+    def get_records(
+        self,
+        func_qualname: str,
+        limit: Optional[int] = 2000,
+        offset: int = 0,
+        module: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[FuncRecordThunk]:
+        """Query the backing store for any traces that match the supplied query.
+
+        Traces of `func_qualname` are optionally restricted to a `module` and to
+        those created in the [since, until) time range. At most `limit` traces
+        (all of them if None) are returned after skipping `offset`.
+
+        By returning an iterator of thunks we let the caller get a partial result in
+        the event that decoding one or more call traces fails, without loading all
+        of them in memory.
+        """
+
+    def serialize(self, trace: FuncRecord) -> SerializedFuncRecord:
+        """Serialize a call trace into the form expected by `add_serialized`."""
+        return serialize_record(trace, self.codec, self.stats)
+
+    def serialize_all(self, traces: Iterable[FuncRecord]) -> List[SerializedFuncRecord]:
+        """Serialize call traces, leaving out those that can't be serialized."""
+        records = []
+        for trace in traces:
+            try:
+                records.append(self.serialize(trace))
+            except Exception:
+                logger.exception("Can't serialize a trace of %s:%s", trace.module, trace.qualname)
+        return records
+
+    def add_serialized(self, records: Iterable[SerializedFuncRecord]) -> None:
+        """Store call traces previously serialized with `serialize`."""
+        raise NotImplementedError(
+            f"Your FuncRecordStore ({self.__class__.__module__}.{self.__class__.__name__}) "
+            f"does not implement add_serialized()"
+        )
+
+    @classmethod
+    def make_store(cls, connection_string: str) -> "FuncRecordStore":
+        """Create a new store instance.
+
+        This is a factory function that is intended to be used by the CLI.
+        """
+        raise NotImplementedError(
+            f"Your FuncRecordStore ({cls.__module__}.{cls.__name__}) "
+            f"does not implement make_store()"
+        )
+
+    def sync(self) -> None:
+        """Make the records added so far durable.
+
+        Called once recording ends, for stores that delay syncing to disk.
+        Does nothing by default.
+        """
+
+    def get_fingerprint(self, module: str, qualname: str) -> Optional[bytes]:
+        """Return the fingerprint of the code of a function when it was last
+        recorded, or None if unknown."""
+        return None
+
+    def vacuum(self) -> VacuumStats:
+        """Delete the records the retention policy doesn't keep and reclaim the
+        space they used."""
+        raise NotImplementedError(
+            f"Your FuncRecordStore ({self.__class__.__module__}.{self.__class__.__name__}) "
+            f"does not implement vacuum()"
+        )
+
+    def list_modules(self) -> List[str]:
+        """List of traced modules from the backing store"""
+        raise NotImplementedError(
+            f"Your FuncRecordStore ({self.__class__.__module__}.{self.__class__.__name__}) "
+            f"does not implement list_modules()"
+        )
+
+
+def reset_after_fork(
+    logger: "Union[FuncRecordStoreLogger, AsyncFuncRecordStoreLogger, CollectorLogger]",
+) -> None:
+    """Call `logger.after_fork()` in the child of every fork, for as long as
+    the logger is alive, and flush it when a multiprocessing child exits."""
+    ref = weakref.ref(logger)
+
+    def after_in_child() -> None:
+        instance = ref()
+        if instance is None:
+            return
+        instance.after_fork()
+        if "multiprocessing" in sys.modules:
+            # multiprocessing ends the processes it forks with os._exit, which
+            # skips the end of the `trace_calls` block that flushes the logger.
+            # It resets exit handlers once the child starts, then runs its own
+            # after-fork hooks.
+            from multiprocessing.util import register_after_fork
+
+            register_after_fork(instance, _flush_at_exit)
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=after_in_child)
+
+
+def _flush_at_exit(
+    logger: "Union[FuncRecordStoreLogger, AsyncFuncRecordStoreLogger, CollectorLogger]",
+) -> None:
+    from multiprocessing.util import Finalize
+
+    Finalize(None, logger.flush, exitpriority=0)
+
+
+class FuncRecordStoreLogger(FuncRecordLogger):
+    """A FuncRecordLogger that stores logged traces in a FuncRecordStore."""
+
+    def __init__(self, store: FuncRecordStore) -> None:
+        self.store = store
+        self.traces: List[FuncRecord] = []
+        self.stats = get_stats()
+        reset_after_fork(self)
+
+    def after_fork(self) -> None:
+        """Forget the traces logged by the parent process, which stores them."""
+        self.traces = []
+
+    def log(self, trace: FuncRecord) -> None:
+        self.traces.append(trace)
+
+    def flush(self) -> None:
+        if self.stats is None:
+            self.store.add(self.traces)
+        else:
+            start = time.perf_counter_ns()
+            self.store.add(self.traces)
+            self.stats.add_flush(time.perf_counter_ns() - start)
+        self.traces = []
+        self.store.sync()
+
+
+# What AsyncFuncRecordStoreLogger does when its queue is full
+BACKPRESSURE_BLOCK = "block"
+BACKPRESSURE_DROP_OLDEST = "drop-oldest"
+BACKPRESSURE_DROP_NEWEST = "drop-newest"
+BACKPRESSURE_POLICIES = {
+    BACKPRESSURE_BLOCK,
+    BACKPRESSURE_DROP_OLDEST,
+    BACKPRESSURE_DROP_NEWEST,
+}
+
+
+
+class AsyncLogProfile(NamedTuple):
+    """Settings of an AsyncFuncRecordStoreLogger, see its documentation."""
+
+    max_queue_size: int = 10000
+    flush_size: int = 1000
+    flush_interval: float = 1.0
+    backpressure: str = BACKPRESSURE_BLOCK
+
+
+DEFAULT_ASYNC_LOG_PROFILE = AsyncLogProfile()
+
+
+def parse_async_log_profile(options: str) -> AsyncLogProfile:
+    """Parse comma separated `<setting>=<value>` pairs into an AsyncLogProfile.
+
+    Settings left out keep their default, so "1" or "" gives the defaults.
+    For example: "backpressure=drop-oldest,flush_size=500,flush_interval=0.5".
+    """
+    values: Dict[str, Any] = {}
+    for option in options.split(","):
+        option = option.strip()
+        if not option or option == "1":
+            continue
+        name, sep, value = option.partition("=")
+        name = name.strip().replace("-", "_")
+        if not sep or name not in AsyncLogProfile._fields:
+            raise ValueError(f"Invalid async logging setting: {option}")
+        if name == "backpressure":
+            if value not in BACKPRESSURE_POLICIES:
+                raise ValueError(f"Unknown backpressure policy: {value}")
+            values[name] = value
+        elif name == "flush_interval":
+            values[name] = float(value)
+        else:
+            values[name] = int(value)
+    return AsyncLogProfile(**values)
+
+
+_STOP = object()
+
+
+class _RecordQueue(queue.Queue):
+    """A queue of records to store, and of flush events and _STOP, the control
+    items that the writer thread must always get."""
+
+    def put_control(self, item: object) -> None:
+        """Queue a control item, even if that exceeds maxsize."""
+        with self.mutex:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def put_dropping_oldest(self, record: SerializedFuncRecord) -> bool:
+        """Queue a record, discarding the oldest queued record if the queue is
+        full. Return True if a record was discarded."""
+        with self.not_full:
+            dropped = False
+            while 0 < self.maxsize <= self._qsize():
+                for i, item in enumerate(self.queue):
+                    if isinstance(item, SerializedFuncRecord):
+                        del self.queue[i]
+                        dropped = True
+                        break
+                else:
+                    # Only control items are queued, wait for the writer
+                    self.not_full.wait()
+                    continue
+                break
+            self._put(record)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return dropped
+
+
+class AsyncFuncRecordStoreLogger(FuncRecordLogger):
+    """A FuncRecordLogger that writes to a FuncRecordStore from a background thread.
+
+    Traces are serialized as soon as they are logged and handed to a writer
+    thread over a queue holding at most `max_queue_size` records. The writer
+    stores them in batches once `flush_size` records are pending or
+    `flush_interval` seconds have passed since the first pending record.
+
+    When the queue is full, `backpressure` decides whether `log` blocks until
+    there is room (BACKPRESSURE_BLOCK), discards the oldest queued record
+    (BACKPRESSURE_DROP_OLDEST) or discards the record being logged
+    (BACKPRESSURE_DROP_NEWEST). Discarded records are counted in `dropped`.
+    """
+
+    def __init__(
+        self,
+        store: FuncRecordStore,
+        max_queue_size: int = 10000,
+        flush_size: int = 1000,
+        flush_interval: float = 1.0,
+        backpressure: str = BACKPRESSURE_BLOCK,
+    ) -> None:
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+        self.store = store
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.max_queue_size = max_queue_size
+        self.dropped = 0
+        self.stats = get_stats()
+        self._start()
+        reset_after_fork(self)
+
+    def _start(self) -> None:
+        self.queue = _RecordQueue(self.max_queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name="goldenrun-writer", daemon=True
+        )
+        self._thread.start()
+
+    def after_fork(self) -> None:
+        """Start a writer thread of our own: the writer thread doesn't survive
+        a fork, and the records it had queued are stored by the parent."""
+        self.dropped = 0
+        self._start()
+
+    def log(self, trace: FuncRecord) -> None:
+        try:
+            record = self.store.serialize(trace)
+        except Exception:
+            logger.exception("Can't serialize a trace of %s:%s", trace.module, trace.qualname)
+            return
+        if self.backpressure == BACKPRESSURE_BLOCK:
+            self.queue.put(record)
+        elif self.backpressure == BACKPRESSURE_DROP_NEWEST:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+        elif self.queue.put_dropping_oldest(record):
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """Block until every trace logged so far has been stored."""
+        done = threading.Event()
+        self.queue.put_control(done)
+        done.wait()
+
+    def close(self) -> None:
+        """Store pending traces and stop the writer thread."""
+        self.queue.put_control(_STOP)
+        self._thread.join()
+
+    def _write(self, batch: List[SerializedFuncRecord]) -> None:
+        if not batch:
+            return
+        start = time.perf_counter_ns() if self.stats is not None else 0
+        try:
+            self.store.add_serialized(batch)
+        except Exception:
+            logger.exception("Failed storing %d traces", len(batch))
+        if self.stats is not None:
+            self.stats.add_flush(time.perf_counter_ns() - start)
+
+    def _sync(self) -> None:
+        try:
+            self.store.sync()
+        except Exception:
+            logger.exception("Failed syncing the trace store")
+
+    def _run(self) -> None:
+        batch: List[SerializedFuncRecord] = []
+        deadline: Optional[float] = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, SerializedFuncRecord):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batch) < self.flush_size and time.monotonic() < deadline:
+                    continue
+            self._write(batch)
+            batch = []
+            deadline = None
+            if isinstance(item, threading.Event) or item is _STOP:
+                self._sync()
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is _STOP:
+                return
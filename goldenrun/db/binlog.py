@@ -0,0 +1,536 @@
+import hashlib
+import itertools
+import logging
+import mmap
+import os
+import pickle
+import random
+import struct
+import threading
+import time
+import zlib
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from typing import (IO, Any, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Tuple)
+
+from goldenrun.db.base import (NO_RETENTION, FuncRecordStore, FuncRecordThunk,
+                               RetentionPolicy, SerializedFuncRecord,
+                               SerializedFuncRecordThunk, VacuumStats)
+from goldenrun.serialization import Codec
+from goldenrun.stats import get_stats
+from goldenrun.tracing import FuncRecord
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# Every frame starts with the length of its payload and the CRC-32 of it
+FRAME_HEADER = struct.Struct("<II")
+# Payloads of log frames start with the creation time of the record
+TIMESTAMP = struct.Struct("<d")
+LOG_MAGIC = b"GRLOG\x00\x00\x01"
+INDEX_MAGIC = b"GRIDX\x00\x00\x01"
+
+# An index entry: the function of a record, its offset and creation time
+IndexEntry = Tuple[str, str, int, float]
+
+
+class LogProfile(NamedTuple):
+    """Settings of a BinaryLogStore.
+
+    Records are handed to the OS as soon as they are added, so they survive
+    the recording process crashing, but only survive a power loss once the
+    files are synced. `fsync_interval` is the least number of seconds between
+    two syncs: 0 syncs every batch, None leaves it to the OS and `close`.
+    Batches added since the last sync are also synced when recording ends,
+    see `BinaryLogStore.sync`.
+    """
+
+    fsync_interval: Optional[float] = 1.0
+
+
+DEFAULT_LOG_PROFILE = LogProfile()
+
+
+def frame(payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_frames(data: memoryview, start: int) -> Iterator[Tuple[int, memoryview]]:
+    """Yield the offset and payload of each intact frame of data from start.
+
+    Stops at the end of data or at the first truncated or corrupted frame.
+    """
+    offset = start
+    while offset + FRAME_HEADER.size <= len(data):
+        length, crc = FRAME_HEADER.unpack_from(data, offset)
+        end = offset + FRAME_HEADER.size + length
+        payload = data[offset + FRAME_HEADER.size : end]
+        if end > len(data) or zlib.crc32(payload) != crc:
+            return
+        yield offset, payload
+        offset = end
+
+
+def _call_body(record: SerializedFuncRecord) -> Tuple[Any, ...]:
+    return (
+        record.module,
+        record.qualname,
+        record.serialized_args,
+        record.serialized_return,
+        record.codec,
+        record.serialized_yields,
+        record.yield_count,
+        record.exception_type,
+        record.exception_message,
+    )
+
+
+def encode_record(record: SerializedFuncRecord) -> bytes:
+    """Encode a record as the payload of a log frame.
+
+    Children are stored with their parent and share its creation time.
+    """
+    body = _call_body(record), tuple(_call_body(child) for child in record.children)
+    return TIMESTAMP.pack(record.created_at.timestamp()) + pickle.dumps(
+        body, protocol=pickle.HIGHEST_PROTOCOL
+    )
+
+
+def decode_record(payload: memoryview) -> SerializedFuncRecord:
+    """Decode the payload of a log frame written by `encode_record`."""
+    (timestamp,) = TIMESTAMP.unpack_from(payload)
+    created_at = datetime.fromtimestamp(timestamp)
+    call, children = pickle.loads(payload[TIMESTAMP.size :])
+    return SerializedFuncRecord(
+        *call[:2],
+        created_at,
+        *call[2:],
+        children=tuple(
+            SerializedFuncRecord(*child[:2], created_at, *child[2:]) for child in children
+        ),
+    )
+
+
+def index_entry(record: SerializedFuncRecord, offset: int) -> IndexEntry:
+    return record.module, record.qualname, offset, record.created_at.timestamp()
+
+
+class FuncIndex:
+    """Offsets and creation times of the records of one function, in log order."""
+
+    __slots__ = ("offsets", "times")
+
+    def __init__(self) -> None:
+        self.offsets = array("q")
+        self.times = array("d")
+
+
+class BinaryLogStore(FuncRecordStore):
+    """Stores call traces in an append-only log file.
+
+    Each record is a length-prefixed, checksummed frame appended to the log at
+    `path`, and a batch of records is written with a single write. The offsets
+    of the records of each function are appended to a side index at
+    `path.idx`, loaded in memory and kept up to date with the writes of other
+    processes, which take turns through a lock on `path.lock`. Reads decode
+    frames straight from a memory map of the log.
+
+    Records are never updated in place: `compact` rewrites the log without
+    duplicated records, `vacuum` without those the retention policy doesn't
+    keep, and `export` copies it to another store, such as a SQLiteStore.
+    """
+
+    # Number of records written per batch
+    BATCH_SIZE = 1000
+
+    def __init__(
+        self,
+        path: str,
+        profile: LogProfile = DEFAULT_LOG_PROFILE,
+        codec: Optional[Codec] = None,
+        retention: RetentionPolicy = NO_RETENTION,
+    ) -> None:
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.profile = profile
+        if codec is not None:
+            self.codec = codec
+        self.retention = retention
+        self.stats = get_stats()
+        self.funcs: Dict[Tuple[str, str], FuncIndex] = {}
+        self._lock = threading.RLock()
+        self._lock_file = open(f"{path}.lock", "ab")
+        self._log: Optional[IO[bytes]] = None
+        self._index: Optional[IO[bytes]] = None
+        self._map: Optional[mmap.mmap] = None
+        # How far the log and the index have been indexed and read
+        self._log_end = 0
+        self._index_end = 0
+        self._last_sync = time.monotonic()
+        # Whether batches were written since the last sync
+        self._unsynced = False
+        try:
+            with self._locked(exclusive=True):
+                self._open()
+                self._recover()
+        except BaseException:
+            self._close_files()
+            raise
+
+    @classmethod
+    def make_store(
+        cls,
+        connection_string: str,
+        profile: Optional[LogProfile] = None,
+        codec: Optional[Codec] = None,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> "FuncRecordStore":
+        return cls(
+            connection_string,
+            profile or DEFAULT_LOG_PROFILE,
+            codec,
+            retention or NO_RETENTION,
+        )
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self) -> None:
+        """(Re)open the log and index files and forget what was read of them."""
+        for f in (self._log, self._index):
+            if f is not None:
+                f.close()
+        self._log = open(self.path, "a+b", buffering=0)
+        self._index = open(self.index_path, "a+b", buffering=0)
+        for f, magic in ((self._log, LOG_MAGIC), (self._index, INDEX_MAGIC)):
+            if os.fstat(f.fileno()).st_size == 0:
+                f.write(magic)
+            f.seek(0)
+            if f.read(len(magic)) != magic:
+                raise ValueError(f"{f.name} is not a GoldenRun log")
+        self.funcs = {}
+        self._map = None
+        self._log_end = len(LOG_MAGIC)
+        self._index_end = len(INDEX_MAGIC)
+
+    def _refresh(self) -> None:
+        """Load the index entries written since the last refresh.
+
+        Must be called with the lock held.
+        """
+        assert self._log is not None and self._index is not None
+        try:
+            replaced = os.stat(self.path).st_ino != os.fstat(self._log.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            # Compacted by another process
+            self._open()
+        self._index.seek(self._index_end)
+        data = memoryview(self._index.read())
+        for _, payload in read_frames(data, 0):
+            log_end, entries = pickle.loads(payload)
+            self._add_entries(entries, log_end)
+            self._index_end += FRAME_HEADER.size + len(payload)
+
+    def _add_entries(self, entries: List[IndexEntry], log_end: int) -> None:
+        for module, qualname, offset, timestamp in entries:
+            index = self.funcs.get((module, qualname))
+            if index is None:
+                index = self.funcs[(module, qualname)] = FuncIndex()
+            index.offsets.append(offset)
+            index.times.append(timestamp)
+        self._log_end = max(self._log_end, log_end)
+
+    def _write_index(self, entries: List[IndexEntry], log_end: int) -> None:
+        assert self._index is not None
+        data = frame(pickle.dumps((log_end, entries)))
+        self._index.write(data)
+        self._index_end += len(data)
+        self._add_entries(entries, log_end)
+
+    def _recover(self) -> None:
+        """Index the records a crashed writer added to the log but not to the
+        index, and drop the frames it left incomplete.
+
+        Must be called with the exclusive lock held.
+        """
+        assert self._log is not None and self._index is not None
+        self._refresh()
+        if os.fstat(self._index.fileno()).st_size > self._index_end:
+            os.truncate(self._index.fileno(), self._index_end)
+        self._log.seek(self._log_end)
+        data = memoryview(self._log.read())
+        entries: List[IndexEntry] = []
+        end = 0
+        for offset, payload in read_frames(data, 0):
+            record = decode_record(payload)
+            entries.append(index_entry(record, self._log_end + offset))
+            end = offset + FRAME_HEADER.size + len(payload)
+        if end < len(data):
+            logger.warning(
+                "Dropping %d bytes of incomplete records from %s",
+                len(data) - end,
+                self.path,
+            )
+            os.truncate(self._log.fileno(), self._log_end + end)
+        if entries:
+            self._write_index(entries, self._log_end + end)
+
+    def add(self, traces: Iterable[FuncRecord]) -> None:
+        self.add_serialized(self.serialize_all(traces))
+
+    def add_serialized(self, records: Iterable[SerializedFuncRecord]) -> None:
+        records = iter(records)
+        while True:
+            batch = list(itertools.islice(records, self.BATCH_SIZE))
+            if not batch:
+                break
+            start = time.perf_counter_ns() if self.stats is not None else 0
+            frames = [frame(encode_record(record)) for record in batch]
+            with self._locked(exclusive=True):
+                assert self._log is not None and self._index is not None
+                self._refresh()
+                offset = os.fstat(self._log.fileno()).st_size
+                entries: List[IndexEntry] = []
+                for record, data in zip(batch, frames):
+                    entries.append(index_entry(record, offset))
+                    offset += len(data)
+                self._log.write(b"".join(frames))
+                sync = self._sync_due()
+                if sync:
+                    # The log must be durable before the index points into it
+                    os.fsync(self._log.fileno())
+                self._write_index(entries, offset)
+                if sync:
+                    os.fsync(self._index.fileno())
+                self._unsynced = not sync
+            if self.stats is not None:
+                self.stats.records_stored += len(batch)
+                self.stats.store_batches += 1
+                self.stats.store_ns += time.perf_counter_ns() - start
+
+    def _sync_due(self) -> bool:
+        interval = self.profile.fsync_interval
+        if interval is None:
+            return False
+        now = time.monotonic()
+        if now - self._last_sync < interval:
+            return False
+        self._last_sync = now
+        return True
+
+    def sync(self) -> None:
+        """Sync the batches added since the last sync, unless `fsync_interval`
+        is None."""
+        with self._lock:
+            if not self._unsynced or self.profile.fsync_interval is None:
+                return
+            assert self._log is not None and self._index is not None
+            os.fsync(self._log.fileno())
+            os.fsync(self._index.fileno())
+            self._last_sync = time.monotonic()
+            self._unsynced = False
+
+    def _view(self) -> memoryview:
+        """A view of the log, covering every record indexed so far."""
+        assert self._log is not None
+        if self._map is None or len(self._map) < self._log_end:
+            # Views handed out earlier keep the previous map alive
+            self._map = mmap.mmap(self._log.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def _read(self, view: memoryview, offset: int) -> SerializedFuncRecord:
+        length, crc = FRAME_HEADER.unpack_from(view, offset)
+        start = offset + FRAME_HEADER.size
+        payload = view[start : start + length]
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Corrupted record at offset {offset} of {self.path}")
+        return decode_record(payload)
+
+    def get_records(
+        self,
+        func_qualname: str,
+        limit: Optional[int] = 2000,
+        offset: int = 0,
+        module: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[FuncRecordThunk]:
+        since_ts = None if since is None else since.timestamp()
+        until_ts = None if until is None else until.timestamp()
+        with self._locked(exclusive=False):
+            self._refresh()
+            offsets = [
+                record_offset
+                for (func_module, qualname), index in self.funcs.items()
+                if qualname == func_qualname and (module is None or func_module == module)
+                for record_offset, timestamp in zip(index.offsets, index.times)
+                if (since_ts is None or timestamp >= since_ts)
+                and (until_ts is None or timestamp < until_ts)
+            ]
+            view = self._view() if offsets else memoryview(b"")
+        stop = None if limit is None else offset + limit
+        try:
+            for record_offset in itertools.islice(offsets, offset, stop):
+                yield SerializedFuncRecordThunk(self._read(view, record_offset))
+        finally:
+            view.release()
+
+    def list_modules(self) -> List[str]:
+        """Modules with records, most recently recorded first."""
+        with self._locked(exclusive=False):
+            self._refresh()
+            latest: Dict[str, float] = {}
+            for (module, _), index in self.funcs.items():
+                if module and index.times:
+                    latest[module] = max(latest.get(module, 0.0), max(index.times))
+        return sorted(latest, key=latest.__getitem__, reverse=True)
+
+    def _all_offsets(self) -> List[int]:
+        return sorted(offset for index in self.funcs.values() for offset in index.offsets)
+
+    def export(self, store: FuncRecordStore) -> int:
+        """Copy every record of the log, in log order, to another store.
+
+        Returns the number of records copied.
+        """
+        with self._locked(exclusive=False):
+            self._refresh()
+            offsets = self._all_offsets()
+            view = self._view() if offsets else memoryview(b"")
+        try:
+            store.add_serialized(self._read(view, offset) for offset in offsets)
+        finally:
+            view.release()
+        return len(offsets)
+
+    def compact(self) -> int:
+        """Rewrite the log keeping only the first of identical records.
+
+        Records are identical when they only differ by their creation time.
+        Returns the number of records dropped.
+        """
+        with self._locked(exclusive=True):
+            self._refresh()
+            offsets = self._all_offsets()
+            return len(offsets) - self._rewrite(offsets, distinct=True)
+
+    def vacuum(self) -> VacuumStats:
+        """Rewrite the log without the records the retention policy doesn't keep.
+
+        Records are never removed from the log as they are added, so this is
+        also where `max_records` is enforced, by keeping a random sample of the
+        records of each function. `max_bytes` applies to the log file.
+        """
+        policy = self.retention
+        with self._locked(exclusive=True):
+            self._refresh()
+            size_before = self._log_end
+            cutoff = None
+            if policy.max_age is not None:
+                cutoff = (datetime.now() - policy.max_age).timestamp()
+            kept: List[Tuple[float, int]] = []
+            total = 0
+            for index in self.funcs.values():
+                records = list(zip(index.times, index.offsets))
+                total += len(records)
+                if cutoff is not None:
+                    records = [record for record in records if record[0] >= cutoff]
+                if policy.max_records is not None and len(records) > policy.max_records:
+                    records = random.sample(records, policy.max_records)
+                kept += records
+            if policy.max_bytes is not None:
+                # Keep the newest records that fit
+                budget = policy.max_bytes - len(LOG_MAGIC)
+                view = self._view()
+                try:
+                    newest = sorted(kept, reverse=True)
+                    kept = []
+                    for timestamp, offset in newest:
+                        (length, _) = FRAME_HEADER.unpack_from(view, offset)
+                        budget -= FRAME_HEADER.size + length
+                        if budget < 0:
+                            break
+                        kept.append((timestamp, offset))
+                finally:
+                    view.release()
+            written = self._rewrite(sorted(offset for _, offset in kept), distinct=False)
+            return VacuumStats(total - written, size_before, self._log_end)
+
+    def _rewrite(self, offsets: List[int], distinct: bool) -> int:
+        """Replace the log with one holding the records at offsets, in that
+        order, and only the first of identical ones if `distinct`.
+
+        Must be called with the exclusive lock held. Other processes pick the
+        new log up on their next read or write. Returns the number of records
+        written.
+        """
+        view = self._view()
+        seen = set()
+        entries: List[IndexEntry] = []
+        log_path, index_path = f"{self.path}.compact", f"{self.index_path}.compact"
+        try:
+            with open(log_path, "wb") as log:
+                log.write(LOG_MAGIC)
+                position = len(LOG_MAGIC)
+                for offset in offsets:
+                    length, _ = FRAME_HEADER.unpack_from(view, offset)
+                    start = offset + FRAME_HEADER.size
+                    if distinct:
+                        key = hashlib.blake2b(
+                            view[start + TIMESTAMP.size : start + length], digest_size=16
+                        ).digest()
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    record = self._read(view, offset)
+                    entries.append(index_entry(record, position))
+                    position += log.write(view[offset : start + length])
+                log.flush()
+                os.fsync(log.fileno())
+            with open(index_path, "wb") as index:
+                index.write(INDEX_MAGIC)
+                index.write(frame(pickle.dumps((position, entries))))
+                index.flush()
+                os.fsync(index.fileno())
+        finally:
+            view.release()
+        # Readers find the log replaced, then reload the new index
+        os.replace(index_path, self.index_path)
+        os.replace(log_path, self.path)
+        self._open()
+        self._refresh()
+        return len(entries)
+
+    def close(self) -> None:
+        """Sync and close the log."""
+        with self._lock:
+            for f in (self._log, self._index):
+                if f is not None:
+                    os.fsync(f.fileno())
+            self._unsynced = False
+            self._close_files()
+
+    def _close_files(self) -> None:
+        for f in (self._log, self._index):
+            if f is not None:
+                f.close()
+        self._log = self._index = None
+        self._map = None
+        self._lock_file.close()
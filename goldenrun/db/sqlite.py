@@ -1,116 +1,1084 @@
-import logging
-import pickle
-import sqlite3
-from datetime import datetime
-from typing import Iterable, List, Tuple, Union
-
-from goldenrun.db.base import FuncRecordStore, FuncRecordThunk
-from goldenrun.tracing import FuncRecord
-
-logger = logging.getLogger(__name__)
-
-
-def create_func_table(conn: sqlite3.Connection) -> None:
-    query = """
-        CREATE TABLE IF NOT EXISTS goldenrun_func (
-          id          INTEGER PRIMARY KEY AUTOINCREMENT,
-          module      TEXT,
-          qualname    TEXT,
-          record      BOOL);
-        """
-
-    with conn:
-        conn.execute(query)
-
-
-def create_record_table(conn: sqlite3.Connection) -> None:
-    query = """
-        CREATE TABLE IF NOT EXISTS goldenrun_record (
-          func_id           INTEGER,
-          created_at        TEXT,
-          serialized_args   BLOB,
-          serialized_return BLOB,
-          FOREIGN KEY (func_id) REFERENCES goldenrun_func(id));
-        """
-
-    with conn:
-        conn.execute(query)
-
-
-QueryValue = Union[str, int]
-ParameterizedQuery = Tuple[str, List[QueryValue]]
-
-
-class SQLiteStore(FuncRecordStore):
-    def __init__(self, conn: sqlite3.Connection) -> None:
-        self.conn = conn
-
-    @classmethod
-    def make_store(cls, connection_string: str) -> "FuncRecordStore":
-        conn = sqlite3.connect(connection_string)
-        create_func_table(conn)
-        create_record_table(conn)
-        return cls(conn)
-
-    def _get_or_insert_func(self, module: str, qualname: str):
-        get_func_query = "SELECT id FROM goldenrun_func WHERE module=? AND qualname=?"
-        result = self.conn.execute(get_func_query, (module, qualname)).fetchone()
-
-        if result:
-            return result[0]
-        else:
-            insert_func_query = (
-                "INSERT INTO goldenrun_func (module, qualname) VALUES (?, ?)"
-            )
-            self.conn.execute(insert_func_query, (module, qualname))
-            return self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-    def add(self, traces: Iterable[FuncRecord]) -> None:
-        with self.conn as conn:
-            for trace in traces:
-                func_id = self._get_or_insert_func(trace.module, trace.qualname)
-                insert_record_query = """
-                        INSERT INTO goldenrun_record (func_id, created_at, serialized_args, serialized_return)
-                        VALUES (?, ?, ?, ?)
-                    """
-                conn.execute(
-                    insert_record_query,
-                    (
-                        func_id,
-                        datetime.now(),
-                        pickle.dumps(trace.args),
-                        pickle.dumps(trace.return_value),
-                    ),
-                )
-
-    def get_records(
-        self, func_qualname: str, limit: int = 2000
-    ) -> List[FuncRecordThunk]:
-        get_func_query = """
-            SELECT id
-            FROM goldenrun_func
-            WHERE qualname = ?
-        """
-        get_records_query = """
-            SELECT created_at, serialized_args, serialized_return
-            FROM goldenrun_record
-            WHERE func_id = ?
-        """
-        with self.conn as conn:
-            _id = conn.execute(get_func_query, (func_qualname,)).fetchone()[0]
-            return conn.execute(get_records_query, (_id,)).fetchall()
-
-    def list_modules(self) -> List[str]:
-        ...
-        # with self.conn:
-        #     cur = self.conn.cursor()
-        #     cur.execute(
-        #         """
-        #                 SELECT module FROM {table}
-        #                 GROUP BY module
-        #                 ORDER BY date(created_at) DESC
-        #                 """.format(
-        #             table=self.table
-        #         )
-        #     )
-        #     return [row[0] for row in cur.fetchall() if row[0]]
+import glob
+import hashlib
+import itertools
+import logging
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime
+from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Tuple, Union)
+from urllib.request import pathname2url
+
+from goldenrun.db.base import (NO_RETENTION, FuncRecordStore, FuncRecordThunk,
+                               RetentionPolicy, SerializedFuncRecord,
+                               SerializedFuncRecordThunk, VacuumStats)
+from goldenrun.serialization import Codec, PickleCodec
+from goldenrun.stats import get_stats
+from goldenrun.tracing import FuncRecord
+
+logger = logging.getLogger(__name__)
+
+
+def create_func_table(conn: sqlite3.Connection) -> None:
+    query = """
+        CREATE TABLE IF NOT EXISTS goldenrun_func (
+          id          INTEGER PRIMARY KEY AUTOINCREMENT,
+          module      TEXT,
+          qualname    TEXT,
+          record      BOOL,
+          seen        INTEGER NOT NULL DEFAULT 0,
+          fingerprint BLOB);
+        """
+    unique_index_query = """
+        CREATE UNIQUE INDEX IF NOT EXISTS goldenrun_func_module_qualname
+        ON goldenrun_func (module, qualname);
+        """
+    qualname_index_query = """
+        CREATE INDEX IF NOT EXISTS goldenrun_func_qualname
+        ON goldenrun_func (qualname);
+        """
+
+    with conn:
+        conn.execute(query)
+        # Number of calls recorded, kept or not, for reservoir sampling, and
+        # fingerprint of the code last recorded, for incremental replay
+        add_missing_columns(
+            conn,
+            "goldenrun_func",
+            {"seen": "INTEGER NOT NULL DEFAULT 0", "fingerprint": "BLOB"},
+        )
+        try:
+            conn.execute(unique_index_query)
+        except sqlite3.IntegrityError:
+            # Databases written before the index existed may contain duplicates
+            merge_duplicate_funcs(conn)
+            conn.execute(unique_index_query)
+        conn.execute(qualname_index_query)
+
+
+def merge_duplicate_funcs(conn: sqlite3.Connection) -> None:
+    """Point records of duplicated functions to the oldest row and drop the rest."""
+    conn.execute(
+        """
+        UPDATE goldenrun_record
+        SET func_id = (
+            SELECT MIN(dup.id)
+            FROM goldenrun_func AS func
+            JOIN goldenrun_func AS dup
+              ON dup.module = func.module AND dup.qualname = func.qualname
+            WHERE func.id = goldenrun_record.func_id)
+        """
+    )
+    conn.execute(
+        """
+        DELETE FROM goldenrun_func
+        WHERE id NOT IN (SELECT MIN(id) FROM goldenrun_func GROUP BY module, qualname)
+        """
+    )
+
+
+def create_record_table(conn: sqlite3.Connection) -> None:
+    query = """
+        CREATE TABLE IF NOT EXISTS goldenrun_record (
+          func_id           INTEGER,
+          created_at        TEXT,
+          created_ts        INTEGER,
+          serialized_args   BLOB,
+          serialized_return BLOB,
+          args_hash         BLOB,
+          return_hash       BLOB,
+          occurrences       INTEGER NOT NULL DEFAULT 1,
+          codec             TEXT,
+          serialized_yields BLOB,
+          yields_hash       BLOB,
+          yield_count       INTEGER NOT NULL DEFAULT 0,
+          exception_type    TEXT,
+          exception_message TEXT,
+          serialized_children BLOB,
+          children_hash     BLOB,
+          FOREIGN KEY (func_id) REFERENCES goldenrun_func(id));
+        """
+    # Rows of a function in insertion order, for streaming reads
+    func_index_query = """
+        CREATE INDEX IF NOT EXISTS goldenrun_record_func_id
+        ON goldenrun_record (func_id);
+        """
+    # Lookups by arguments, for deduplication
+    func_args_index_query = """
+        CREATE INDEX IF NOT EXISTS goldenrun_record_func_args
+        ON goldenrun_record (func_id, args_hash);
+        """
+    # Time range queries and deletes
+    created_index_query = """
+        CREATE INDEX IF NOT EXISTS goldenrun_record_created_ts
+        ON goldenrun_record (created_ts);
+        """
+
+    with conn:
+        conn.execute(query)
+        add_missing_columns(
+            conn,
+            "goldenrun_record",
+            {
+                "args_hash": "BLOB",
+                "return_hash": "BLOB",
+                "occurrences": "INTEGER NOT NULL DEFAULT 1",
+                "codec": "TEXT",
+                "serialized_yields": "BLOB",
+                "yields_hash": "BLOB",
+                "yield_count": "INTEGER NOT NULL DEFAULT 0",
+                "exception_type": "TEXT",
+                "exception_message": "TEXT",
+                "serialized_children": "BLOB",
+                "children_hash": "BLOB",
+                "created_ts": "INTEGER",
+            },
+        )
+        conn.execute(func_index_query)
+        conn.execute(func_args_index_query)
+        conn.execute(created_index_query)
+        migrate_created_at(conn)
+
+
+def to_timestamp(value: datetime) -> int:
+    """Microseconds since the epoch, the form creation times are stored in."""
+    return round(value.timestamp() * 1_000_000)
+
+
+def from_timestamp(value: int) -> datetime:
+    return datetime.fromtimestamp(value // 1_000_000).replace(microsecond=value % 1_000_000)
+
+
+def migrate_created_at(conn: sqlite3.Connection) -> None:
+    """Fill `created_ts` in for records written when creation times were only
+    stored as text, in `created_at`."""
+    rows = conn.execute(
+        """
+        SELECT rowid, created_at FROM goldenrun_record
+        WHERE created_ts IS NULL AND created_at IS NOT NULL
+        """
+    ).fetchall()
+    conn.executemany(
+        "UPDATE goldenrun_record SET created_ts = ? WHERE rowid = ?",
+        [(to_timestamp(datetime.fromisoformat(text)), rowid) for rowid, text in rows],
+    )
+
+
+def create_blob_table(conn: sqlite3.Connection) -> None:
+    query = """
+        CREATE TABLE IF NOT EXISTS goldenrun_blob (
+          hash  BLOB PRIMARY KEY,
+          data  BLOB);
+        """
+
+    with conn:
+        conn.execute(query)
+
+
+# Columns of goldenrun_record, in the order used by inserts
+RECORD_COLUMNS = (
+    "func_id",
+    "created_ts",
+    "serialized_args",
+    "serialized_return",
+    "args_hash",
+    "return_hash",
+    "codec",
+    "serialized_yields",
+    "yields_hash",
+    "yield_count",
+    "exception_type",
+    "exception_message",
+    "serialized_children",
+    "children_hash",
+    "occurrences",
+)
+# Columns that identify a distinct record, for deduplication
+DEDUPE_COLUMNS = (
+    "func_id",
+    "args_hash",
+    "return_hash",
+    "yields_hash",
+    "yield_count",
+    "exception_type",
+    "exception_message",
+    "children_hash",
+)
+
+INSERT_RECORD_QUERY = f"""
+    INSERT INTO goldenrun_record ({", ".join(RECORD_COLUMNS)})
+    VALUES ({", ".join("?" * len(RECORD_COLUMNS))})
+"""
+
+
+def add_missing_columns(
+    conn: sqlite3.Connection, table: str, columns: Dict[str, str]
+) -> None:
+    """Add the columns a table created by an older version doesn't have yet."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, declaration in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+
+def hash_blob(data: bytes) -> bytes:
+    """Content address of a serialized value."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+JOURNAL_MODES = {"delete", "truncate", "persist", "memory", "wal", "off"}
+SYNCHRONOUS_LEVELS = {"off", "normal", "full", "extra"}
+
+
+class SQLiteProfile(NamedTuple):
+    """Connection settings applied to every SQLiteStore connection.
+
+    The defaults use WAL journaling so that recording processes and replay
+    runs sharing one database do not block each other. `cache_size` follows
+    the SQLite convention: a negative value is a size in KiB, a positive one a
+    number of pages. `busy_timeout` is in seconds.
+    """
+
+    journal_mode: str = "wal"
+    synchronous: str = "normal"
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size: int = -64 * 1024
+    busy_timeout: float = 30.0
+    # Serve reads from a separate read-only connection
+    read_only_readers: bool = True
+
+
+DEFAULT_PROFILE = SQLiteProfile()
+
+
+def apply_profile(conn: sqlite3.Connection, profile: SQLiteProfile) -> None:
+    journal_mode = profile.journal_mode.lower()
+    synchronous = profile.synchronous.lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"Unknown SQLite journal mode: {profile.journal_mode}")
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f"Unknown SQLite synchronous level: {profile.synchronous}")
+    conn.execute(f"PRAGMA busy_timeout = {int(profile.busy_timeout * 1000)}")
+    conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+    conn.execute(f"PRAGMA synchronous = {synchronous}")
+    conn.execute(f"PRAGMA mmap_size = {int(profile.mmap_size)}")
+    conn.execute(f"PRAGMA cache_size = {int(profile.cache_size)}")
+
+
+# How SQLiteStore handles calls with the same arguments and return value
+DEDUPE_DISTINCT = "distinct"  # keep the first record only
+DEDUPE_COUNT = "count"  # keep the first record and count occurrences
+DEDUPE_MODES = {DEDUPE_DISTINCT, DEDUPE_COUNT}
+
+# Encodes the references to the children of a record
+CHILDREN_CODEC = PickleCodec()
+# Reference to a serialized value: its hash, and the value itself if inlined
+BlobRef = Tuple[bytes, Optional[bytes]]
+
+QueryValue = Union[str, int]
+ParameterizedQuery = Tuple[str, List[QueryValue]]
+
+
+class SQLiteStore(FuncRecordStore):
+    """Stores call traces in a SQLite database.
+
+    Serialized values are content addressed: values larger than
+    INLINE_BLOB_SIZE are kept once in `goldenrun_blob` and records reference
+    them by hash. With `dedupe` set to DEDUPE_DISTINCT or DEDUPE_COUNT only one
+    record is kept per distinct (function, arguments, return value), the latter
+    also counting how many calls it stands for in `occurrences`.
+
+    The `max_records` limit of the `retention` policy is applied as records
+    are added, its other limits by `vacuum`.
+    """
+
+    # Number of records inserted per executemany call
+    BATCH_SIZE = 1000
+    # Number of rows fetched at a time by get_records
+    FETCH_SIZE = 500
+    # Values up to this size are cheaper to store inline than by reference
+    INLINE_BLOB_SIZE = 32
+    # Number of records deleted per transaction by vacuum, so that recorders
+    # aren't kept waiting
+    VACUUM_BATCH_SIZE = 1000
+
+    def __init__(
+        self,
+        conn: sqlite3.Connection,
+        path: Optional[str] = None,
+        profile: SQLiteProfile = DEFAULT_PROFILE,
+        dedupe: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        retention: RetentionPolicy = NO_RETENTION,
+    ) -> None:
+        if dedupe is not None and dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Unknown dedupe mode: {dedupe}")
+        self.conn = conn
+        self.path = path
+        self.profile = profile
+        self.dedupe = dedupe
+        if codec is not None:
+            self.codec = codec
+        self.retention = retention
+        self.stats = get_stats()
+        self.func_ids: Dict[Tuple[str, str], int] = {}
+        # Fingerprints written to goldenrun_func by this store, by function id
+        self.fingerprints: Dict[int, bytes] = {}
+        self._read_conn: Optional[sqlite3.Connection] = None
+
+    @classmethod
+    def make_store(
+        cls,
+        connection_string: str,
+        profile: Optional[SQLiteProfile] = None,
+        dedupe: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> "FuncRecordStore":
+        if profile is None:
+            profile = DEFAULT_PROFILE
+        # The connection may be handed over to a background writer thread
+        conn = sqlite3.connect(
+            connection_string,
+            timeout=profile.busy_timeout,
+            check_same_thread=False,
+        )
+        apply_profile(conn, profile)
+        create_func_table(conn)
+        create_record_table(conn)
+        create_blob_table(conn)
+        return cls(
+            conn, connection_string, profile, dedupe, codec, retention or NO_RETENTION
+        )
+
+    @property
+    def read_conn(self) -> sqlite3.Connection:
+        """Connection used by queries that don't write to the database.
+
+        A separate read-only connection lets replay read a WAL database while
+        recorders are writing to it. In-memory databases can't be shared, so they
+        are read through the main connection.
+        """
+        if (
+            not self.profile.read_only_readers
+            or self.path is None
+            or self.path == ":memory:"
+            or self.path.startswith("file:")
+        ):
+            return self.conn
+        if self._read_conn is None:
+            uri = f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro"
+            self._read_conn = sqlite3.connect(
+                uri, uri=True, timeout=self.profile.busy_timeout
+            )
+            self._read_conn.execute(f"PRAGMA mmap_size = {int(self.profile.mmap_size)}")
+            self._read_conn.execute(f"PRAGMA cache_size = {int(self.profile.cache_size)}")
+        return self._read_conn
+
+    def _resolve_func_ids(self, keys: Iterable[Tuple[str, str]]) -> None:
+        """Make sure `func_ids` has an entry for every (module, qualname) in keys."""
+        missing = {key for key in keys if key not in self.func_ids}
+        if not missing:
+            return
+        insert_func_query = """
+            INSERT INTO goldenrun_func (module, qualname) VALUES (?, ?)
+            ON CONFLICT (module, qualname) DO NOTHING
+        """
+        get_func_query = "SELECT id FROM goldenrun_func WHERE module=? AND qualname=?"
+        self.conn.executemany(insert_func_query, missing)
+        for key in missing:
+            self.func_ids[key] = self.conn.execute(get_func_query, key).fetchone()[0]
+
+    def add(self, traces: Iterable[FuncRecord]) -> None:
+        self.add_serialized(self.serialize_all(traces))
+
+    def _blob_ref(
+        self, data: bytes, blobs: Dict[bytes, bytes]
+    ) -> Tuple[bytes, Optional[bytes]]:
+        """Return the hash of data and, if it is small enough, the data to inline.
+
+        Larger values are added to blobs to be stored in the blob table.
+        """
+        digest = hash_blob(data)
+        if len(data) <= self.INLINE_BLOB_SIZE:
+            return digest, data
+        blobs[digest] = data
+        return digest, None
+
+    def _children_ref(
+        self, record: SerializedFuncRecord, blobs: Dict[bytes, bytes]
+    ) -> Tuple[Optional[bytes], Optional[bytes]]:
+        """Return the hash of the encoded children of record and, if small enough,
+        the encoded children to inline.
+
+        Children are encoded as references to their values, which are stored in
+        the blob table like those of records.
+        """
+        if not record.children:
+            return None, None
+        refs = [
+            (
+                child.module,
+                child.qualname,
+                child.codec,
+                self._blob_ref(child.serialized_args, blobs),
+                self._blob_ref(child.serialized_return, blobs),
+                None
+                if child.serialized_yields is None
+                else self._blob_ref(child.serialized_yields, blobs),
+                child.yield_count,
+                child.exception_type,
+                child.exception_message,
+            )
+            for child in record.children
+        ]
+        return self._blob_ref(CHILDREN_CODEC.encode(refs), blobs)
+
+    def _load_children(
+        self, rows: List[Tuple[datetime, Optional[bytes]]]
+    ) -> List[Tuple[SerializedFuncRecord, ...]]:
+        """Decode the children of a batch of records, given their creation time and
+        encoded children, fetching the values they reference in one query."""
+        refs = [[] if data is None else CHILDREN_CODEC.decode(data) for _, data in rows]
+        missing = list(
+            {
+                ref[0]
+                for children in refs
+                for child in children
+                for ref in child[3:6]
+                if ref is not None and ref[1] is None
+            }
+        )
+        blobs: Dict[bytes, bytes] = {}
+        # Stay well below SQLite's limit on the number of parameters
+        for start in range(0, len(missing), self.FETCH_SIZE):
+            chunk = missing[start : start + self.FETCH_SIZE]
+            blobs.update(
+                self.read_conn.execute(
+                    f"SELECT hash, data FROM goldenrun_blob "
+                    f"WHERE hash IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+
+        def value(ref: Optional[BlobRef]) -> Optional[bytes]:
+            if ref is None:
+                return None
+            digest, data = ref
+            return blobs[digest] if data is None else data
+
+        return [
+            tuple(
+                SerializedFuncRecord(
+                    module,
+                    qualname,
+                    created_at,
+                    value(args),  # type: ignore[arg-type]
+                    value(return_value),  # type: ignore[arg-type]
+                    codec,
+                    value(yields),
+                    yield_count,
+                    exception_type,
+                    exception_message,
+                )
+                for (
+                    module,
+                    qualname,
+                    codec,
+                    args,
+                    return_value,
+                    yields,
+                    yield_count,
+                    exception_type,
+                    exception_message,
+                ) in children
+            )
+            for (created_at, _), children in zip(rows, refs)
+        ]
+
+    def _insert_deduped(self, conn: sqlite3.Connection, rows: List[Tuple[Any, ...]]) -> None:
+        # Also distinguishes generator and exception outcomes of the same call
+        same_record = """
+            func_id = ? AND args_hash = ? AND return_hash = ? AND yields_hash IS ?
+            AND yield_count = ? AND exception_type IS ? AND exception_message IS ?
+            AND children_hash IS ?
+        """
+        find_record_query = f"SELECT 1 FROM goldenrun_record WHERE {same_record} LIMIT 1"
+        count_record_query = f"""
+            UPDATE goldenrun_record SET occurrences = occurrences + ?
+            WHERE {same_record}
+        """
+        distinct: Dict[Tuple[Any, ...], List[Any]] = {}
+        for row in rows:
+            key = (row[0], row[4], row[5], *row[8:12], row[13])
+            distinct.setdefault(key, [row, 0])[1] += 1
+        for key, (row, count) in distinct.items():
+            if self.dedupe == DEDUPE_COUNT:
+                if conn.execute(count_record_query, (count, *key)).rowcount:
+                    continue
+            elif conn.execute(find_record_query, key).fetchone():
+                continue
+            conn.execute(
+                INSERT_RECORD_QUERY,
+                (*row[:-1], count if self.dedupe == DEDUPE_COUNT else 1),
+            )
+
+    def _sample(
+        self, conn: sqlite3.Connection, rows: List[Tuple[Any, ...]], max_records: int
+    ) -> List[Tuple[Any, ...]]:
+        """Return the rows to insert so that at most `max_records` are kept per
+        function, each call having the same chance of being kept.
+
+        Implements reservoir sampling: a function's `seen` call is kept with a
+        probability of `max_records / seen`, in place of a random one of those
+        already kept.
+        """
+        reservoirs: Dict[int, List[Any]] = {}
+        for func_id in {row[0] for row in rows}:
+            (seen,) = conn.execute(
+                "SELECT seen FROM goldenrun_func WHERE id = ?", (func_id,)
+            ).fetchone()
+            (stored,) = conn.execute(
+                "SELECT COUNT(*) FROM goldenrun_record WHERE func_id = ?", (func_id,)
+            ).fetchone()
+            # calls seen, records stored, records to evict, rows to insert
+            reservoirs[func_id] = [seen, stored, 0, []]
+        for position, row in enumerate(rows):
+            reservoir = reservoirs[row[0]]
+            reservoir[0] += 1
+            seen, stored, _, pending = reservoir
+            if stored + len(pending) < max_records:
+                pending.append((position, row))
+                continue
+            slot = random.randrange(seen)
+            if slot >= max_records:
+                continue
+            if slot < len(pending):
+                pending[slot] = (position, row)
+            else:
+                reservoir[1] -= 1
+                reservoir[2] += 1
+                pending.append((position, row))
+        kept = []
+        for func_id, (seen, _, evicted, pending) in reservoirs.items():
+            conn.execute("UPDATE goldenrun_func SET seen = ? WHERE id = ?", (seen, func_id))
+            if evicted:
+                conn.execute(
+                    """
+                    DELETE FROM goldenrun_record WHERE rowid IN (
+                        SELECT rowid FROM goldenrun_record WHERE func_id = ?
+                        ORDER BY random() LIMIT ?)
+                    """,
+                    (func_id, evicted),
+                )
+            kept += pending
+        return [row for _, row in sorted(kept, key=lambda item: item[0])]
+
+    def add_serialized(self, records: Iterable[SerializedFuncRecord]) -> None:
+        insert_blob_query = """
+            INSERT INTO goldenrun_blob (hash, data) VALUES (?, ?)
+            ON CONFLICT (hash) DO NOTHING
+        """
+        records = iter(records)
+        start = time.perf_counter_ns() if self.stats is not None else 0
+        stored = 0
+        try:
+            with self.conn as conn:
+                while True:
+                    batch = list(itertools.islice(records, self.BATCH_SIZE))
+                    if not batch:
+                        break
+                    stored += len(batch)
+                    self._resolve_func_ids((r.module, r.qualname) for r in batch)
+                    self._update_fingerprints(conn, batch)
+                    blobs: Dict[bytes, bytes] = {}
+                    rows = []
+                    for r in batch:
+                        args_hash, args = self._blob_ref(r.serialized_args, blobs)
+                        return_hash, return_value = self._blob_ref(
+                            r.serialized_return, blobs
+                        )
+                        yields_hash, yields = (
+                            (None, None)
+                            if r.serialized_yields is None
+                            else self._blob_ref(r.serialized_yields, blobs)
+                        )
+                        children_hash, children = self._children_ref(r, blobs)
+                        rows.append(
+                            (
+                                self.func_ids[(r.module, r.qualname)],
+                                to_timestamp(r.created_at),
+                                args,
+                                return_value,
+                                args_hash,
+                                return_hash,
+                                r.codec,
+                                yields,
+                                yields_hash,
+                                r.yield_count,
+                                r.exception_type,
+                                r.exception_message,
+                                children,
+                                children_hash,
+                                1,
+                            )
+                        )
+                    if self.retention.max_records is not None:
+                        rows = self._sample(conn, rows, self.retention.max_records)
+                    conn.executemany(insert_blob_query, blobs.items())
+                    if self.dedupe is None:
+                        conn.executemany(INSERT_RECORD_QUERY, rows)
+                    else:
+                        self._insert_deduped(conn, rows)
+        except Exception:
+            # Functions inserted by the rolled back transaction no longer exist
+            self.func_ids.clear()
+            self.fingerprints.clear()
+            raise
+        if self.stats is not None and stored:
+            self.stats.records_stored += stored
+            self.stats.store_batches += 1
+            self.stats.store_ns += time.perf_counter_ns() - start
+
+    def _update_fingerprints(
+        self, conn: sqlite3.Connection, records: List[SerializedFuncRecord]
+    ) -> None:
+        changed = {}
+        for r in records:
+            func_id = self.func_ids[(r.module, r.qualname)]
+            if r.fingerprint is not None and self.fingerprints.get(func_id) != r.fingerprint:
+                changed[func_id] = self.fingerprints[func_id] = r.fingerprint
+        conn.executemany(
+            "UPDATE goldenrun_func SET fingerprint = ? WHERE id = ?",
+            [(fingerprint, func_id) for func_id, fingerprint in changed.items()],
+        )
+
+    def get_fingerprint(self, module: str, qualname: str) -> Optional[bytes]:
+        row = self.conn.execute(
+            "SELECT fingerprint FROM goldenrun_func WHERE module = ? AND qualname = ?",
+            (module, qualname),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def merge_shard(self, path: str) -> int:
+        """Copy the records of the SQLite database at path into this store.
+
+        The shard is attached to the store's connection and copied with
+        INSERT ... SELECT, remapping its function ids to those of the store. Its
+        records are deduplicated against the store according to `dedupe`.
+        Returns the number of records read from the shard.
+        """
+        # The view keeps the shard's insertion order in `shard_rowid`
+        shard_view_query = f"""
+            CREATE TEMP VIEW goldenrun_shard_record AS
+            SELECT f.id AS func_id,
+                   {", ".join(f"r.{c}" for c in RECORD_COLUMNS[1:])},
+                   r.rowid AS shard_rowid
+            FROM goldenrun_shard.goldenrun_record AS r
+            JOIN goldenrun_shard.goldenrun_func AS sf ON sf.id = r.func_id
+            JOIN main.goldenrun_func AS f
+              ON f.module = sf.module AND f.qualname = sf.qualname
+        """
+        insert_funcs_query = """
+            INSERT INTO main.goldenrun_func (module, qualname, record, fingerprint)
+            SELECT module, qualname, record, fingerprint
+            FROM goldenrun_shard.goldenrun_func
+            WHERE true ORDER BY id
+            ON CONFLICT (module, qualname) DO UPDATE
+            SET fingerprint = COALESCE(excluded.fingerprint, fingerprint)
+        """
+        insert_blobs_query = """
+            INSERT INTO main.goldenrun_blob (hash, data)
+            SELECT hash, data FROM goldenrun_shard.goldenrun_blob
+            WHERE true
+            ON CONFLICT (hash) DO NOTHING
+        """
+        columns = ", ".join(RECORD_COLUMNS)
+        same_record = " AND ".join(f"r.{c} IS s.{c}" for c in DEDUPE_COLUMNS)
+        key = ", ".join(DEDUPE_COLUMNS)
+        if self.dedupe is None:
+            insert_records_query = f"""
+                INSERT INTO main.goldenrun_record ({columns})
+                SELECT {columns} FROM goldenrun_shard_record ORDER BY shard_rowid
+            """
+        else:
+            # One row per distinct record, taken from its first occurrence
+            occurrences = "SUM(occurrences)" if self.dedupe == DEDUPE_COUNT else "1"
+            insert_records_query = f"""
+                INSERT INTO main.goldenrun_record ({columns})
+                SELECT {", ".join(RECORD_COLUMNS[:-1])}, total
+                FROM (
+                    SELECT *, MIN(shard_rowid) AS first_rowid, {occurrences} AS total
+                    FROM goldenrun_shard_record AS s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM main.goldenrun_record AS r WHERE {same_record})
+                    GROUP BY {key})
+                ORDER BY first_rowid
+            """
+        count_records_query = f"""
+            UPDATE main.goldenrun_record AS r
+            SET occurrences = r.occurrences + s.total
+            FROM (
+                SELECT {key}, SUM(occurrences) AS total
+                FROM goldenrun_shard_record GROUP BY {key}) AS s
+            WHERE {same_record}
+        """
+
+        self.conn.execute("ATTACH DATABASE ? AS goldenrun_shard", (path,))
+        try:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM goldenrun_shard.goldenrun_record"
+            ).fetchone()
+            self.conn.execute(shard_view_query)
+            try:
+                with self.conn as conn:
+                    conn.execute(insert_funcs_query)
+                    conn.execute(insert_blobs_query)
+                    if self.dedupe == DEDUPE_COUNT:
+                        conn.execute(count_records_query)
+                    conn.execute(insert_records_query)
+            finally:
+                self.conn.execute("DROP VIEW temp.goldenrun_shard_record")
+        finally:
+            self.conn.execute("DETACH DATABASE goldenrun_shard")
+        return count  # type: ignore[no-any-return]
+
+    def vacuum(self) -> VacuumStats:
+        """Delete the records the retention policy doesn't keep, then the values
+        no record references anymore, and VACUUM the database.
+
+        Records are deleted in batches of VACUUM_BATCH_SIZE, each in a
+        transaction of its own, so that recorders can write in between.
+        """
+        size_before = self._size()
+        policy = self.retention
+        deleted = 0
+        if policy.max_age is not None:
+            deleted += self._delete_records(
+                "SELECT rowid FROM goldenrun_record WHERE created_ts < ?",
+                [to_timestamp(datetime.now() - policy.max_age)],
+            )
+        if policy.max_records is not None:
+            over = self.conn.execute(
+                """
+                SELECT func_id, COUNT(*) FROM goldenrun_record
+                GROUP BY func_id HAVING COUNT(*) > ?
+                """,
+                (policy.max_records,),
+            ).fetchall()
+            for func_id, count in over:
+                # A uniform sample of a uniform sample is still one
+                deleted += self._delete_records(
+                    """
+                    SELECT rowid FROM goldenrun_record WHERE func_id = ?
+                    ORDER BY random()
+                    """,
+                    [func_id],
+                    count - policy.max_records,
+                )
+        self._delete_unreferenced_blobs()
+        if policy.max_bytes is not None:
+            while True:
+                used = self._size()
+                (count,) = self.conn.execute(
+                    "SELECT COUNT(*) FROM goldenrun_record"
+                ).fetchone()
+                if used <= policy.max_bytes or not count:
+                    break
+                # Assume records take the same room on average
+                excess = -(-count * (used - policy.max_bytes) // used)
+                deleted += self._delete_records(
+                    "SELECT rowid FROM goldenrun_record ORDER BY created_ts, rowid",
+                    [],
+                    excess,
+                )
+                self._delete_unreferenced_blobs()
+        self.conn.execute("VACUUM")
+        return VacuumStats(deleted, size_before, self._size())
+
+    def _size(self) -> int:
+        """Number of bytes used by the database, not counting free pages."""
+        pages = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return (pages - free_pages) * page_size  # type: ignore[no-any-return]
+
+    def _delete_records(
+        self, select_query: str, params: List[QueryValue], count: Optional[int] = None
+    ) -> int:
+        """Delete the records whose rowid `select_query` returns, at most count,
+        in batches of VACUUM_BATCH_SIZE. Returns the number of records deleted."""
+        deleted = 0
+        while count is None or deleted < count:
+            size = self.VACUUM_BATCH_SIZE
+            if count is not None:
+                size = min(size, count - deleted)
+            with self.conn as conn:
+                batch = conn.execute(
+                    f"DELETE FROM goldenrun_record WHERE rowid IN ({select_query} LIMIT ?)",
+                    [*params, size],
+                ).rowcount
+            deleted += batch
+            if batch < size:
+                break
+        return deleted
+
+    def _delete_unreferenced_blobs(self) -> int:
+        """Delete the stored values no record or child of a record references.
+
+        Holds the write lock from marking the values in use to deleting the
+        others, so values being recorded in the meantime are never deleted.
+        """
+        self.conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS goldenrun_live_blob (hash BLOB PRIMARY KEY)"
+        )
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.conn as conn:
+            conn.execute("DELETE FROM temp.goldenrun_live_blob")
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO temp.goldenrun_live_blob
+                SELECT args_hash FROM goldenrun_record WHERE serialized_args IS NULL
+                UNION SELECT return_hash FROM goldenrun_record
+                  WHERE serialized_return IS NULL
+                UNION SELECT yields_hash FROM goldenrun_record
+                  WHERE yields_hash IS NOT NULL AND serialized_yields IS NULL
+                UNION SELECT children_hash FROM goldenrun_record
+                  WHERE children_hash IS NOT NULL AND serialized_children IS NULL
+                """
+            )
+            cursor = conn.execute(
+                """
+                SELECT COALESCE(r.serialized_children, c.data)
+                FROM goldenrun_record AS r
+                LEFT JOIN goldenrun_blob AS c ON c.hash = r.children_hash
+                WHERE r.children_hash IS NOT NULL
+                """
+            )
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                conn.executemany(
+                    "INSERT OR IGNORE INTO temp.goldenrun_live_blob VALUES (?)",
+                    {
+                        (ref[0],)
+                        for (data,) in rows
+                        for child in CHILDREN_CODEC.decode(data)
+                        for ref in child[3:6]
+                        if ref is not None and ref[1] is None
+                    },
+                )
+            return conn.execute(  # type: ignore[no-any-return]
+                """
+                DELETE FROM goldenrun_blob
+                WHERE hash NOT IN (SELECT hash FROM temp.goldenrun_live_blob)
+                """
+            ).rowcount
+
+    def get_records(
+        self,
+        func_qualname: str,
+        limit: Optional[int] = 2000,
+        offset: int = 0,
+        module: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[FuncRecordThunk]:
+        conditions = ["f.qualname = ?"]
+        params: List[Any] = [func_qualname]
+        if module is not None:
+            conditions.append("f.module = ?")
+            params.append(module)
+        if since is not None:
+            conditions.append("r.created_ts >= ?")
+            params.append(to_timestamp(since))
+        if until is not None:
+            conditions.append("r.created_ts < ?")
+            params.append(to_timestamp(until))
+        params += [-1 if limit is None else limit, offset]
+        get_records_query = f"""
+            SELECT f.module,
+                   f.qualname,
+                   r.created_ts,
+                   COALESCE(r.serialized_args, a.data),
+                   COALESCE(r.serialized_return, rv.data),
+                   r.codec,
+                   COALESCE(r.serialized_yields, y.data),
+                   r.yield_count,
+                   r.exception_type,
+                   r.exception_message,
+                   COALESCE(r.serialized_children, c.data)
+            FROM goldenrun_func AS f
+            JOIN goldenrun_record AS r ON r.func_id = f.id
+            LEFT JOIN goldenrun_blob AS a ON a.hash = r.args_hash
+            LEFT JOIN goldenrun_blob AS rv ON rv.hash = r.return_hash
+            LEFT JOIN goldenrun_blob AS y ON y.hash = r.yields_hash
+            LEFT JOIN goldenrun_blob AS c ON c.hash = r.children_hash
+            WHERE {" AND ".join(conditions)}
+            ORDER BY f.id, r.rowid
+            LIMIT ? OFFSET ?
+        """
+        cursor = self.read_conn.execute(get_records_query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                created = [from_timestamp(row[2]) for row in rows]
+                children = self._load_children(
+                    [(created_at, row[-1]) for created_at, row in zip(created, rows)]
+                )
+                for row, created_at, row_children in zip(rows, created, children):
+                    module, qualname, _, *values, _ = row
+                    yield SerializedFuncRecordThunk(
+                        SerializedFuncRecord(
+                            module,
+                            qualname,
+                            created_at,
+                            *values,
+                            children=row_children,
+                        )
+                    )
+        finally:
+            cursor.close()
+
+    def list_modules(self) -> List[str]:
+        """Modules with records, most recently recorded first."""
+        rows = self.conn.execute(
+            """
+            SELECT func.module FROM goldenrun_func AS func
+            JOIN goldenrun_record AS record ON record.func_id = func.id
+            GROUP BY func.module
+            ORDER BY MAX(record.created_ts) DESC
+            """
+        )
+        return [row[0] for row in rows if row[0]]
+
+
+def shard_path(path: str, pid: int) -> str:
+    """Path of the shard written by process `pid` for the database at path."""
+    return f"{path}.{pid}.shard"
+
+
+def find_shards(path: str) -> List[str]:
+    """Paths of the shards written for the database at path."""
+    return sorted(glob.glob(f"{glob.escape(path)}.*.shard"))
+
+
+def remove_database(path: str) -> None:
+    """Delete a SQLite database file along with its journal files."""
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class ShardedSQLiteStore(FuncRecordStore):
+    """Stores call traces in one SQLite database per process.
+
+    Each process writes to its own shard next to `path`, named after its PID
+    (see `shard_path`), so recording processes never wait on each other's
+    locks. A shard is opened on first write, and again in processes forked
+    after that. Traces are read from the database at `path` once the shards
+    have been merged into it, see `SQLiteStore.merge_shard` and `goldenrun merge`.
+
+    Shards sample calls on their own, so the merged database may hold more
+    than `max_records` per function until vacuumed.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        profile: SQLiteProfile = DEFAULT_PROFILE,
+        dedupe: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        retention: RetentionPolicy = NO_RETENTION,
+    ) -> None:
+        if dedupe is not None and dedupe not in DEDUPE_MODES:
+            raise ValueError(f"Unknown dedupe mode: {dedupe}")
+        self.path = path
+        self.profile = profile
+        self.dedupe = dedupe
+        if codec is not None:
+            self.codec = codec
+        self.retention = retention
+        self.stats = get_stats()
+        self._pid: Optional[int] = None
+        self._shard: Optional[SQLiteStore] = None
+        self._merged: Optional[SQLiteStore] = None
+        # Connections opened before a fork belong to the parent process: they
+        # are kept open, as closing them could disturb the parent's database
+        self._inherited: List[SQLiteStore] = []
+
+    @classmethod
+    def make_store(
+        cls,
+        connection_string: str,
+        profile: Optional[SQLiteProfile] = None,
+        dedupe: Optional[str] = None,
+        codec: Optional[Codec] = None,
+        retention: Optional[RetentionPolicy] = None,
+    ) -> "FuncRecordStore":
+        return cls(
+            connection_string,
+            profile or DEFAULT_PROFILE,
+            dedupe,
+            codec,
+            retention or NO_RETENTION,
+        )
+
+    @property
+    def shard(self) -> SQLiteStore:
+        """The store of the shard written by the current process."""
+        pid = os.getpid()
+        if self._shard is None or self._pid != pid:
+            if self._shard is not None:
+                self._inherited.append(self._shard)
+            self._shard = SQLiteStore.make_store(  # type: ignore[assignment]
+                shard_path(self.path, pid),
+                self.profile,
+                self.dedupe,
+                self.codec,
+                self.retention,
+            )
+            self._pid = pid
+        return self._shard  # type: ignore[return-value]
+
+    @property
+    def merged(self) -> SQLiteStore:
+        """The store the shards are merged into."""
+        if self._merged is None:
+            self._merged = SQLiteStore.make_store(  # type: ignore[assignment]
+                self.path, self.profile, self.dedupe, self.codec, self.retention
+            )
+        return self._merged  # type: ignore[return-value]
+
+    def add(self, traces: Iterable[FuncRecord]) -> None:
+        self.shard.add(traces)
+
+    def add_serialized(self, records: Iterable[SerializedFuncRecord]) -> None:
+        self.shard.add_serialized(records)
+
+    def get_records(
+        self,
+        func_qualname: str,
+        limit: Optional[int] = 2000,
+        offset: int = 0,
+        module: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> Iterator[FuncRecordThunk]:
+        return self.merged.get_records(func_qualname, limit, offset, module, since, until)
+
+    def get_fingerprint(self, module: str, qualname: str) -> Optional[bytes]:
+        return self.merged.get_fingerprint(module, qualname)
+
+    def vacuum(self) -> VacuumStats:
+        return self.merged.vacuum()
+
+    def list_modules(self) -> List[str]:
+        return self.merged.list_modules()
@@ -0,0 +1,194 @@
+import hashlib
+import inspect
+import sys
+import weakref
+from types import CodeType, FunctionType, ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+# Same as goldenrun.tracing.CodeFilter, which imports this module
+CodeFilter = Callable[[CodeType], bool]
+
+# Values hashed by value when they are default arguments or globals, other
+# objects are left out since their repr may hold an address
+LITERAL_TYPES = (type(None), bool, int, float, complex, str, bytes)
+
+# Digests of code objects, see `_hash_code`. Equal code objects share an entry,
+# so the defaults and globals of functions are hashed separately
+_code_digests: "weakref.WeakKeyDictionary[CodeType, bytes]" = weakref.WeakKeyDictionary()
+
+
+def _literal(value: Any) -> Optional[str]:
+    """Return a stable representation of a literal value, or None."""
+    if isinstance(value, LITERAL_TYPES):
+        return repr(value)
+    if isinstance(value, (tuple, frozenset)):
+        items = [_literal(item) for item in value]
+        if None in items:
+            return None
+        if isinstance(value, frozenset):
+            # Iteration order depends on string hashing, which is randomized
+            items.sort()
+        return f"{type(value).__name__}({', '.join(items)})"  # type: ignore[arg-type]
+    return None
+
+
+def _hash_code(code: CodeType, digest: "hashlib._Hash") -> None:
+    """Hash the bytecode, constants and names of code and its nested code objects.
+
+    File names and line numbers are left out, so moving a function around or
+    editing code above it doesn't change its digest.
+    """
+    digest.update(code.co_code)
+    digest.update(
+        repr(
+            (
+                code.co_name,
+                code.co_argcount,
+                code.co_posonlyargcount,
+                code.co_kwonlyargcount,
+                code.co_flags,
+                code.co_names,
+                code.co_varnames,
+                code.co_freevars,
+                code.co_cellvars,
+            )
+        ).encode()
+    )
+    # Offsets of exception handlers, on 3.11+
+    digest.update(getattr(code, "co_exceptiontable", b""))
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _hash_code(const, digest)
+        else:
+            digest.update((_literal(const) or repr(const)).encode())
+
+
+def _names(code: CodeType) -> Set[str]:
+    """Global and attribute names used by code and its nested code objects."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            names |= _names(const)
+    return names
+
+
+def _digest(func: FunctionType, names: Set[str]) -> bytes:
+    code = func.__code__
+    code_digest = _code_digests.get(code)
+    if code_digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        _hash_code(code, h)
+        code_digest = _code_digests[code] = h.digest()
+    h = hashlib.blake2b(code_digest, digest_size=16)
+    defaults = list(enumerate(func.__defaults__ or ()))
+    defaults += sorted((func.__kwdefaults__ or {}).items())
+    for key, value in defaults:
+        h.update(f"{key}={_literal(value) or type(value).__qualname__}".encode())
+    # Module level constants the function reads
+    for name in sorted(names):
+        literal = _literal(func.__globals__.get(name, _MISSING))
+        if literal is not None:
+            h.update(f"{name}={literal}".encode())
+    return h.digest()
+
+
+def _class_functions(cls: type, names: Set[str]) -> Iterator[Any]:
+    """Methods of cls that code using `names` may call: those it names, and
+    special methods, which run implicitly."""
+    for klass in cls.__mro__[:-1]:
+        for name, value in vars(klass).items():
+            if name in names or (name.startswith("__") and name.endswith("__")):
+                if isinstance(value, property):
+                    yield from (value.fget, value.fset, value.fdel)
+                else:
+                    yield value
+
+
+def _functions(value: Any, names: Set[str], nested: bool = True) -> Iterator[FunctionType]:
+    """Functions that using value by one of `names` may call."""
+    if isinstance(value, (classmethod, staticmethod)):
+        value = value.__func__
+    if isinstance(value, FunctionType):
+        yield value
+        # Decorated functions, like those of `@record`
+        wrapped = getattr(value, "__wrapped__", None)
+        if wrapped is not None:
+            yield from _functions(wrapped, names, nested)
+    elif isinstance(value, type):
+        if nested:
+            for member in _class_functions(value, names):
+                yield from _functions(member, names, nested=False)
+    elif isinstance(value, ModuleType) and nested:
+        for name in names:
+            member = value.__dict__.get(name)
+            if not isinstance(member, ModuleType):
+                yield from _functions(member, names)
+
+
+def _owner(func: FunctionType) -> Optional[type]:
+    """The class func is defined in, if it can be reached from its module."""
+    parts = func.__qualname__.split(".")[:-1]
+    if not parts or "<locals>" in parts:
+        return None
+    owner: Any = func.__globals__.get(parts[0])
+    for part in parts[1:]:
+        owner = getattr(owner, part, None)
+    return owner if isinstance(owner, type) else None
+
+
+def _callees(func: FunctionType, names: Set[str]) -> Iterator[FunctionType]:
+    """Functions func may call, as far as its globals, closure and class tell."""
+    func_globals = func.__globals__
+    for name in names:
+        yield from _functions(func_globals.get(name), names)
+    for cell in func.__closure__ or ():
+        try:
+            yield from _functions(cell.cell_contents, names)
+        except ValueError:
+            # Empty cell
+            pass
+    owner = _owner(func)
+    if owner is not None:
+        yield from _functions(owner, names)
+
+
+def function_fingerprint(
+    func: Callable[..., Any], code_filter: Optional[CodeFilter] = None
+) -> Optional[bytes]:
+    """Return a digest of the code of func and of the functions it may call.
+
+    The functions func may call are found statically, from the names its code
+    uses: functions and classes of its module, functions of the modules it
+    imports and methods of its own class, then the same for those, and so on.
+    Only functions whose code passes `code_filter` are followed, so library
+    code is not included. Calls that can't be resolved that way, like those
+    made through arguments or attributes of other objects, are missed.
+
+    The digest doesn't depend on file names or line numbers, only on bytecode,
+    constants, names and literal defaults and globals, and the Python version.
+    Returns None if func has no code object.
+    """
+    func = inspect.unwrap(func)
+    if not isinstance(func, FunctionType):
+        return None
+    digests: Dict[CodeType, bytes] = {}
+    pending: List[FunctionType] = [func]
+    while pending:
+        current = pending.pop()
+        code = current.__code__
+        if code in digests:
+            continue
+        if current is not func and code_filter is not None and not code_filter(code):
+            continue
+        names = _names(code)
+        digests[code] = _digest(current, names)
+        pending.extend(_callees(current, names))
+    h = hashlib.blake2b(digest_size=16)
+    h.update(sys.implementation.cache_tag.encode())
+    h.update(digests.pop(func.__code__))
+    for digest in sorted(digests.values()):
+        h.update(digest)
+    return h.digest()
+
+
+_MISSING = object()
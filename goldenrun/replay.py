@@ -0,0 +1,615 @@
+import asyncio
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import importlib
+import inspect
+import logging
+import os
+import pickle
+import sqlite3
+from collections import deque
+from contextlib import contextmanager
+from typing import (Any, Callable, Deque, Dict, Iterable, Iterator, List,
+                    NamedTuple, Optional, Sequence, Set, Tuple)
+
+from goldenrun.compare import (DEFAULT_COMPARE_OPTIONS, CompareOptions,
+                               GoldenValue, compare_golden, differences,
+                               format_differences, short_repr)
+from goldenrun.db.base import (FuncRecordStore, SerializedFuncRecord,
+                               SerializedFuncRecordThunk, decode_record)
+from goldenrun.exceptions import GoldenRunError
+from goldenrun.fingerprint import function_fingerprint
+from goldenrun.serialization import Unserializable, get_codec
+from goldenrun.tracing import CodeFilter, FuncRecord, RaisedException
+from goldenrun.util import get_name_in_module
+
+logger = logging.getLogger(__name__)
+
+PASSED = "passed"
+FAILED = "failed"
+ERROR = "error"
+# Not replayed, the outcome being known from a previous run
+SKIPPED = "skipped"
+
+
+class ReplayOutcome(NamedTuple):
+    """The outcome of re-executing a single recorded call."""
+
+    status: str
+    detail: str = ""
+
+
+class ReplayResult:
+    """Aggregated outcomes of replaying the records of one function."""
+
+    def __init__(self, module: str, qualname: str, max_failures: int = 10) -> None:
+        self.module = module
+        self.qualname = qualname
+        self.max_failures = max_failures
+        self.counts: Dict[str, int] = {PASSED: 0, FAILED: 0, ERROR: 0, SKIPPED: 0}
+        self.failures: List[ReplayOutcome] = []
+        # Whether the code of the function changed since it was last recorded,
+        # None if unknown
+        self.changed: Optional[bool] = None
+
+    def add(self, outcome: ReplayOutcome) -> None:
+        self.counts[outcome.status] += 1
+        if outcome.status in (FAILED, ERROR) and len(self.failures) < self.max_failures:
+            self.failures.append(outcome)
+
+    @property
+    def ok(self) -> bool:
+        return self.counts[FAILED] == 0 and self.counts[ERROR] == 0
+
+    def __str__(self) -> str:
+        summary = (
+            f"{self.module}:{self.qualname}: {self.counts[PASSED]} passed, "
+            f"{self.counts[FAILED]} failed, {self.counts[ERROR]} errors"
+        )
+        if self.counts[SKIPPED]:
+            summary += f", {self.counts[SKIPPED]} skipped"
+        if self.changed:
+            summary += " (changed since recorded)"
+        return summary
+
+
+def record_digest(
+    record: SerializedFuncRecord,
+    mock: Sequence[str] = (),
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+) -> bytes:
+    """Digest of what replaying a record depends on besides the code.
+
+    That's the arguments and the expected outcome, how outcomes are compared,
+    and when functions are mocked, the patterns and the recorded children.
+    """
+    parts: List[Any] = [record[:2], record[3:10]]
+    if options != DEFAULT_COMPARE_OPTIONS:
+        parts.append(tuple(options))
+    if mock:
+        parts.append(sorted(mock))
+        parts.extend(child[:2] + child[3:10] for child in record.children)
+    return hashlib.blake2b(pickle.dumps(parts, protocol=4), digest_size=16).digest()
+
+
+class ReplayCache:
+    """Remembers the records that passed, in a SQLite database at path.
+
+    Entries are keyed by the fingerprint of the code of the replayed function
+    and its callees (see `goldenrun.fingerprint`) and by `record_digest`, so a
+    record is replayed again as soon as either changes.
+    """
+
+    # Digests looked up per query
+    BATCH_SIZE = 500
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS goldenrun_replay_pass (
+                  fingerprint BLOB,
+                  record_hash BLOB,
+                  PRIMARY KEY (fingerprint, record_hash)) WITHOUT ROWID
+                """
+            )
+
+    def passed(self, fingerprint: bytes, digests: Sequence[bytes]) -> Set[bytes]:
+        """Return those of digests that passed against fingerprint."""
+        found: Set[bytes] = set()
+        for start in range(0, len(digests), self.BATCH_SIZE):
+            batch = digests[start : start + self.BATCH_SIZE]
+            found.update(
+                row[0]
+                for row in self.conn.execute(
+                    f"""
+                    SELECT record_hash FROM goldenrun_replay_pass
+                    WHERE fingerprint = ? AND record_hash IN ({", ".join("?" * len(batch))})
+                    """,
+                    (fingerprint, *batch),
+                )
+            )
+        return found
+
+    def add(self, fingerprint: bytes, digests: Iterable[bytes]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO goldenrun_replay_pass (fingerprint, record_hash)
+                VALUES (?, ?) ON CONFLICT DO NOTHING
+                """,
+                [(fingerprint, digest) for digest in digests],
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+# Functions already imported by this (worker) process
+_functions: Dict[Tuple[str, str], Callable[..., Any]] = {}
+
+
+def load_function(module: str, qualname: str) -> Callable[..., Any]:
+    """Import the current version of a recorded function.
+
+    Methods are looked up without invoking descriptors, so that the recorded
+    `self` or `cls` argument can be passed explicitly.
+    """
+    key = (module, qualname)
+    func = _functions.get(key)
+    if func is None:
+        func = get_name_in_module(module, qualname, inspect.getattr_static)
+        if isinstance(func, (classmethod, staticmethod)):
+            func = func.__func__
+        _functions[key] = func
+    return func
+
+
+def call_with_args(func: Callable[..., Any], args: Dict[str, Any]) -> Any:
+    """Call func with recorded arguments, which are keyed by parameter name."""
+    positional = []
+    keywords = {}
+    for name, param in inspect.signature(func).parameters.items():
+        if name not in args:
+            continue
+        if param.kind is inspect.Parameter.POSITIONAL_ONLY:
+            positional.append(args[name])
+        else:
+            keywords[name] = args[name]
+    return func(*positional, **keywords)
+
+
+def _replay_yields(yields: List[Any], return_value: Any) -> Iterator[Any]:
+    yield from yields
+    return return_value
+
+
+class RecordedCalls:
+    """Stands in for a function called by a replayed call.
+
+    Each call is answered with the result of a recorded call with equal
+    arguments, which is then used up. Calls without one, and calls whose
+    recorded result can't be reproduced (they raised, yielded more values
+    than were kept, or their result couldn't be serialized), go to the real
+    function. The instance methods are called
+    on is not compared, since it is rarely equal to the recorded one.
+    """
+
+    def __init__(
+        self, func: Callable[..., Any], calls: List[FuncRecord], method: bool = False
+    ) -> None:
+        self.func = func
+        self.calls = calls
+        self.signature = inspect.signature(func)
+        self.ignored = next(iter(self.signature.parameters), None) if method else None
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        try:
+            bound = self.signature.bind(*args, **kwargs)
+        except TypeError:
+            return self.func(*args, **kwargs)
+        bound.apply_defaults()
+        for i, call in enumerate(self.calls):
+            if self._matches(call, bound.arguments, self.ignored):
+                del self.calls[i]
+                if call.yields is not None:
+                    return _replay_yields(call.yields, call.return_value)
+                return call.return_value
+        return self.func(*args, **kwargs)
+
+    @staticmethod
+    def _matches(
+        call: FuncRecord, arguments: Dict[str, Any], ignored: Optional[str]
+    ) -> bool:
+        if call.exception is not None:
+            return False
+        if isinstance(call.return_value, Unserializable) or isinstance(
+            call.yields, Unserializable
+        ):
+            return False
+        if call.yields is not None and len(call.yields) < call.yield_count:
+            return False
+        try:
+            return all(
+                name == ignored or name in arguments and bool(arguments[name] == value)
+                for name, value in call.args.items()
+            )
+        except Exception:
+            return False
+
+
+def _replacement(func: Callable[..., Any], stub: RecordedCalls) -> Callable[..., Any]:
+    # A function rather than the stub itself, so it binds like a method
+    @functools.wraps(func)
+    def replacement(*args: Any, **kwargs: Any) -> Any:
+        return stub(*args, **kwargs)
+
+    return replacement
+
+
+_MISSING = object()
+
+
+@contextmanager
+def recorded_children(
+    func: Callable[..., Any], trace: FuncRecord, mock: Sequence[str]
+) -> Iterator[None]:
+    """Replace the functions called by a recorded call with their recorded results.
+
+    Only functions whose "<module>:<qualname>" matches one of the `mock` globs
+    are replaced, where they are defined and where the module of func refers
+    to them by another name. Those that can't be imported, like nested
+    functions, are left alone.
+    """
+    calls: Dict[Tuple[str, str], List[FuncRecord]] = {}
+    for child in trace.children or ():
+        name = f"{child.module}:{child.qualname}"
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in mock):
+            calls.setdefault((child.module, child.qualname), []).append(child)
+    func_globals = getattr(inspect.unwrap(func), "__globals__", {})
+    patched: List[Tuple[Any, str, Any]] = []
+    try:
+        for (module, qualname), recorded in calls.items():
+            owner_qualname, _, name = qualname.rpartition(".")
+            try:
+                if owner_qualname:
+                    owner = get_name_in_module(module, owner_qualname)
+                else:
+                    owner = importlib.import_module(module)
+                original = inspect.getattr_static(owner, name)
+            except (GoldenRunError, ImportError, AttributeError):
+                continue
+            target = original
+            if isinstance(original, (classmethod, staticmethod)):
+                target = original.__func__
+            if not callable(target):
+                continue
+            method = inspect.isclass(owner) and inspect.isfunction(original)
+            replacement = _replacement(target, RecordedCalls(target, recorded, method))
+            replaced: Any = replacement
+            if isinstance(original, (classmethod, staticmethod)):
+                replaced = type(original)(replacement)
+            patched.append((owner, name, owner.__dict__.get(name, _MISSING)))
+            setattr(owner, name, replaced)
+            for alias, value in list(func_globals.items()):
+                if value is original and func_globals is not owner.__dict__:
+                    patched.append((func_globals, alias, value))
+                    func_globals[alias] = replacement
+        yield
+    finally:
+        for owner, name, value in reversed(patched):
+            if isinstance(owner, dict):
+                owner[name] = value
+            elif value is _MISSING:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, value)
+
+
+def drain_generator(generator: Any, trace: FuncRecord, yielded: List[Any]) -> Any:
+    """Consume a generator the way the recorded call's consumer did.
+
+    The first values are appended to `yielded`, as many as the record kept. A
+    generator that was closed early is closed after the same number of values.
+    Returns the value the generator returned.
+    """
+    kept = len(trace.yields or ())
+    closed = trace.exception is not None and trace.exception.type == "GeneratorExit"
+    count = 0
+    while not (closed and count == trace.yield_count):
+        try:
+            value = next(generator)
+        except StopIteration as stop:
+            return stop.value
+        if count < kept:
+            yielded.append(value)
+        count += 1
+    generator.close()
+    return None
+
+
+def replay_record(
+    func: Callable[..., Any],
+    thunk: SerializedFuncRecordThunk,
+    mock: Sequence[str] = (),
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+) -> ReplayOutcome:
+    record = thunk.record
+    try:
+        # The return value is only decoded if the replayed one serializes differently
+        trace = decode_record(record, decode_return=False)
+        golden = GoldenValue(record.serialized_return, get_codec(record.codec))
+    except Exception as exc:
+        return ReplayOutcome(ERROR, f"cannot decode record: {exc!r}")
+    if mock and trace.children:
+        with recorded_children(func, trace, mock):
+            return run_record(func, trace, golden, options)
+    return run_record(func, trace, golden, options)
+
+
+def run_record(
+    func: Callable[..., Any],
+    trace: FuncRecord,
+    golden: GoldenValue,
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+) -> ReplayOutcome:
+    """Call func with the arguments of trace and compare the outcome with the
+    recorded one, whose return value is `golden`."""
+    expected = trace.exception
+    if expected is not None and expected.type == "GeneratorExit":
+        expected = None
+    args = short_repr(trace.args)
+    yielded: List[Any] = []
+    try:
+        result = call_with_args(func, trace.args)
+        if inspect.iscoroutine(result):
+            result = asyncio.run(result)
+        elif inspect.isgenerator(result) and trace.yields is not None:
+            result = drain_generator(result, trace, yielded)
+    except Exception as exc:
+        raised = RaisedException.from_exception(exc)
+        if expected is None:
+            return ReplayOutcome(ERROR, f"args {args}: raised {exc!r}")
+        if raised != expected:
+            return ReplayOutcome(
+                FAILED,
+                f"args {args}: expected {expected.type}({expected.message!r}), "
+                f"raised {exc!r}",
+            )
+    else:
+        if expected is not None:
+            return ReplayOutcome(
+                FAILED,
+                f"args {args}: expected {expected.type}({expected.message!r}), "
+                f"got {short_repr(result)}",
+            )
+        found = compare_golden(golden, result, options)
+        if found:
+            return ReplayOutcome(
+                FAILED,
+                f"args {args}: return value differs\n    "
+                + format_differences(found, options.max_differences),
+            )
+    if trace.yields is not None:
+        found = differences(trace.yields, yielded, options, "yields")
+        if found:
+            return ReplayOutcome(
+                FAILED,
+                f"args {args}: yielded values differ\n    "
+                + format_differences(found, options.max_differences),
+            )
+    return ReplayOutcome(PASSED)
+
+
+def replay_chunk(
+    module: str,
+    qualname: str,
+    thunks: List[SerializedFuncRecordThunk],
+    mock: Sequence[str] = (),
+    options: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+) -> List[ReplayOutcome]:
+    """Replay a chunk of records of one function. Runs in the worker processes."""
+    try:
+        func = load_function(module, qualname)
+    except GoldenRunError as exc:
+        return [ReplayOutcome(ERROR, f"cannot load function: {exc}")] * len(thunks)
+    except Exception as exc:
+        # Importing the module failed (SyntaxError, ImportError, ...)
+        detail = f"cannot load function: {type(exc).__name__}: {exc}"
+        return [ReplayOutcome(ERROR, detail)] * len(thunks)
+    return [replay_record(func, thunk, mock, options) for thunk in thunks]
+
+
+def chunk_records(
+    thunks: Iterable[SerializedFuncRecordThunk], chunk_size: int
+) -> Iterator[Tuple[str, str, List[SerializedFuncRecordThunk]]]:
+    """Group consecutive records of the same function into chunks."""
+    key: Optional[Tuple[str, str]] = None
+    chunk: List[SerializedFuncRecordThunk] = []
+    for thunk in thunks:
+        thunk_key = (thunk.module, thunk.qualname)
+        if chunk and (thunk_key != key or len(chunk) >= chunk_size):
+            yield (*key, chunk)  # type: ignore[misc]
+            chunk = []
+        key = thunk_key
+        chunk.append(thunk)
+    if chunk:
+        yield (*key, chunk)  # type: ignore[misc]
+
+
+class ReplayEngine:
+    """Re-executes recorded calls and compares them with the recorded results.
+
+    Records are streamed from the store in chunks of `chunk_size` and replayed
+    by a pool of `workers` processes, each of which imports the replayed
+    functions once. With a single worker everything runs in this process.
+
+    Functions matching the `mock` globs return the results recorded for the
+    calls a replayed call made to them instead of running, see
+    `recorded_children`.
+
+    Given a `cache`, replay is incremental: records that already passed
+    against the current fingerprint of their function are skipped. Being
+    recorded with the current code doesn't make a record pass, it still has to
+    be replayed once. Fingerprints follow
+    the callees whose code passes `code_filter`, which should be the filter
+    used when recording. Records that pass are added to the cache.
+
+    Return and yielded values are compared according to `compare`, see
+    `goldenrun.compare`.
+
+    Results tell whether the code of their function changed since it was last
+    recorded, when the store kept its fingerprint.
+    """
+
+    def __init__(
+        self,
+        store: FuncRecordStore,
+        workers: Optional[int] = None,
+        chunk_size: int = 100,
+        max_failures: int = 10,
+        mock: Sequence[str] = (),
+        cache: Optional[ReplayCache] = None,
+        code_filter: Optional[CodeFilter] = None,
+        compare: CompareOptions = DEFAULT_COMPARE_OPTIONS,
+    ) -> None:
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.max_failures = max_failures
+        self.mock = tuple(mock)
+        self.cache = cache
+        self.code_filter = code_filter
+        self.compare = compare
+        # Current fingerprints of the replayed functions
+        self._fingerprints: Dict[Tuple[str, str], Optional[bytes]] = {}
+
+    def _get_fingerprint(self, module: str, qualname: str) -> Optional[bytes]:
+        key = (module, qualname)
+        if key not in self._fingerprints:
+            try:
+                current: Optional[bytes] = function_fingerprint(
+                    load_function(module, qualname), self.code_filter
+                )
+            except Exception:
+                # Replaying reports the functions that can't be loaded
+                current = None
+            self._fingerprints[key] = current
+        return self._fingerprints[key]
+
+    def _changed(self, module: str, qualname: str) -> Optional[bool]:
+        recorded = self.store.get_fingerprint(module, qualname)
+        if recorded is None:
+            return None
+        current = self._get_fingerprint(module, qualname)
+        return None if current is None else current != recorded
+
+    def _plan(
+        self, chunks: Iterable[Tuple[str, str, List[SerializedFuncRecordThunk]]]
+    ) -> Iterator[Tuple[str, str, List[SerializedFuncRecordThunk], List[bytes], int]]:
+        """Drop the records the cache tells the outcome of from chunks.
+
+        Yields the records left to replay in each chunk, their digests and the
+        number of records skipped.
+        """
+        assert self.cache is not None
+        for module, qualname, chunk in chunks:
+            current = self._get_fingerprint(module, qualname)
+            if current is None:
+                yield module, qualname, chunk, [], 0
+            else:
+                digests = [
+                    record_digest(thunk.record, self.mock, self.compare) for thunk in chunk
+                ]
+                passed = self.cache.passed(current, digests)
+                kept = [
+                    (thunk, digest)
+                    for thunk, digest in zip(chunk, digests)
+                    if digest not in passed
+                ]
+                yield (
+                    module,
+                    qualname,
+                    [thunk for thunk, _ in kept],
+                    [digest for _, digest in kept],
+                    len(chunk) - len(kept),
+                )
+
+    def replay(self, qualname: str, module: Optional[str] = None) -> List[ReplayResult]:
+        """Replay every record of `qualname`, one result per recorded module."""
+        thunks = self.store.get_records(qualname, limit=None, module=module)
+        chunks = chunk_records(thunks, self.chunk_size)  # type: ignore[arg-type]
+        if self.cache is None:
+            plan = ((m, q, chunk, [], 0) for m, q, chunk in chunks)
+        else:
+            plan = self._plan(chunks)
+        results: Dict[Tuple[str, str], ReplayResult] = {}
+
+        def collect(
+            module: str, qualname: str, digests: List[bytes], outcomes: List[ReplayOutcome]
+        ) -> None:
+            key = (module, qualname)
+            if key not in results:
+                results[key] = ReplayResult(module, qualname, self.max_failures)
+                results[key].changed = self._changed(module, qualname)
+            for outcome in outcomes:
+                results[key].add(outcome)
+            if digests and self.cache is not None:
+                current = self._get_fingerprint(module, qualname)
+                self.cache.add(
+                    current,  # type: ignore[arg-type]
+                    (
+                        digest
+                        for digest, outcome in zip(digests, outcomes)
+                        if outcome.status == PASSED
+                    ),
+                )
+
+        def replay_plan() -> Iterator[
+            Tuple[str, str, List[SerializedFuncRecordThunk], List[bytes]]
+        ]:
+            for module, qualname, chunk, digests, skipped in plan:
+                if skipped:
+                    collect(module, qualname, [], [ReplayOutcome(SKIPPED)] * skipped)
+                if chunk:
+                    yield module, qualname, chunk, digests
+
+        if self.workers <= 1:
+            for chunk_module, chunk_qualname, chunk, digests in replay_plan():
+                collect(
+                    chunk_module,
+                    chunk_qualname,
+                    digests,
+                    replay_chunk(
+                        chunk_module, chunk_qualname, chunk, self.mock, self.compare
+                    ),
+                )
+            return list(results.values())
+
+        # Bound the number of chunks in flight so records keep streaming
+        pending: Deque[
+            Tuple[str, str, List[bytes], "concurrent.futures.Future[List[ReplayOutcome]]"]
+        ]
+        pending = deque()
+        with concurrent.futures.ProcessPoolExecutor(self.workers) as executor:
+            for chunk_module, chunk_qualname, chunk, digests in replay_plan():
+                future = executor.submit(
+                    replay_chunk,
+                    chunk_module,
+                    chunk_qualname,
+                    chunk,
+                    self.mock,
+                    self.compare,
+                )
+                pending.append((chunk_module, chunk_qualname, digests, future))
+                if len(pending) >= self.workers * 2:
+                    done_module, done_qualname, done_digests, done = pending.popleft()
+                    collect(done_module, done_qualname, done_digests, done.result())
+            while pending:
+                done_module, done_qualname, done_digests, done = pending.popleft()
+                collect(done_module, done_qualname, done_digests, done.result())
+        return list(results.values())
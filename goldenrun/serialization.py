@@ -0,0 +1,289 @@
+import array
+import io
+import pickle
+import struct
+import threading
+import zlib
+from abc import ABCMeta, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Anything supporting the buffer protocol
+Buffer = Union[bytes, bytearray, memoryview, pickle.PickleBuffer]
+
+
+class Codec(metaclass=ABCMeta):
+    """Serializes the argument and return values of recorded calls.
+
+    Every codec has a tag that is stored next to the values it encoded, so
+    that they can still be decoded after the configured codec changes.
+    """
+
+    tag: str
+
+    def encode(self, value: Any) -> bytes:
+        """Encode value as a single bytes object, as stored.
+
+        Joining the parts of `encode_parts` copies them once.
+        """
+        return b"".join(self.encode_parts(value))
+
+    @abstractmethod
+    def encode_parts(self, value: Any) -> Sequence[Buffer]:
+        """Encode value as a sequence of buffers to be concatenated.
+
+        Lets wrapping codecs consume large buffers without joining them first.
+        """
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Any:
+        """Decode a value produced by `encode`."""
+
+
+class PickleCodec(Codec):
+    """Plain pickle, the format used before codecs were configurable."""
+
+    tag = "pickle"
+
+    def __init__(self, protocol: int = pickle.DEFAULT_PROTOCOL) -> None:
+        self.protocol = protocol
+
+    def encode_parts(self, value: Any) -> Sequence[Buffer]:
+        return [pickle.dumps(value, protocol=self.protocol)]
+
+    def decode(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+# Pickle streams start with the PROTO opcode (0x80), never with this byte
+_FRAMED = b"\x00"
+_COUNT = struct.Struct("<I")
+_LENGTH = struct.Struct("<Q")
+
+
+def _rebuild_memoryview(data: Any, format: str, shape: Tuple[int, ...]) -> memoryview:
+    view = memoryview(bytes(data))
+    try:
+        return view.cast(format, shape)
+    except (TypeError, ValueError):
+        # Formats cast doesn't support, such as numpy's "<d", stay flat bytes
+        return view
+
+
+def _rebuild_array(typecode: str, data: Any) -> "array.array[Any]":
+    rebuilt = array.array(typecode)
+    rebuilt.frombytes(data)
+    return rebuilt
+
+
+class _OutOfBandPickler(pickle.Pickler):
+    """Pickles memoryviews, which pickle rejects, and hands the data of large
+    memoryviews and arrays to `buffers` instead of copying it.
+
+    Reused for successive values, as creating a pickler costs more than
+    pickling a small value.
+    """
+
+    def __init__(self, threshold: int) -> None:
+        self.file = io.BytesIO()
+        self.buffers: List[pickle.PickleBuffer] = []
+        super().__init__(self.file, protocol=5, buffer_callback=self.buffers.append)
+        self.threshold = threshold
+
+    def pickle(self, value: Any) -> Tuple[bytes, List[pickle.PickleBuffer]]:
+        """Return the pickle stream of value and its out-of-band buffers."""
+        try:
+            self.dump(value)
+            return self.file.getvalue(), self.buffers[:]
+        finally:
+            self.file.seek(0)
+            self.file.truncate()
+            self.buffers.clear()
+            self.clear_memo()
+
+    def reducer_override(self, obj: Any) -> Any:
+        if type(obj) is memoryview:
+            data: Any = pickle.PickleBuffer(obj)
+            if obj.nbytes < self.threshold or not obj.c_contiguous:
+                data = obj.tobytes()
+            return _rebuild_memoryview, (data, obj.format, obj.shape)
+        if type(obj) is array.array and len(obj) * obj.itemsize >= self.threshold:
+            return _rebuild_array, (obj.typecode, pickle.PickleBuffer(obj))
+        return NotImplemented
+
+
+class OutOfBandPickleCodec(Codec):
+    """Pickle protocol 5 with out-of-band buffers.
+
+    The data of memoryviews and arrays of at least `threshold` bytes, and of
+    objects exposing it through `pickle.PickleBuffer` (numpy arrays, ...), is
+    not copied into the pickle stream. bytes and bytearray are always copied
+    in, as the pickler doesn't let them be reduced otherwise. Out-of-band
+    buffers are appended after the stream, preceded by a header with the
+    number of buffers and the length of the stream and of each buffer. Values
+    without out-of-band buffers are stored as the bare pickle stream.
+
+    Stores keep each value as a single bytes object, so `encode` still copies
+    the buffers once when joining them; wrapping codecs such as
+    CompressedCodec consume them from `encode_parts` without that copy.
+    """
+
+    tag = "pickle5"
+
+    def __init__(self, threshold: int = 1024) -> None:
+        self.threshold = threshold
+        self._local = threading.local()
+
+    def encode_parts(self, value: Any) -> Sequence[Buffer]:
+        # Taken while in use, so values pickled while pickling another (from
+        # a __reduce__ method, ...) get a pickler of their own
+        pickler = getattr(self._local, "pickler", None) or _OutOfBandPickler(self.threshold)
+        self._local.pickler = None
+        try:
+            data, buffers = pickler.pickle(value)
+        finally:
+            self._local.pickler = pickler
+        if not buffers:
+            return [data]
+        raw = [buffer.raw() for buffer in buffers]
+        lengths = [len(data)] + [view.nbytes for view in raw]
+        header = _FRAMED + _COUNT.pack(len(raw))
+        header += b"".join(_LENGTH.pack(n) for n in lengths)
+        return [header, data, *raw]
+
+    def decode(self, data: bytes) -> Any:
+        view = memoryview(data)
+        if view[:1] != _FRAMED:
+            return pickle.loads(view)
+        (count,) = _COUNT.unpack_from(view, 1)
+        offset = 1 + _COUNT.size
+        lengths = []
+        for _ in range(count + 1):
+            lengths.append(_LENGTH.unpack_from(view, offset)[0])
+            offset += _LENGTH.size
+        pickled_length, *buffer_lengths = lengths
+        pickled = view[offset : offset + pickled_length]
+        offset += pickled_length
+        buffers = []
+        for length in buffer_lengths:
+            buffers.append(view[offset : offset + length])
+            offset += length
+        return pickle.loads(pickled, buffers=buffers)
+
+
+class Unserializable:
+    """Stands in for a recorded value that its codec couldn't encode.
+
+    It is equal only to itself, so a call recorded with one never matches the
+    arguments of a replayed call.
+    """
+
+    __slots__ = ("type_name", "error")
+
+    def __init__(self, type_name: str, error: str) -> None:
+        self.type_name = type_name
+        self.error = error
+
+    @classmethod
+    def of(cls, value: Any, exc: BaseException) -> "Unserializable":
+        return cls(type(value).__qualname__, f"{type(exc).__name__}: {exc}")
+
+    def __reduce__(self) -> Any:
+        return (Unserializable, (self.type_name, self.error))
+
+    def __repr__(self) -> str:
+        return f"<unserializable {self.type_name} ({self.error})>"
+
+
+def _lzma_compressor(level: Optional[int]) -> Any:
+    # lzma is only imported when used
+    import lzma
+
+    return lzma.LZMACompressor(preset=level)
+
+
+def _lzma_decompress(data: bytes) -> bytes:
+    import lzma
+
+    return lzma.decompress(data)
+
+
+_COMPRESSORS: Dict[str, Callable[[Optional[int]], Any]] = {
+    "zlib": lambda level: zlib.compressobj(-1 if level is None else level),
+    "lzma": _lzma_compressor,
+}
+_DECOMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "zlib": zlib.decompress,
+    "lzma": _lzma_decompress,
+}
+
+_RAW = b"\x00"
+_COMPRESSED = b"\x01"
+
+
+class CompressedCodec(Codec):
+    """Compresses the output of another codec when it is at least `threshold` bytes.
+
+    `compression` is "zlib" or "lzma", and `level` is passed on as the zlib
+    level or lzma preset. A leading flag byte tells whether a value was
+    compressed.
+    """
+
+    def __init__(
+        self,
+        codec: Codec,
+        compression: str = "zlib",
+        threshold: int = 4096,
+        level: Optional[int] = None,
+    ) -> None:
+        if compression not in _COMPRESSORS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
+        self.tag = f"{compression}+{codec.tag}"
+
+    def encode_parts(self, value: Any) -> Sequence[Buffer]:
+        parts = self.codec.encode_parts(value)
+        size = sum(memoryview(part).nbytes for part in parts)
+        if size < self.threshold:
+            return [_RAW, *parts]
+        compressor = _COMPRESSORS[self.compression](self.level)
+        compressed: List[Buffer] = [_COMPRESSED]
+        compressed.extend(compressor.compress(part) for part in parts)
+        compressed.append(compressor.flush())
+        return compressed
+
+    def decode(self, data: bytes) -> Any:
+        flag, payload = data[:1], data[1:]
+        if flag == _COMPRESSED:
+            payload = _DECOMPRESSORS[self.compression](payload)
+        return self.codec.decode(payload)
+
+
+_BASE_CODECS: Dict[str, Callable[[], Codec]] = {
+    PickleCodec.tag: PickleCodec,
+    OutOfBandPickleCodec.tag: OutOfBandPickleCodec,
+}
+_codecs: Dict[str, Codec] = {}
+
+DEFAULT_CODEC: Codec = CompressedCodec(OutOfBandPickleCodec(), "zlib", level=1)
+
+
+def get_codec(tag: Optional[str]) -> Codec:
+    """Return a codec able to decode values stored with the given tag.
+
+    Values stored before codecs were recorded have no tag and are plain pickles.
+    """
+    if tag is None:
+        tag = PickleCodec.tag
+    codec = _codecs.get(tag)
+    if codec is None:
+        compression, _, base_tag = tag.rpartition("+")
+        if base_tag not in _BASE_CODECS:
+            raise ValueError(f"Unknown codec: {tag}")
+        codec = _BASE_CODECS[base_tag]()
+        if compression:
+            codec = CompressedCodec(codec, compression)
+        _codecs[tag] = codec
+    return codec
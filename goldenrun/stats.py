@@ -0,0 +1,162 @@
+import json
+from typing import IO, Any, Dict, List, Optional, Tuple
+
+
+class Stats:
+    """Counters and timers of the work goldenrun does while recording.
+
+    Collecting them is off by default: tracers, loggers and stores pick up the
+    current Stats when they are created, see `enable_stats`, and skip counting
+    altogether without one. Times are accumulated in nanoseconds from
+    `time.perf_counter_ns`.
+
+    Counters are plain attributes updated without locking, so an increment
+    may occasionally be lost when several traced threads run at once.
+    """
+
+    __slots__ = (
+        # Call events received by the tracer, including generators resuming
+        "calls_seen",
+        # Call events of code rejected by the code filter. With the monitoring
+        # backend, rejected code stops sending events, so this is mostly the
+        # number of distinct code locations rejected
+        "calls_filtered",
+        # Time spent running the code filter, and resolving the function of a
+        # traced code object (see `goldenrun.tracing.get_func`)
+        "filter_ns",
+        "get_func_ns",
+        # Lookups of the module and qualified name of traced code objects
+        "cache_hits",
+        "cache_misses",
+        # Calls whose trace was handed to the logger
+        "records_captured",
+        # Size of the encoded arguments, return values and yielded values, and
+        # the time taken to encode them
+        "bytes_serialized",
+        "serialize_ns",
+        # Writes of pending traces to the store by loggers
+        "flushes",
+        "flush_ns",
+        "max_flush_ns",
+        # Records written by stores, in how many transactions, and how long it took
+        "records_stored",
+        "store_batches",
+        "store_ns",
+    )
+
+    def __init__(self) -> None:
+        self.calls_seen = 0
+        self.calls_filtered = 0
+        self.filter_ns = 0
+        self.get_func_ns = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.records_captured = 0
+        self.bytes_serialized = 0
+        self.serialize_ns = 0
+        self.flushes = 0
+        self.flush_ns = 0
+        self.max_flush_ns = 0
+        self.records_stored = 0
+        self.store_batches = 0
+        self.store_ns = 0
+
+    def add_flush(self, elapsed_ns: int) -> None:
+        self.flushes += 1
+        self.flush_ns += elapsed_ns
+        if elapsed_ns > self.max_flush_ns:
+            self.max_flush_ns = elapsed_ns
+
+    def update(self, other: "Stats") -> None:
+        """Add the counters of other, such as those of another process."""
+        for name in self.__slots__:
+            if name == "max_flush_ns":
+                self.max_flush_ns = max(self.max_flush_ns, other.max_flush_ns)
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Stats":
+        stats = cls()
+        for name in cls.__slots__:
+            setattr(stats, name, int(data.get(name, 0)))
+        return stats
+
+    def dump(self, f: IO[str]) -> None:
+        """Write the counters to f as JSON."""
+        json.dump(self.to_dict(), f, indent=2)
+        f.write("\n")
+
+    @classmethod
+    def load(cls, f: IO[str]) -> "Stats":
+        """Read counters written by `dump`."""
+        return cls.from_dict(json.load(f))
+
+    def report(self) -> str:
+        """Return a human readable summary of the counters."""
+        lookups = self.cache_hits + self.cache_misses
+        rows: List[Tuple[str, str]] = [
+            ("calls seen", f"{self.calls_seen:,}"),
+            ("calls filtered", f"{self.calls_filtered:,}"),
+            ("code filter time", _format_ns(self.filter_ns)),
+            ("function lookup time", _format_ns(self.get_func_ns)),
+            (
+                "name cache hits",
+                f"{self.cache_hits:,} / {lookups:,}"
+                + (f" ({self.cache_hits / lookups:.1%})" if lookups else ""),
+            ),
+            ("records captured", f"{self.records_captured:,}"),
+            ("bytes serialized", f"{self.bytes_serialized:,}"),
+            ("serialization time", _format_ns(self.serialize_ns)),
+            ("flushes", f"{self.flushes:,}"),
+            ("flush time", _format_ns(self.flush_ns)),
+            (
+                "flush latency",
+                f"mean {_format_ns(self.flush_ns // self.flushes)}, "
+                f"max {_format_ns(self.max_flush_ns)}"
+                if self.flushes
+                else "-",
+            ),
+            ("records stored", f"{self.records_stored:,}"),
+            ("store transactions", f"{self.store_batches:,}"),
+            ("store time", _format_ns(self.store_ns)),
+        ]
+        width = max(len(label) for label, _ in rows)
+        return "\n".join(f"{label:<{width}}  {value}" for label, value in rows)
+
+
+def _format_ns(ns: int) -> str:
+    if ns < 1_000_000:
+        return f"{ns / 1e3:,.1f} us"
+    if ns < 1_000_000_000:
+        return f"{ns / 1e6:,.1f} ms"
+    return f"{ns / 1e9:,.2f} s"
+
+
+_current: Optional[Stats] = None
+
+
+def enable_stats() -> Stats:
+    """Start collecting stats, and return the Stats they are collected in.
+
+    Only tracers, loggers and stores created afterwards update them. Calling
+    it again returns the same Stats.
+    """
+    global _current
+    if _current is None:
+        _current = Stats()
+    return _current
+
+
+def disable_stats() -> None:
+    """Stop collecting stats in tracers, loggers and stores created afterwards."""
+    global _current
+    _current = None
+
+
+def get_stats() -> Optional[Stats]:
+    """Return the Stats being collected, or None if collecting is off."""
+    return _current
@@ -1,318 +1,1293 @@
-import functools
-import inspect
-import logging
-import sys
-from abc import ABCMeta, abstractmethod
-from contextlib import contextmanager
-from types import CodeType, FrameType
-from typing import Any, Callable, Dict, Iterator, Optional, cast
-
-import opcode
-
-logger = logging.getLogger(__name__)
-
-
-class FuncRecord:
-    """FuncRecord contains the types observed during a single invocation of a function"""
-
-    def __init__(
-        self,
-        record: bool,
-        func: Callable[..., Any],
-        args: Dict[str, Any],
-        return_value: Optional[Any] = None,
-        # return_type: Optional[type] = None,
-        # yield_type: Optional[type] = None,
-    ) -> None:
-        """
-        Args:
-            func: The function where the trace occurred
-            args: The collected argument types
-            return_type: The collected return type. This will be None if the called function returns
-                due to an unhandled exception. It will be NoneType if the function returns the value None.
-            yield_type: The collected yield type. This will be None if the called function never
-                yields. It will be NoneType if the function yields the value None.
-        """
-        self.record = record
-        self.func = func
-        self.args = args
-        self.return_value = return_value
-        # Reeplace __main__ with the module name
-        self.module = (
-            self.__file_to_module(self.func.__globals__["__file__"])
-            if self.func.__module__ == "__main__"
-            else self.func.__module__
-        )
-        self.qualname = self.func.__qualname__
-
-    def __file_to_module(self, file: str) -> str:
-        return file.replace(".py", "").replace("/", ".")
-
-    # def __eq__(self, other: object) -> bool:
-    #     if isinstance(other, self.__class__):
-    #         return self.__dict__ == other.__dict__
-    #     return NotImplemented
-
-    # def __repr__(self) -> str:
-    #     return "FuncRecord(%s, %s, %s, %s)" % (
-    #         self.func,
-    #         self.args,
-    #         self.return_value,
-    #         # self.return_type,
-    #         # self.yield_type,
-    #     )
-
-    def __hash__(self) -> int:
-        return hash(
-            (
-                self.func,
-                frozenset(self.args.items()),
-                # self.return_type,
-                # self.yield_type,
-            )
-        )
-
-    # def add_yield_type(self, typ: type) -> None:
-    #     if self.yield_type is None:
-    #         self.yield_type = typ
-    #     else:
-    #         self.yield_type = cast(type, Union[self.yield_type, typ])
-
-
-class FuncRecordLogger(metaclass=ABCMeta):
-    """Log and store/print records collected by a CallTracer."""
-
-    @abstractmethod
-    def log(self, trace: FuncRecord) -> None:
-        """Log a single call trace."""
-
-    def flush(self) -> None:
-        """Flush all logged traces to output / database.
-
-        Not an abstractmethod because it's OK to leave it as a no-op; for very
-        simple loggers it may not be necessary to batch-flush traces, and `log`
-        can handle everything.
-        """
-
-
-def get_previous_frames(frame: Optional[FrameType]) -> Iterator[FrameType]:
-    while frame is not None:
-        yield frame
-        frame = frame.f_back
-
-
-def get_locals_from_previous_frames(frame: FrameType) -> Iterator[Any]:
-    for previous_frame in get_previous_frames(frame):
-        yield from previous_frame.f_locals.values()
-
-
-def _has_code(
-    func: Optional[Callable[..., Any]], code: CodeType
-) -> Optional[Callable[..., Any]]:
-    while func is not None:
-        func_code = getattr(func, "__code__", None)
-        if func_code is code:
-            return func
-        # Attempt to find the decorated function
-        func = getattr(func, "__wrapped__", None)
-    return None
-
-
-def get_func_in_mro(obj: Any, code: CodeType) -> Optional[Callable[..., Any]]:
-    """Attempt to find a function in a side-effect free way.
-
-    This looks in obj's mro manually and does not invoke any descriptors.
-    """
-    # FunctionType is incompatible with Callable
-    # https://github.com/python/typeshed/issues/1378
-    val = inspect.getattr_static(obj, code.co_name, None)
-    if val is None:
-        return None
-    if isinstance(val, (classmethod, staticmethod)):
-        cand = val.__func__
-    elif isinstance(val, property) and (val.fset is None) and (val.fdel is None):
-        cand = cast(Callable[..., Any], val.fget)
-    else:
-        cand = cast(Callable[..., Any], val)
-    return _has_code(cand, code)
-
-
-def get_func(frame: FrameType) -> Optional[Callable[..., Any]]:
-    """Return the function whose code object corresponds to the supplied stack frame."""
-    code = frame.f_code
-    if code.co_name is None:
-        return None
-    # First, try to find the function in globals
-    cand = frame.f_globals.get(code.co_name, None)
-    func = _has_code(cand, code)
-    # If that failed, as will be the case with class and instance methods, try
-    # to look up the function from the first argument. In the case of class/instance
-    # methods, this should be the class (or an instance of the class) on which our
-    # method is defined.
-    if func is None and code.co_argcount >= 1:
-        first_arg = frame.f_locals.get(code.co_varnames[0])
-        func = get_func_in_mro(first_arg, code)
-    # If we still can't find the function, as will be the case with static methods,
-    # try looking at classes in global scope.
-    if func is None:
-        for v in frame.f_globals.values():
-            if not isinstance(v, type):
-                continue
-            func = get_func_in_mro(v, code)
-            if func is not None:
-                break
-    # # If we still can't find the function, try looking at the locals of all previous frames.
-    if func is None:
-        for v in get_locals_from_previous_frames(frame):
-            if not callable(v):
-                continue
-            func = _has_code(v, code)
-            if func is not None:
-                break
-    return func
-
-
-RETURN_VALUE_OPCODE = opcode.opmap["RETURN_VALUE"]
-YIELD_VALUE_OPCODE = opcode.opmap["YIELD_VALUE"]
-
-# A CodeFilter is a predicate that decides whether or not a the call for the
-# supplied code object should be traced.
-CodeFilter = Callable[[CodeType], bool]
-
-EVENT_CALL = "call"
-EVENT_RETURN = "return"
-SUPPORTED_EVENTS = {EVENT_CALL, EVENT_RETURN}
-
-
-class CallTracer:
-    """CallTracer captures the concrete types involved in a function invocation.
-
-    On a per function call basis, CallTracer will record the types of arguments
-    supplied, the type of the function's return value (if any), and the types
-    of values yielded by the function (if any). It emits a FuncRecord object
-    that contains the captured types when the function returns.
-
-    Use it like so:
-
-        sys.setprofile(CallTracer(MyCallLogger()))
-
-    """
-
-    def __init__(
-        self,
-        logger: FuncRecordLogger,
-        code_filter: Optional[CodeFilter] = None,
-        sample_rate: Optional[int] = None,
-    ) -> None:
-        self.logger = logger
-        self.traces: Dict[FrameType, FuncRecord] = {}
-        self.sample_rate = sample_rate
-        self.cache: Dict[CodeType, Optional[Callable[..., Any]]] = {}
-        self.should_trace = code_filter
-        self.recording = False
-
-    def _get_func(self, frame: FrameType) -> Optional[Callable[..., Any]]:
-        code = frame.f_code
-        if code not in self.cache:
-            self.cache[code] = get_func(frame)
-        return self.cache[code]
-
-    def handle_call(self, frame: FrameType) -> None:
-        func = self._get_func(frame)
-        if func is None:
-            return
-        func_record = getattr(func, "__record__", False)
-        if func_record:
-            self.recording = True
-        if not self.recording:
-            return
-
-        code = frame.f_code
-        # I can't figure out a way to access the value sent to a generator via
-        # send() from a stack frame.
-        if frame in self.traces:
-            # resuming a generator; we've already seen this frame
-            return
-
-        arg_names = code.co_varnames[: code.co_argcount + code.co_kwonlyargcount]
-        args = {}
-        for name in arg_names:
-            if name in frame.f_locals:
-                arg = frame.f_locals[name]
-                args[name] = arg  # , get_type(arg))
-        self.traces[frame] = FuncRecord(func_record, func, args)
-
-    def handle_return(self, frame: FrameType, arg: Any) -> None:
-        # In the case of a 'return' event, arg contains the return value, or
-        # None, if the block returned because of an unhandled exception. We
-        # need to distinguish the exceptional case (not a valid return type)
-        # from a function returning (or yielding) None. In the latter case, the
-        # the last instruction that was executed should always be a return or a
-        # yield.
-        # typ = get_type(arg)
-        last_opcode = frame.f_code.co_code[frame.f_lasti]
-        trace = self.traces.get(frame)
-        if trace is None:
-            return
-        # TODO: Add generators support
-        # elif last_opcode == YIELD_VALUE_OPCODE:
-        #     trace.add_yield_type(typ)
-        else:
-            if last_opcode == RETURN_VALUE_OPCODE:
-                trace.return_value = arg
-                self.logger.log(trace)
-            # TODO: Add exceptions support
-            del self.traces[frame]
-            if len(self.traces) == 0:
-                self.recording = False
-
-    def __call__(self, frame: FrameType, event: str, arg: Any) -> "CallTracer":
-        code = frame.f_code
-        if (
-            event not in SUPPORTED_EVENTS
-            or code.co_name == "trace_types"
-            or self.should_trace
-            and not self.should_trace(code)
-        ):
-            return self
-        try:
-            if event == EVENT_CALL:
-                self.handle_call(frame)
-            elif event == EVENT_RETURN:
-                self.handle_return(frame, arg)
-            else:
-                logger.error("Cannot handle event %s", event)
-
-        except Exception:
-            logger.exception("Failed collecting trace")
-        return self
-
-
-def record(func):
-    """
-    Mark the function to record it.
-    """
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        logging.info("Calling function: " + func.__name__)
-        return func(*args, **kwargs)
-
-    setattr(func, "__record__", True)
-    return wrapper
-
-
-@contextmanager
-def trace_calls(
-    logger: FuncRecordLogger,
-    code_filter: Optional[CodeFilter] = None,
-    sample_rate: Optional[int] = None,
-) -> Iterator[None]:
-    """Enable call tracing for a block of code"""
-    old_trace = sys.getprofile()
-    sys.setprofile(CallTracer(logger, code_filter, sample_rate))
-    try:
-        yield
-    finally:
-        sys.setprofile(old_trace)
-        logger.flush()
+import contextvars
+import copy
+import functools
+import gc
+import hashlib
+import inspect
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import weakref
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from types import CodeType, FrameType, FunctionType
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Set, Tuple, Union, cast)
+
+import opcode
+
+from goldenrun.fingerprint import function_fingerprint
+from goldenrun.stats import Stats, get_stats
+
+logger = logging.getLogger(__name__)
+
+
+class RaisedException(NamedTuple):
+    """The exception a traced call raised, reduced to what replay can compare."""
+
+    type: str
+    message: str
+
+    @classmethod
+    def from_exception(cls, exc: BaseException) -> "RaisedException":
+        exc_type = type(exc)
+        if exc_type.__module__ == "builtins":
+            name = exc_type.__qualname__
+        else:
+            name = f"{exc_type.__module__}.{exc_type.__qualname__}"
+        return cls(name, str(exc))
+
+
+def module_name_from_path(path: str) -> Optional[str]:
+    """Return the name the module in the file at path is imported as.
+
+    That's its path relative to the innermost `sys.path` entry containing it, or
+    None if there is none.
+    """
+    stem = os.path.splitext(os.path.abspath(path))[0]
+    base = ""
+    for entry in sys.path:
+        prefix = os.path.join(os.path.abspath(entry or os.curdir), "")
+        if stem.startswith(prefix) and len(prefix) > len(base):
+            base = prefix
+    if not base:
+        return None
+    parts = stem[len(base) :].split(os.sep)
+    if parts[-1] == "__init__":
+        parts.pop()
+    if not parts or not all(part.isidentifier() for part in parts):
+        return None
+    return ".".join(parts)
+
+
+def get_module_name(func: Callable[..., Any]) -> str:
+    """Return the name of the module func is defined in.
+
+    Functions of a script run as `__main__` get the name the script would be
+    imported as, so they can be found again when replaying.
+    """
+    module = func.__module__
+    if module != "__main__":
+        return module
+    func_globals = getattr(func, "__globals__", {})
+    spec = func_globals.get("__spec__")
+    if spec is not None and spec.name != "__main__":
+        # Run with -m
+        return cast(str, spec.name)
+    path = func_globals.get("__file__")
+    if path is None:
+        return module
+    return module_name_from_path(path) or os.path.splitext(os.path.basename(path))[0]
+
+
+class FuncRecord:
+    """FuncRecord contains the values observed during a single invocation of a function"""
+
+    __slots__ = (
+        "record",
+        "func",
+        "args",
+        "return_value",
+        "yields",
+        "yield_count",
+        "exception",
+        "parent",
+        "children",
+        "serialized",
+        "module",
+        "qualname",
+        "fingerprint",
+    )
+
+    def __init__(
+        self,
+        record: bool,
+        func: Callable[..., Any],
+        args: Dict[str, Any],
+        return_value: Optional[Any] = None,
+        yields: Optional[List[Any]] = None,
+        yield_count: int = 0,
+        exception: Optional[RaisedException] = None,
+        parent: Optional["FuncRecord"] = None,
+        module: Optional[str] = None,
+        qualname: Optional[str] = None,
+        fingerprint: Optional[bytes] = None,
+    ) -> None:
+        """
+        Args:
+            func: The function where the trace occurred
+            args: The collected argument values
+            return_value: The collected return value. This will be None if the called
+                function raised an exception.
+            yields: The first values yielded by a generator, None if the called
+                function is not a generator.
+            yield_count: The number of values yielded, including those not kept in
+                `yields`.
+            exception: The exception raised by the called function, if any.
+            parent: The trace of the traced call this call was made from, if any.
+            module: The module of func, looked up with `get_module_name` if None.
+            qualname: The qualified name of func, looked up if None.
+            fingerprint: The digest of the code of func and its callees, see
+                `goldenrun.fingerprint.function_fingerprint`.
+        """
+        self.record = record
+        self.func = func
+        self.args = args
+        self.return_value = return_value
+        self.yields = yields
+        self.yield_count = yield_count
+        self.exception = exception
+        self.parent = parent
+        # Traces of the calls made by this call that finished, in order
+        self.children: Optional[List[FuncRecord]] = None
+        # Cached serialized form, see `FuncRecordStore.serialize`
+        self.serialized: Any = None
+        self.module = get_module_name(func) if module is None else module
+        self.qualname = func.__qualname__ if qualname is None else qualname
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def from_stored(
+        cls,
+        module: str,
+        qualname: str,
+        args: Dict[str, Any],
+        return_value: Any,
+        yields: Optional[List[Any]] = None,
+        yield_count: int = 0,
+        exception: Optional[RaisedException] = None,
+        children: Optional[List["FuncRecord"]] = None,
+    ) -> "FuncRecord":
+        """Rebuild a FuncRecord read back from a store.
+
+        The traced function is not imported, so `func` is None.
+        """
+        trace = cls.__new__(cls)
+        trace.record = True
+        trace.func = None  # type: ignore[assignment]
+        trace.args = args
+        trace.return_value = return_value
+        trace.yields = yields
+        trace.yield_count = yield_count
+        trace.exception = exception
+        trace.parent = None
+        trace.children = children
+        trace.serialized = None
+        trace.module = module
+        trace.qualname = qualname
+        trace.fingerprint = None
+        return trace
+
+    # def __eq__(self, other: object) -> bool:
+    #     if isinstance(other, self.__class__):
+    #         return self.__dict__ == other.__dict__
+    #     return NotImplemented
+
+    # def __repr__(self) -> str:
+    #     return "FuncRecord(%s, %s, %s, %s)" % (
+    #         self.func,
+    #         self.args,
+    #         self.return_value,
+    #         # self.return_type,
+    #         # self.yield_type,
+    #     )
+
+    def __hash__(self) -> int:
+        return hash(
+            (
+                self.func,
+                frozenset(self.args.items()),
+                # self.return_type,
+                # self.yield_type,
+            )
+        )
+
+    def add_yield(self, value: Any, max_yields: int) -> None:
+        """Count a yielded value, keeping it if fewer than max_yields are kept."""
+        if self.yields is None:
+            self.yields = []
+        if len(self.yields) < max_yields:
+            self.yields.append(value)
+        self.yield_count += 1
+
+    def add_child(self, child: "FuncRecord") -> None:
+        if self.children is None:
+            self.children = []
+        self.children.append(child)
+
+
+class FuncRecordLogger(metaclass=ABCMeta):
+    """Log and store/print records collected by a CallTracer."""
+
+    @abstractmethod
+    def log(self, trace: FuncRecord) -> None:
+        """Log a single call trace."""
+
+    def flush(self) -> None:
+        """Flush all logged traces to output / database.
+
+        Not an abstractmethod because it's OK to leave it as a no-op; for very
+        simple loggers it may not be necessary to batch-flush traces, and `log`
+        can handle everything.
+        """
+
+
+def get_previous_frames(frame: Optional[FrameType]) -> Iterator[FrameType]:
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+
+
+def get_locals_from_previous_frames(frame: FrameType) -> Iterator[Any]:
+    for previous_frame in get_previous_frames(frame):
+        yield from previous_frame.f_locals.values()
+
+
+def _has_code(
+    func: Optional[Callable[..., Any]], code: CodeType
+) -> Optional[Callable[..., Any]]:
+    while func is not None:
+        func_code = getattr(func, "__code__", None)
+        if func_code is code:
+            return func
+        # Attempt to find the decorated function
+        func = getattr(func, "__wrapped__", None)
+    return None
+
+
+def get_func_in_mro(obj: Any, code: CodeType) -> Optional[Callable[..., Any]]:
+    """Attempt to find a function in a side-effect free way.
+
+    This looks in obj's mro manually and does not invoke any descriptors.
+    """
+    # FunctionType is incompatible with Callable
+    # https://github.com/python/typeshed/issues/1378
+    val = inspect.getattr_static(obj, code.co_name, None)
+    if val is None:
+        return None
+    if isinstance(val, (classmethod, staticmethod)):
+        cand = val.__func__
+    elif isinstance(val, property) and (val.fset is None) and (val.fdel is None):
+        cand = cast(Callable[..., Any], val.fget)
+    else:
+        cand = cast(Callable[..., Any], val)
+    return _has_code(cand, code)
+
+
+class FunctionIndex:
+    """Maps code objects to the functions they belong to.
+
+    Functions are resolved once per code object and the result, including a
+    failure to find one, is cached. Entries hold weak references only, so code
+    objects and functions are not kept alive by the index.
+
+    Resolution tries the cheap lookups first: the function's name in the
+    frame's globals, then the class of its first argument. Failing that, the
+    functions and classes of the frame's module are indexed (once per module),
+    then the caller's locals are checked, and as a last resort
+    `gc.get_referrers` finds functions owning the code.
+    """
+
+    def __init__(self) -> None:
+        self.functions: "weakref.WeakKeyDictionary[CodeType, Optional[weakref.ref[Callable[..., Any]]]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # Size of the module namespaces when they were last indexed, by id
+        self._indexed_namespaces: Dict[int, int] = {}
+
+    def lookup(self, frame: FrameType) -> Optional[Callable[..., Any]]:
+        code = frame.f_code
+        entry = self.functions.get(code, _MISSING)
+        if entry is None:
+            return None
+        if entry is not _MISSING:
+            func = entry()  # type: ignore[operator]
+            if func is not None:
+                return func
+        func = self._resolve(frame)
+        try:
+            self.functions[code] = None if func is None else weakref.ref(func)
+        except TypeError:
+            # Not weak referenceable, don't cache it
+            pass
+        return func
+
+    def _add(self, func: Any) -> None:
+        while func is not None:
+            code = getattr(func, "__code__", None)
+            if isinstance(code, CodeType) and self.functions.get(code) is None:
+                try:
+                    self.functions[code] = weakref.ref(func)
+                except TypeError:
+                    pass
+            func = getattr(func, "__wrapped__", None)
+
+    def _index_class(self, cls: type, module: Optional[str], seen: Set[int]) -> None:
+        if id(cls) in seen:
+            return
+        seen.add(id(cls))
+        for val in vars(cls).values():
+            if isinstance(val, (classmethod, staticmethod)):
+                self._add(val.__func__)
+            elif isinstance(val, property):
+                for accessor in (val.fget, val.fset, val.fdel):
+                    self._add(accessor)
+            elif isinstance(val, type):
+                if val.__module__ == module:
+                    self._index_class(val, module, seen)
+            elif isinstance(val, FunctionType):
+                self._add(val)
+
+    def _index_namespace(self, namespace: Dict[str, Any]) -> bool:
+        """Index a module namespace, unless it didn't change since last time."""
+        if self._indexed_namespaces.get(id(namespace)) == len(namespace):
+            return False
+        self._indexed_namespaces[id(namespace)] = len(namespace)
+        module = namespace.get("__name__")
+        seen: Set[int] = set()
+        for val in list(namespace.values()):
+            if isinstance(val, type):
+                # Only classes defined in this module, imported ones are indexed
+                # with their own module
+                if val.__module__ == module:
+                    self._index_class(val, module, seen)
+            elif callable(val):
+                self._add(val)
+        return True
+
+    def _cached(self, code: CodeType) -> Optional[Callable[..., Any]]:
+        entry = self.functions.get(code)
+        return None if entry is None else entry()
+
+    def _resolve(self, frame: FrameType) -> Optional[Callable[..., Any]]:
+        code = frame.f_code
+        if code.co_name is None:
+            return None
+        # First, try to find the function in globals
+        cand = frame.f_globals.get(code.co_name, None)
+        func = _has_code(cand, code)
+        # If that failed, as will be the case with class and instance methods, try
+        # to look up the function from the first argument. In the case of class/instance
+        # methods, this should be the class (or an instance of the class) on which our
+        # method is defined.
+        if func is None and code.co_argcount >= 1:
+            first_arg = frame.f_locals.get(code.co_varnames[0])
+            func = get_func_in_mro(first_arg, code)
+        # If we still can't find the function, as will be the case with static
+        # methods, index the functions and classes of the module.
+        if func is None and self._index_namespace(frame.f_globals):
+            func = self._cached(code)
+        # Nested functions are usually called by the function defining them. A new
+        # closure is created on every call, so this is checked before the slow path.
+        if func is None and frame.f_back is not None:
+            for val in frame.f_back.f_locals.values():
+                if callable(val):
+                    func = _has_code(val, code)
+                    if func is not None:
+                        break
+        # Finally, look for functions referencing the code object.
+        if func is None:
+            for referrer in gc.get_referrers(code):
+                if isinstance(referrer, FunctionType) and referrer.__code__ is code:
+                    func = referrer
+                    break
+        return func
+
+
+_MISSING = object()
+
+# Shared by all tracers
+FUNCTION_INDEX = FunctionIndex()
+
+
+def get_func(frame: FrameType) -> Optional[Callable[..., Any]]:
+    """Return the function whose code object corresponds to the supplied stack frame."""
+    return FUNCTION_INDEX.lookup(frame)
+
+
+RETURN_VALUE_OPCODE = opcode.opmap["RETURN_VALUE"]
+YIELD_VALUE_OPCODE = opcode.opmap["YIELD_VALUE"]
+# Python 3.12+ returns constants with RETURN_CONST
+RETURN_OPCODES = {
+    opcode.opmap[name] for name in ("RETURN_VALUE", "RETURN_CONST") if name in opcode.opmap
+}
+# Python 3.10 suspends in 'yield from' and 'await' on YIELD_FROM, and leaves
+# f_lasti on the instruction before it while suspended
+YIELD_FROM_OPCODE = opcode.opmap.get("YIELD_FROM")
+
+
+def delegating(co_code: bytes, lasti: int) -> bool:
+    """Return True if a frame stopped at lasti is suspended in YIELD_FROM.
+
+    An exception raised through YIELD_FROM leaves f_lasti on YIELD_FROM itself.
+    """
+    return YIELD_FROM_OPCODE is not None and co_code[lasti + 2 : lasti + 3] == bytes(
+        [YIELD_FROM_OPCODE]
+    )
+
+# Code flags of functions whose frames can be suspended and resumed
+CO_GENERATOR = inspect.CO_GENERATOR
+CO_RESUMABLE = (
+    inspect.CO_GENERATOR
+    | inspect.CO_COROUTINE
+    | inspect.CO_ITERABLE_COROUTINE
+    | inspect.CO_ASYNC_GENERATOR
+)
+
+# Number of values kept per generator call by default
+DEFAULT_MAX_YIELDS = 1000
+
+# A CodeFilter is a predicate that decides whether or not a the call for the
+# supplied code object should be traced.
+CodeFilter = Callable[[CodeType], bool]
+
+EVENT_CALL = "call"
+EVENT_RETURN = "return"
+SUPPORTED_EVENTS = {EVENT_CALL, EVENT_RETURN}
+
+# Tracing backends. `sys.monitoring` (PEP 669) is only available on 3.12+.
+BACKEND_SETPROFILE = "setprofile"
+BACKEND_MONITORING = "monitoring"
+HAS_MONITORING = hasattr(sys, "monitoring")
+
+# Code objects of every function decorated with `@record`. Lets the tracer skip
+# function resolution for calls made outside of a recording.
+RECORDED_CODE: Set[CodeType] = set()
+# Code objects of the wrappers `@record` returns. They are shared by every
+# decorated function, and never traced.
+WRAPPER_CODE: Set[CodeType] = set()
+
+SAMPLE_RANDOM = "random"
+SAMPLE_HASH = "hash"
+
+
+class Sampler:
+    """Sampler decides which calls to `@record` functions get recorded.
+
+    The rate for a function is, in order of precedence, the `sample_rate` given to
+    its `@record` decorator, its entry in `rates` (keyed by qualname), or the
+    global `rate`. Rates are fractions between 0 and 1.
+
+    In SAMPLE_RANDOM mode each call is recorded with probability `rate`. In
+    SAMPLE_HASH mode the decision is derived from a hash of the argument values,
+    so calls with the same arguments are either always or never recorded. This
+    is only deterministic across processes for arguments with a stable repr.
+    """
+
+    def __init__(
+        self,
+        rate: float = 1.0,
+        rates: Optional[Dict[str, float]] = None,
+        mode: str = SAMPLE_RANDOM,
+    ) -> None:
+        if mode not in (SAMPLE_RANDOM, SAMPLE_HASH):
+            raise ValueError(f"Unknown sampling mode: {mode}")
+        self.rate = rate
+        self.rates = rates or {}
+        self.mode = mode
+
+    def rate_for(self, func: Callable[..., Any]) -> float:
+        rate = getattr(func, "__record_sample_rate__", None)
+        if rate is None:
+            rate = self.rates.get(func.__qualname__, self.rate)
+        return rate
+
+    def should_sample(self, func: Callable[..., Any], frame: FrameType) -> bool:
+        """Decide whether the call to `func` running in `frame` is recorded.
+
+        Only reads the argument values in SAMPLE_HASH mode.
+        """
+        rate = self.rate_for(func)
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        if self.mode == SAMPLE_HASH:
+            code = frame.f_code
+            f_locals = frame.f_locals
+            arg_names = code.co_varnames[: code.co_argcount + code.co_kwonlyargcount]
+            key = repr((func.__qualname__, [f_locals.get(name) for name in arg_names]))
+            digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+            return int.from_bytes(digest, "little") < rate * 2**64
+        return random.random() < rate
+
+
+# A sample rate is either a global rate for all functions or a Sampler.
+SampleRate = Union[float, Sampler]
+
+
+def make_sampler(sample_rate: Optional[SampleRate]) -> Sampler:
+    if sample_rate is None:
+        return Sampler()
+    if isinstance(sample_rate, Sampler):
+        return sample_rate
+    return Sampler(sample_rate)
+
+
+# Tracer activated by `@record` calls when tracing lazily, see `trace_calls`.
+_armed_tracer: Optional["CallTracer"] = None
+
+
+def snapshot_args(args: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a deep copy of args, so later mutations don't change them.
+
+    Arguments that can't be copied are kept as they are.
+    """
+    try:
+        return copy.deepcopy(args)
+    except Exception:
+        copied = {}
+        for name, value in args.items():
+            try:
+                copied[name] = copy.deepcopy(value)
+            except Exception:
+                copied[name] = value
+        return copied
+
+
+def _trace_nothing(frame: FrameType, event: str, arg: Any) -> None:
+    """Global trace function that leaves frames untraced unless they set f_trace."""
+    return None
+
+
+class Recording:
+    """The calls being traced inside one outermost `@record` call.
+
+    Kept in a context variable of the tracer, so that concurrent recordings on
+    different threads or asyncio tasks are captured independently, without
+    locking.
+    """
+
+    __slots__ = ("traces", "thrown")
+
+    def __init__(self) -> None:
+        # Calls currently running
+        self.traces: Dict[FrameType, FuncRecord] = {}
+        # Offset of the yield generators resumed by throw() or close() were resumed at
+        self.thrown: Dict[FrameType, int] = {}
+
+
+class CallTracer:
+    """CallTracer captures the concrete types involved in a function invocation.
+
+    On a per function call basis, CallTracer will record the types of arguments
+    supplied, the type of the function's return value (if any), and the types
+    of values yielded by the function (if any). It emits a FuncRecord object
+    that contains the captured types when the function returns.
+
+    Use it like so:
+
+        sys.setprofile(CallTracer(MyCallLogger()))
+
+    or call `install()` to trace all threads.
+    """
+
+    def __init__(
+        self,
+        logger: FuncRecordLogger,
+        code_filter: Optional[CodeFilter] = None,
+        sample_rate: Optional[SampleRate] = None,
+        max_yields: Optional[int] = None,
+        snapshot_args: bool = False,
+    ) -> None:
+        self.logger = logger
+        self.sampler = make_sampler(sample_rate)
+        self.max_yields = DEFAULT_MAX_YIELDS if max_yields is None else max_yields
+        self.snapshot_args = snapshot_args
+        # (module, qualname) of the traced functions
+        self.names: Dict[CodeType, Tuple[str, str]] = {}
+        # Fingerprints of the recorded functions, computed when first logged
+        self.fingerprints: Dict[CodeType, Optional[bytes]] = {}
+        # Traces of suspended generators and coroutines, until they are resumed
+        self._suspended: Dict[FrameType, FuncRecord] = {}
+        # Traces of calls that raised, keyed by the frame the exception is raised
+        # into, per thread like the trace functions that catch it
+        self._pending = threading.local()
+        self.cache = FUNCTION_INDEX
+        self.should_trace = code_filter
+        self.stats = get_stats()
+        self._recording: contextvars.ContextVar[Optional[Recording]] = (
+            contextvars.ContextVar(f"goldenrun_recording_{id(self)}", default=None)
+        )
+        self._old_profile: Optional[Callable[..., Any]] = None
+        self._old_thread_profile: Optional[Callable[..., Any]] = None
+        self._scope = threading.local()
+
+    @property
+    def recording(self) -> bool:
+        """Whether a recording is in progress in the current thread or task."""
+        return self._recording.get() is not None
+
+    def install(self) -> None:
+        """Start receiving call events for all threads.
+
+        Before Python 3.12 threads that are already running are not traced, only
+        the current one and those started afterwards.
+        """
+        self._old_profile = sys.getprofile()
+        self._old_thread_profile = threading.getprofile()
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(self)
+        else:
+            threading.setprofile(self)
+            sys.setprofile(self)
+
+    def uninstall(self) -> None:
+        """Stop receiving call events and restore the previous profilers."""
+        if hasattr(threading, "setprofile_all_threads"):
+            threading.setprofile_all_threads(self._old_profile)
+        threading.setprofile(self._old_thread_profile)  # type: ignore[arg-type]
+        sys.setprofile(self._old_profile)
+        self._old_profile = None
+        self._old_thread_profile = None
+        self._drop_raising()
+
+    def arm(self) -> None:
+        """Prepare for lazy tracing, where only `@record` calls are traced.
+
+        Nothing is installed until `activate` is called, so code running outside
+        of a recorded call is not slowed down.
+        """
+
+    def disarm(self) -> None:
+        """Undo `arm`."""
+        self._drop_raising()
+
+    def activate(self) -> None:
+        """Receive call events until the matching `deactivate` call.
+
+        Called by `@record` wrappers when tracing lazily. Nested calls only
+        install the tracer once per thread.
+        """
+        depth = getattr(self._scope, "depth", 0)
+        if depth == 0:
+            self._scope.old_profile = sys.getprofile()
+            sys.setprofile(self)
+        self._scope.depth = depth + 1
+
+    def deactivate(self) -> None:
+        self._scope.depth -= 1
+        if self._scope.depth == 0:
+            sys.setprofile(self._scope.old_profile)
+            self._scope.old_profile = None
+
+    def _get_func(self, frame: FrameType) -> Optional[Callable[..., Any]]:
+        stats = self.stats
+        if stats is None:
+            return self.cache.lookup(frame)
+        start = time.perf_counter_ns()
+        func = self.cache.lookup(frame)
+        stats.get_func_ns += time.perf_counter_ns() - start
+        return func
+
+    def _timed_filter(self, code: CodeType, stats: Stats) -> bool:
+        """Run the code filter on code, timing it."""
+        start = time.perf_counter_ns()
+        traced = self.should_trace(code)  # type: ignore[misc]
+        stats.filter_ns += time.perf_counter_ns() - start
+        return traced
+
+    def handle_call(self, frame: FrameType) -> None:
+        code = frame.f_code
+        if code in WRAPPER_CODE:
+            return
+        recording = self._recording.get()
+        if code.co_flags & CO_RESUMABLE and self._suspended:
+            # I can't figure out a way to access the value sent to a generator via
+            # send() from a stack frame.
+            trace = self._suspended.pop(frame, None)
+            if trace is not None:
+                # Resuming a generator; it carries on the recording it started in
+                if recording is None:
+                    recording = Recording()
+                    self._recording.set(recording)
+                recording.traces[frame] = trace
+                if code.co_code[frame.f_lasti] == YIELD_VALUE_OPCODE:
+                    # throw() and close() raise at the yield instead of resuming after it
+                    recording.thrown[frame] = frame.f_lasti
+                return
+        if recording is None:
+            if code not in RECORDED_CODE:
+                return
+            func = self._get_func(frame)
+            if func is None or not getattr(func, "__record__", False):
+                return
+            # Only the outermost recorded call is sampled, nested calls belong to it
+            if not self.sampler.should_sample(func, frame):
+                return
+            recording = Recording()
+            self._recording.set(recording)
+        else:
+            func = self._get_func(frame)
+            if func is None or frame in recording.traces:
+                return
+        func_record = getattr(func, "__record__", False)
+
+        arg_names = code.co_varnames[: code.co_argcount + code.co_kwonlyargcount]
+        args = {}
+        for name in arg_names:
+            if name in frame.f_locals:
+                arg = frame.f_locals[name]
+                args[name] = arg  # , get_type(arg))
+        if self.snapshot_args:
+            args = snapshot_args(args)
+        names = self.names.get(code)
+        if names is None:
+            names = self.names[code] = (get_module_name(func), func.__qualname__)
+            if self.stats is not None:
+                self.stats.cache_misses += 1
+        elif self.stats is not None:
+            self.stats.cache_hits += 1
+        # The closest traced caller, frames of filtered code in between are skipped
+        parent = None
+        caller = frame.f_back
+        while caller is not None and recording.traces:
+            parent = recording.traces.get(caller)
+            if parent is not None:
+                break
+            caller = caller.f_back
+        recording.traces[frame] = FuncRecord(
+            func_record,
+            func,
+            args,
+            parent=parent,
+            module=names[0],
+            qualname=names[1],
+        )
+
+    def _fingerprint(self, func: Callable[..., Any]) -> Optional[bytes]:
+        """Return the fingerprint of a recorded function.
+
+        Walking its callees is costly, so it is only done once per function,
+        for those whose calls are recorded.
+        """
+        code = func.__code__
+        if code not in self.fingerprints:
+            try:
+                self.fingerprints[code] = function_fingerprint(func, self.should_trace)
+            except Exception:
+                logger.exception("Failed fingerprinting %s", func)
+                self.fingerprints[code] = None
+        return self.fingerprints[code]
+
+    def handle_return(self, frame: FrameType, arg: Any) -> None:
+        # In the case of a 'return' event, arg contains the return value, or
+        # None, if the block returned because of an unhandled exception. We
+        # need to distinguish the exceptional case (not a valid return type)
+        # from a function returning (or yielding) None. In the latter case, the
+        # the last instruction that was executed should always be a return or a
+        # yield. f_lasti is a byte offset into co_code.
+        recording = self._recording.get()
+        if recording is None:
+            return
+        co_code = frame.f_code.co_code
+        last_opcode = co_code[frame.f_lasti]
+        thrown_at = recording.thrown.pop(frame, None) if recording.thrown else None
+        if last_opcode in RETURN_OPCODES:
+            self.finish_call(frame, arg, returned=True)
+        elif (
+            last_opcode == YIELD_VALUE_OPCODE
+            and not (arg is None and thrown_at == frame.f_lasti)
+            or delegating(co_code, frame.f_lasti)
+        ):
+            self.handle_yield(frame, arg)
+        else:
+            self.handle_raise(frame)
+
+    def handle_yield(self, frame: FrameType, value: Any) -> None:
+        """Buffer a value yielded by a generator and suspend its trace until resumed.
+
+        Coroutines and async generators also yield when they await, and their
+        values are not kept.
+        """
+        recording = self._recording.get()
+        if recording is None:
+            return
+        trace = recording.traces.pop(frame, None)
+        if trace is None:
+            return
+        if frame.f_code.co_flags & CO_GENERATOR:
+            trace.add_yield(value, self.max_yields)
+        self._suspended[frame] = trace
+        self._end_recording(recording)
+
+    def handle_raise(self, frame: FrameType) -> None:
+        """Emit the trace for `frame` once the exception it raised is known.
+
+        Profile functions don't see the exception being raised, so the caller
+        frame is traced until the exception reaches it. That's not possible
+        while another trace function (a debugger, coverage) is set, and then
+        the trace is dropped.
+        """
+        recording = self._recording.get()
+        if recording is None:
+            return
+        trace = recording.traces.pop(frame, None)
+        if trace is None:
+            return
+        caller = frame.f_back
+        if caller is not None and sys.gettrace() in (None, _trace_nothing):
+            self._raising()[caller] = trace
+            # The exception reached the caller only if its very next event is an
+            # exception, any other means something swallowed it, like close()
+            # does with GeneratorExit
+            caller.f_trace_lines = False
+            caller.f_trace_opcodes = True
+            caller.f_trace = self._catch_raised
+            sys.settrace(_trace_nothing)
+        self._end_recording(recording)
+
+    def _raising(self) -> Dict[FrameType, FuncRecord]:
+        raising = getattr(self._pending, "raising", None)
+        if raising is None:
+            raising = self._pending.raising = {}
+        return raising  # type: ignore[no-any-return]
+
+    def _catch_raised(self, frame: FrameType, event: str, arg: Any) -> None:
+        frame.f_trace = None
+        frame.f_trace_opcodes = False
+        raising = self._raising()
+        trace = raising.pop(frame, None)
+        if not raising:
+            sys.settrace(None)
+        if trace is None:
+            return
+        if event == "exception":
+            trace.exception = RaisedException.from_exception(arg[1])
+            self._log(trace)
+        else:
+            self._swallowed(trace)
+
+    def _swallowed(self, trace: FuncRecord) -> None:
+        """Handle a call whose exception never reached its caller.
+
+        That's what happens to the GeneratorExit raised in a generator by
+        close(), other calls are dropped.
+        """
+        if trace.yields is not None:
+            trace.exception = RaisedException("GeneratorExit", "")
+            self._log(trace)
+
+    def _drop_raising(self) -> None:
+        """Stop waiting for the exceptions of the calls of this thread that raised."""
+        if sys.gettrace() is _trace_nothing:
+            sys.settrace(None)
+        raising = self._raising()
+        for caller, trace in raising.items():
+            caller.f_trace = None
+            caller.f_trace_opcodes = False
+            self._swallowed(trace)
+        raising.clear()
+
+    def finish_call(
+        self,
+        frame: FrameType,
+        return_value: Any,
+        returned: bool,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        """Emit the trace for `frame` if it returned or raised and stop tracking it."""
+        recording = self._recording.get()
+        if recording is None:
+            return
+        trace = recording.traces.pop(frame, None)
+        if trace is None:
+            return
+        if returned:
+            trace.return_value = return_value
+            self._log(trace)
+        elif exception is not None:
+            trace.exception = RaisedException.from_exception(exception)
+            self._log(trace)
+        self._end_recording(recording)
+
+    def _log(self, trace: FuncRecord) -> None:
+        if trace.parent is not None:
+            trace.parent.add_child(trace)
+            # Parents hold on to their children, not the other way around
+            trace.parent = None
+        if trace.record:
+            trace.fingerprint = self._fingerprint(trace.func)
+        if self.stats is not None:
+            self.stats.records_captured += 1
+        self.logger.log(trace)
+
+    def _end_recording(self, recording: Recording) -> None:
+        if not recording.traces:
+            self._recording.set(None)
+
+    def __call__(self, frame: FrameType, event: str, arg: Any) -> "CallTracer":
+        code = frame.f_code
+        if event not in SUPPORTED_EVENTS or code.co_name == "trace_types":
+            return self
+        stats = self.stats
+        if stats is not None and event == EVENT_CALL:
+            stats.calls_seen += 1
+        if self.should_trace and not (
+            self.should_trace(code) if stats is None else self._timed_filter(code, stats)
+        ):
+            if stats is not None and event == EVENT_CALL:
+                stats.calls_filtered += 1
+            return self
+        try:
+            if event == EVENT_CALL:
+                self.handle_call(frame)
+            elif event == EVENT_RETURN:
+                self.handle_return(frame, arg)
+            else:
+                logger.error("Cannot handle event %s", event)
+
+        except Exception:
+            logger.exception("Failed collecting trace")
+        return self
+
+
+class MonitoringCallTracer(CallTracer):
+    """A CallTracer driven by `sys.monitoring` (PEP 669) instead of `sys.setprofile`.
+
+    Only PY_START, PY_RESUME, PY_THROW, PY_RETURN, PY_YIELD and PY_UNWIND
+    events are requested, so calls into C functions never reach Python code.
+    Like a profiler "call" event, resuming a generator or coroutine is handled as
+    a call. Code objects rejected by the code filter return
+    `sys.monitoring.DISABLE` and are not reported again until the tracer is
+    reinstalled.
+
+    The profiler tool id is used unless another tool (cProfile, ...) holds it,
+    in which case any free tool id is. When none is free, the tracer falls back
+    to `sys.setprofile`.
+    """
+
+    TOOL_ID = 2  # sys.monitoring.PROFILER_ID
+    TOOL_NAME = "goldenrun"
+    # Tool ids available to tools other than debuggers, coverage and optimizers
+    # are 0 to 5
+    TOOL_IDS = range(6)
+
+    def __init__(
+        self,
+        logger: FuncRecordLogger,
+        code_filter: Optional[CodeFilter] = None,
+        sample_rate: Optional[SampleRate] = None,
+        max_yields: Optional[int] = None,
+        snapshot_args: bool = False,
+    ) -> None:
+        super().__init__(logger, code_filter, sample_rate, max_yields, snapshot_args)
+        self._active_scopes = 0
+        self._scope_lock = threading.Lock()
+        # The tool id in use once armed, None when falling back to sys.setprofile
+        self.tool_id: Optional[int] = None
+
+    @property
+    def _events(self) -> int:
+        events = sys.monitoring.events  # type: ignore[attr-defined]
+        return (
+            events.PY_START
+            | events.PY_RESUME
+            | events.PY_THROW
+            | events.PY_RETURN
+            | events.PY_YIELD
+            | events.PY_UNWIND
+        )
+
+    def _use_tool_id(self) -> Optional[int]:
+        monitoring = sys.monitoring  # type: ignore[attr-defined]
+        for tool_id in (self.TOOL_ID, *(i for i in self.TOOL_IDS if i != self.TOOL_ID)):
+            try:
+                monitoring.use_tool_id(tool_id, self.TOOL_NAME)
+            except ValueError:
+                # In use by another tool
+                continue
+            return tool_id
+        return None
+
+    def install(self) -> None:
+        self.arm()
+        if self.tool_id is None:
+            super().install()
+        else:
+            sys.monitoring.set_events(self.tool_id, self._events)  # type: ignore[attr-defined]
+
+    def arm(self) -> None:
+        monitoring = sys.monitoring  # type: ignore[attr-defined]
+        events = monitoring.events
+        self.tool_id = tool_id = self._use_tool_id()
+        if tool_id is None:
+            logger.warning("No sys.monitoring tool id is free, tracing with sys.setprofile")
+            super().arm()
+            return
+        monitoring.register_callback(tool_id, events.PY_START, self._on_start)
+        monitoring.register_callback(tool_id, events.PY_RESUME, self._on_start)
+        monitoring.register_callback(tool_id, events.PY_THROW, self._on_throw)
+        monitoring.register_callback(tool_id, events.PY_RETURN, self._on_return)
+        monitoring.register_callback(tool_id, events.PY_YIELD, self._on_yield)
+        monitoring.register_callback(tool_id, events.PY_UNWIND, self._on_unwind)
+        # Locations disabled by a previous tracer may have used a different filter
+        monitoring.restart_events()
+
+    def disarm(self) -> None:
+        if self.tool_id is None:
+            super().disarm()
+        else:
+            self.uninstall()
+
+    def activate(self) -> None:
+        if self.tool_id is None:
+            super().activate()
+            return
+        # sys.monitoring events are process wide, so scopes are counted globally
+        with self._scope_lock:
+            if self._active_scopes == 0:
+                sys.monitoring.set_events(self.tool_id, self._events)  # type: ignore[attr-defined]
+            self._active_scopes += 1
+
+    def deactivate(self) -> None:
+        if self.tool_id is None:
+            super().deactivate()
+            return
+        with self._scope_lock:
+            self._active_scopes -= 1
+            if self._active_scopes == 0:
+                monitoring = sys.monitoring  # type: ignore[attr-defined]
+                monitoring.set_events(self.tool_id, monitoring.events.NO_EVENTS)
+
+    def uninstall(self) -> None:
+        if self.tool_id is None:
+            super().uninstall()
+            return
+        monitoring = sys.monitoring  # type: ignore[attr-defined]
+        monitoring.set_events(self.tool_id, monitoring.events.NO_EVENTS)
+        for event in (
+            monitoring.events.PY_START,
+            monitoring.events.PY_RESUME,
+            monitoring.events.PY_THROW,
+            monitoring.events.PY_RETURN,
+            monitoring.events.PY_YIELD,
+            monitoring.events.PY_UNWIND,
+        ):
+            monitoring.register_callback(self.tool_id, event, None)
+        monitoring.free_tool_id(self.tool_id)
+
+    def _is_filtered(self, code: CodeType) -> bool:
+        return (
+            code.co_name == "trace_types"
+            or code in WRAPPER_CODE
+            or bool(
+                self.should_trace
+                and not (
+                    self.should_trace(code)
+                    if self.stats is None
+                    else self._timed_filter(code, self.stats)
+                )
+            )
+        )
+
+    def _on_start(self, code: CodeType, instruction_offset: int) -> Any:
+        stats = self.stats
+        if stats is not None:
+            stats.calls_seen += 1
+        if self._is_filtered(code):
+            if stats is not None:
+                stats.calls_filtered += 1
+            return sys.monitoring.DISABLE  # type: ignore[attr-defined]
+        try:
+            self.handle_call(sys._getframe(1))
+        except Exception:
+            logger.exception("Failed collecting trace")
+        return None
+
+    def _on_return(self, code: CodeType, instruction_offset: int, retval: Any) -> Any:
+        if self._is_filtered(code):
+            return sys.monitoring.DISABLE  # type: ignore[attr-defined]
+        try:
+            self.finish_call(sys._getframe(1), retval, returned=True)
+        except Exception:
+            logger.exception("Failed collecting trace")
+        return None
+
+    def _on_throw(self, code: CodeType, instruction_offset: int, exc: BaseException) -> None:
+        # Like PY_UNWIND, PY_THROW cannot be disabled
+        if not self._suspended or self._is_filtered(code):
+            return
+        try:
+            self.handle_call(sys._getframe(1))
+        except Exception:
+            logger.exception("Failed collecting trace")
+
+    def _on_yield(self, code: CodeType, instruction_offset: int, retval: Any) -> Any:
+        if self._is_filtered(code):
+            return sys.monitoring.DISABLE  # type: ignore[attr-defined]
+        try:
+            self.handle_yield(sys._getframe(1), retval)
+        except Exception:
+            logger.exception("Failed collecting trace")
+        return None
+
+    def _on_unwind(self, code: CodeType, instruction_offset: int, exc: BaseException) -> None:
+        # PY_UNWIND cannot be disabled, so only frames we are tracking do any work
+        if self._recording.get() is None:
+            return
+        try:
+            self.finish_call(sys._getframe(1), None, returned=False, exception=exc)
+        except Exception:
+            logger.exception("Failed collecting trace")
+
+
+def make_tracer(
+    logger: FuncRecordLogger,
+    code_filter: Optional[CodeFilter] = None,
+    sample_rate: Optional[SampleRate] = None,
+    backend: Optional[str] = None,
+    max_yields: Optional[int] = None,
+    snapshot_args: bool = False,
+) -> CallTracer:
+    """Return a CallTracer for the requested backend.
+
+    If no backend is given, `sys.monitoring` is used when the interpreter supports
+    it and `sys.setprofile` otherwise.
+    """
+    if backend is None:
+        backend = BACKEND_MONITORING if HAS_MONITORING else BACKEND_SETPROFILE
+    if backend == BACKEND_MONITORING:
+        if not HAS_MONITORING:
+            raise ValueError("The monitoring backend requires Python 3.12 or newer")
+        return MonitoringCallTracer(
+            logger, code_filter, sample_rate, max_yields, snapshot_args
+        )
+    if backend == BACKEND_SETPROFILE:
+        return CallTracer(logger, code_filter, sample_rate, max_yields, snapshot_args)
+    raise ValueError(f"Unknown tracing backend: {backend}")
+
+
+def record(func=None, *, sample_rate: Optional[float] = None):
+    """
+    Mark the function to record it.
+
+    Use as `@record`, or as `@record(sample_rate=0.1)` to only record a fraction
+    of the calls regardless of the global sample rate.
+    """
+    if func is None:
+        return functools.partial(record, sample_rate=sample_rate)
+    name = getattr(func, "__name__", repr(func))
+
+    if inspect.iscoroutinefunction(func):
+        # Keep the tracer active while the coroutine runs, not just while it's created
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            logging.info("Calling function: " + name)
+            tracer = _armed_tracer
+            if tracer is None:
+                return await func(*args, **kwargs)
+            tracer.activate()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                tracer.deactivate()
+
+    elif inspect.isgeneratorfunction(func):
+        # Keep the tracer active until the generator is exhausted or closed
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            logging.info("Calling function: " + name)
+            tracer = _armed_tracer
+            if tracer is None:
+                return (yield from func(*args, **kwargs))
+            tracer.activate()
+            try:
+                return (yield from func(*args, **kwargs))
+            finally:
+                tracer.deactivate()
+
+    elif inspect.isasyncgenfunction(func):
+        # Async generators can't `yield from`, so values, sent values and
+        # thrown exceptions are passed on by hand
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            logging.info("Calling function: " + name)
+            tracer = _armed_tracer
+            if tracer is not None:
+                tracer.activate()
+            try:
+                agen = func(*args, **kwargs)
+                try:
+                    value = await agen.__anext__()
+                    while True:
+                        try:
+                            sent = yield value
+                        except GeneratorExit:
+                            await agen.aclose()
+                            raise
+                        except BaseException as exc:
+                            value = await agen.athrow(exc)
+                        else:
+                            value = await agen.asend(sent)
+                except StopAsyncIteration:
+                    return
+            finally:
+                if tracer is not None:
+                    tracer.deactivate()
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            logging.info("Calling function: " + name)
+            tracer = _armed_tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            tracer.activate()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.deactivate()
+
+    # Calls are told apart by their code object. Callables without one, such
+    # as builtins, partials or instances, can be wrapped but aren't recorded
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        setattr(func, "__record__", True)
+        if sample_rate is not None:
+            setattr(func, "__record_sample_rate__", sample_rate)
+        RECORDED_CODE.add(code)
+    WRAPPER_CODE.add(wrapper.__code__)
+    return wrapper
+
+
+@contextmanager
+def trace_calls(
+    logger: FuncRecordLogger,
+    code_filter: Optional[CodeFilter] = None,
+    sample_rate: Optional[SampleRate] = None,
+    backend: Optional[str] = None,
+    lazy: bool = False,
+    max_yields: Optional[int] = None,
+    snapshot_args: bool = False,
+) -> Iterator[None]:
+    """Enable call tracing for a block of code
+
+    If `lazy` is True, the tracer is only installed for the duration of calls to
+    `@record` functions, and code running outside of them is not traced at all.
+    At most `max_yields` values yielded by each generator call are kept. If
+    `snapshot_args` is True, arguments are copied when a call starts rather than
+    captured by reference.
+    """
+    global _armed_tracer
+    tracer = make_tracer(
+        logger, code_filter, sample_rate, backend, max_yields, snapshot_args
+    )
+    if lazy:
+        tracer.arm()
+        _armed_tracer = tracer
+    else:
+        tracer.install()
+    try:
+        yield
+    finally:
+        if lazy:
+            _armed_tracer = None
+            tracer.disarm()
+        else:
+            tracer.uninstall()
+        logger.flush()
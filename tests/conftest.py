@@ -0,0 +1,53 @@
+import os
+from contextlib import contextmanager
+from types import CodeType
+from typing import Any, Iterator, List
+
+import pytest
+
+from goldenrun.tracing import (BACKEND_MONITORING, BACKEND_SETPROFILE,
+                               HAS_MONITORING, FuncRecord, FuncRecordLogger,
+                               trace_calls)
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "")
+BACKENDS = [BACKEND_SETPROFILE] + ([BACKEND_MONITORING] if HAS_MONITORING else [])
+
+
+class ListLogger(FuncRecordLogger):
+    def __init__(self) -> None:
+        self.traces: List[FuncRecord] = []
+        self.flushes = 0
+
+    def log(self, trace: FuncRecord) -> None:
+        self.traces.append(trace)
+
+    def flush(self) -> None:
+        self.flushes += 1
+
+    def by_name(self, qualname: str) -> List[FuncRecord]:
+        return [trace for trace in self.traces if trace.qualname == qualname]
+
+
+def in_tests(code: CodeType) -> bool:
+    """Code filter tracing the test modules only."""
+    return code.co_filename.startswith(TESTS_DIR)
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request: Any) -> str:
+    return request.param  # type: ignore[no-any-return]
+
+
+@pytest.fixture
+def tracing(backend: str) -> Any:
+    """Return a context manager tracing the test modules with `backend`, which
+    yields the logger the traces go to."""
+
+    @contextmanager
+    def tracing(**options: Any) -> Iterator[ListLogger]:
+        logger = ListLogger()
+        options.setdefault("code_filter", in_tests)
+        with trace_calls(logger, backend=backend, **options):
+            yield logger
+
+    return tracing
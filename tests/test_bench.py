@@ -0,0 +1,61 @@
+import io
+import json
+
+from goldenrun.bench import (INGEST_COUNTS, STORE_BACKENDS, BenchOptions,
+                             BenchResult, bench_store, over_budget)
+from goldenrun.cli import main
+
+
+def test_store_suite_measures_ingestion_throughput():
+    options = BenchOptions(repeat=1, scale=0.001)
+
+    results = {result.name: result for result in bench_store(options)}
+
+    for count in INGEST_COUNTS:
+        for backend in STORE_BACKENDS:
+            result = results[f"ingest/{backend}/{options.count(count)}"]
+            assert result.ops == options.count(count)
+            assert result.metrics["records_per_sec"] > 0
+
+
+def test_results_without_metrics():
+    result = BenchResult("store", "add/sqlite/16", {}, 2.0, 4)
+
+    assert result.metrics is None
+    assert result.to_dict() == {
+        "suite": "store",
+        "name": "add/sqlite/16",
+        "params": {},
+        "seconds": 2.0,
+        "ops": 4,
+        "ns_per_op": 0.5e9,
+        "ops_per_sec": 2.0,
+    }
+
+
+def test_bench_command_writes_a_json_report(tmp_path):
+    output = tmp_path / "report.json"
+    argv = ["bench", "--repeat", "1", "--scale", "0.001", "-o", str(output)]
+    for suite in ("tracing", "serialization", "record"):
+        argv += ["--suite", suite]
+
+    assert main(argv, io.StringIO(), io.StringIO()) == 0
+
+    report = json.loads(output.read_text())
+    results = {(result["suite"], result["name"]): result for result in report["results"]}
+    assert {suite for suite, _ in results} == {"tracing", "serialization", "record"}
+    assert results[("tracing", "recorded/setprofile")]["slowdown"] > 0
+    assert results[("record", "script/goldenrun-record")]["slowdown"] > 0
+    assert all(result["ns_per_op"] > 0 for result in results.values())
+    assert report["options"] == {"repeat": 1, "scale": 0.001}
+
+
+def test_over_budget():
+    report = {
+        "results": [
+            {"suite": "import", "name": "goldenrun", "over_budget": 1.0},
+            {"suite": "import", "name": "goldenrun.cli", "over_budget": 0.0},
+            {"suite": "store", "name": "add/sqlite/16"},
+        ]
+    }
+    assert over_budget(report) == ["import/goldenrun"]
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+import goldenrun.db.binlog
+from goldenrun.db import make_store
+from goldenrun.db.base import FuncRecordStoreLogger
+from goldenrun.db.binlog import INDEX_MAGIC, BinaryLogStore, LogProfile
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.tracing import FuncRecord
+
+
+def open_files(prefix):
+    fds = os.listdir("/proc/self/fd")
+    paths = []
+    for fd in fds:
+        try:
+            paths.append(os.readlink(f"/proc/self/fd/{fd}"))
+        except OSError:
+            pass
+    return [path for path in paths if path.startswith(prefix)]
+
+
+def returns(store, qualname="func"):
+    return [thunk.to_trace().return_value for thunk in store.get_records(qualname)]
+
+
+def test_make_store_selects_the_backend_by_scheme(tmp_path):
+    path = str(tmp_path / "records.log")
+
+    store = make_store(f"binlog:{path}")
+    assert isinstance(store, BinaryLogStore)
+    assert store.path == path
+    store.close()
+    assert isinstance(make_store(str(tmp_path / "records.sqlite3")), SQLiteStore)
+
+
+def test_other_stores_see_new_records(tmp_path):
+    path = str(tmp_path / "records.log")
+    writer = BinaryLogStore(path)
+    reader = BinaryLogStore(path)
+
+    writer.add([FuncRecord.from_stored("mod", "func", {"x": 1}, 2)])
+    assert returns(reader) == [2]
+    writer.add([FuncRecord.from_stored("mod", "func", {"x": 2}, 4)])
+    assert returns(reader) == [2, 4]
+    writer.close()
+    reader.close()
+
+
+def test_crashed_writes_are_recovered(tmp_path):
+    path = tmp_path / "records.log"
+    store = BinaryLogStore(str(path))
+    store.add([FuncRecord.from_stored("mod", "func", {"x": i}, i) for i in range(3)])
+    store.close()
+    # The writer crashed before indexing its records, in the middle of a frame
+    (tmp_path / "records.log.idx").write_bytes(INDEX_MAGIC)
+    size = path.stat().st_size
+    with open(path, "ab") as log:
+        log.write(b"\x40\x00\x00\x00partial")
+
+    store = BinaryLogStore(str(path))
+    assert returns(store) == [0, 1, 2]
+    assert path.stat().st_size == size
+    store.add([FuncRecord.from_stored("mod", "func", {"x": 3}, 3)])
+    store.close()
+    store = BinaryLogStore(str(path))
+    assert returns(store) == [0, 1, 2, 3]
+    store.close()
+
+
+def test_compact_and_export(tmp_path):
+    path = tmp_path / "records.log"
+    store = BinaryLogStore(str(path))
+    for _ in range(3):
+        store.add([FuncRecord.from_stored("mod", "func", {"x": i}, i) for i in range(2)])
+    store.add([FuncRecord.from_stored("mod", "other", {}, None)])
+    size = path.stat().st_size
+
+    assert store.compact() == 4
+    assert path.stat().st_size < size
+    assert returns(store) == [0, 1]
+
+    sqlite_store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    assert store.export(sqlite_store) == 3
+    assert returns(sqlite_store) == [0, 1]
+    assert returns(sqlite_store, "other") == [None]
+    store.close()
+
+
+def test_last_batch_is_synced_when_recording_ends(tmp_path, monkeypatch):
+    synced = []
+
+    def fsync(fd):
+        synced.append(os.readlink(f"/proc/self/fd/{fd}"))
+
+    monkeypatch.setattr(goldenrun.db.binlog.os, "fsync", fsync)
+    path = str(tmp_path / "records.log")
+    store = BinaryLogStore(path, LogProfile(fsync_interval=3600))
+    logger = FuncRecordStoreLogger(store)
+
+    logger.log(FuncRecord.from_stored("mod", "func", {"x": 1}, 2))
+    store.add([FuncRecord.from_stored("mod", "func", {"x": 2}, 4)])
+    assert synced == []
+
+    logger.flush()
+    assert synced == [path, f"{path}.idx"]
+    store.sync()
+    assert synced == [path, f"{path}.idx"]
+    store.close()
+
+
+def test_files_are_closed_when_opening_fails(tmp_path):
+    path = tmp_path / "records.log"
+    path.write_bytes(b"not a log")
+
+    with pytest.raises(ValueError) as excinfo:
+        BinaryLogStore(str(path))
+    # The traceback keeps the store alive, its files must be closed already
+    assert excinfo.traceback
+    assert open_files(str(path)) == []
@@ -0,0 +1,145 @@
+import os
+import socket
+import threading
+from datetime import datetime
+
+import pytest
+
+from goldenrun.collector import (ACK, BATCH, HELLO, SEQ, Collector,
+                                 CollectorLogger, _read_message, encode_record,
+                                 parse_address)
+from goldenrun.db.base import SerializedFuncRecord
+from goldenrun.db.binlog import frame
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.serialization import PickleCodec
+from goldenrun.tracing import FuncRecord
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+
+
+@pytest.fixture
+def address(tmp_path):
+    return f"unix:{tmp_path / 'collector.sock'}"
+
+
+def start_collector(store, address):
+    collector = Collector(store, address, flush_interval=0.01)
+    thread = threading.Thread(target=collector.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        collector.shutdown()
+        collector.close()
+        thread.join()
+
+    return collector, stop
+
+
+@pytest.fixture
+def collector(store, address):
+    collector, stop = start_collector(store, address)
+    yield collector
+    stop()
+
+
+def returns(store):
+    return [thunk.to_trace().return_value for thunk in store.get_records("func", limit=None)]
+
+
+def trace(i):
+    return FuncRecord.from_stored("mod", "func", {"i": i}, i)
+
+
+def test_parse_address():
+    assert parse_address("tcp:localhost:9000") == (socket.AF_INET, ("localhost", 9000))
+    assert parse_address("tcp::9000") == (socket.AF_INET, ("127.0.0.1", 9000))
+    assert parse_address("tcp:[::1]:9000") == (socket.AF_INET6, ("::1", 9000))
+    assert parse_address("unix:/run/gr.sock") == (socket.AF_UNIX, "/run/gr.sock")
+    assert parse_address("gr.sock") == (socket.AF_UNIX, "gr.sock")
+
+
+def test_logger_round_trip(collector, store, address):
+    logger = CollectorLogger(address, batch_size=2)
+    for i in range(5):
+        logger.log(trace(i))
+    logger.close()
+
+    assert returns(store) == [0, 1, 2, 3, 4]
+    assert collector.records_stored == 5
+
+
+def send(address, client_id, batches):
+    """Send batches of (seq, values) as a client would, and wait for the last
+    of them to be acknowledged."""
+    codec = PickleCodec()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(parse_address(address)[1])
+    sock.sendall(frame(HELLO + client_id))
+    for seq, values in batches:
+        records = [
+            frame(
+                encode_record(
+                    SerializedFuncRecord(
+                        "mod", "func", datetime.now(), codec.encode({}), codec.encode(value)
+                    )
+                )
+            )
+            for value in values
+        ]
+        sock.sendall(frame(BATCH + SEQ.pack(seq) + b"".join(records)))
+    stream = sock.makefile("rb")
+    last = batches[-1][0]
+    while True:
+        message = _read_message(stream)
+        assert message is not None and message[:1] == ACK
+        if SEQ.unpack_from(message, 1)[0] == last:
+            break
+    stream.close()
+    sock.close()
+
+
+def test_resent_batches_are_stored_once(collector, store, address):
+    client, other_client = os.urandom(16), os.urandom(16)
+
+    send(address, client, [(1, [1, 2]), (2, [3])])
+    # Reconnected without having seen the acknowledgement of batch 2
+    send(address, client, [(2, [3]), (3, [4])])
+    send(address, other_client, [(1, [5])])
+
+    assert sorted(returns(store)) == [1, 2, 3, 4, 5]
+    assert collector.records_stored == 5
+
+
+def test_logger_reconnects(store, address):
+    logger = CollectorLogger(address, batch_size=1, reconnect_interval=0.01, timeout=0.1)
+    logger.log(trace(0))
+    logger.flush()
+    assert returns(store) == []
+
+    _, stop = start_collector(store, address)
+    try:
+        logger.timeout = 5.0
+        logger.log(trace(1))
+        logger.flush()
+        assert returns(store) == [0, 1]
+        assert logger.dropped == 0
+    finally:
+        logger.close()
+        stop()
+
+
+def test_logger_drops_the_oldest_batches_past_max_pending(store, address):
+    logger = CollectorLogger(address, batch_size=1, max_pending=2, reconnect_interval=0.01)
+    for i in range(5):
+        logger.log(trace(i))
+    assert logger.dropped == 3
+
+    _, stop = start_collector(store, address)
+    try:
+        logger.close()
+        assert returns(store) == [3, 4]
+    finally:
+        stop()
@@ -0,0 +1,138 @@
+import array
+import dataclasses
+import math
+
+from goldenrun.compare import (CompareOptions, Difference, GoldenValue,
+                               compare_golden, differences,
+                               format_differences)
+from goldenrun.serialization import PickleCodec
+
+
+@dataclasses.dataclass
+class Order:
+    id: int
+    price: float
+    created_at: str
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def test_equal_values_have_no_differences():
+    value = {"orders": [Order(1, 9.99, "today")], "tags": {"a", "b"}, "nan": math.nan}
+    same = {"orders": [Order(1, 9.99, "today")], "tags": {"a", "b"}, "nan": math.nan}
+
+    assert differences(value, same) == []
+    assert differences(Point(1, 2), Point(1, 2)) == []
+
+
+def test_differences_have_paths():
+    expected = {"items": [1, 2, {"x": 1}], "name": "a", "gone": 0}
+    actual = {"items": [1, 3, {"x": 2}], "name": "a", "new": 0}
+
+    assert [d.path for d in differences(expected, actual)] == [
+        "return.gone",
+        "return.new",
+        "return.items.1",
+        "return.items.2.x",
+    ]
+    (difference,) = differences([1, 2], [1, 2, 3])
+    assert str(difference) == "return: expected 2 items, got 3"
+    (difference,) = differences(Point(1, 2), Point(1, 5))
+    assert difference == Difference("return.y", "expected 2, got 5")
+
+
+class Node:
+    def __init__(self, value, parent=None):
+        self.value = value
+        self.parent = parent
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+
+def tree(leaf):
+    root = Node("root")
+    Node(leaf, Node("branch", root))
+    return root
+
+
+def test_cyclic_values():
+    assert differences(tree(1), tree(1)) == []
+    assert [d.path for d in differences(tree(1), tree(2))] == ["return.children.0.children.0.value"]
+    cycle, other = [1], [1]
+    cycle.append(cycle)
+    other.append(other)
+    assert differences(cycle, other) == []
+
+
+def test_float_tolerance():
+    options = CompareOptions(rel_tol=1e-6)
+
+    assert differences(1.0, 1.0 + 1e-9) != []
+    assert differences(1.0, 1.0 + 1e-9, options) == []
+    assert differences([1.0, 2.0], [1.0, 2.1], options) != []
+    assert differences(Order(1, 9.99, "x"), Order(1, 9.99 + 1e-9, "x"), options) == []
+
+
+def test_ignored_paths():
+    options = CompareOptions(ignore=("*.created_at", "return.1"))
+    expected = [Order(1, 2.0, "monday"), "ignored", {"created_at": 1, "x": 1}]
+    actual = [Order(1, 2.0, "tuesday"), "other", {"x": 1}]
+
+    assert differences(expected, actual, options) == []
+    assert [d.path for d in differences(expected, actual)] == [
+        "return.0.created_at",
+        "return.1",
+        "return.2.created_at",
+    ]
+
+
+def test_differences_are_capped():
+    options = CompareOptions(max_differences=3)
+
+    found = differences(list(range(10)), list(range(1, 11)), options)
+
+    assert len(found) == 4
+    assert format_differences(found, 3).endswith("\n    ...")
+
+
+def test_buffers_are_compared_as_vectors():
+    expected = array.array("d", [1.0, 2.0, 3.0])
+
+    assert differences(expected, array.array("d", [1.0, 2.0, 3.0])) == []
+    assert differences(expected, array.array("d", [1.0, 2.0, 3.0 + 1e-12])) != []
+    options = CompareOptions(abs_tol=1e-9)
+    assert differences(expected, array.array("d", [1.0, 2.0, 3.0 + 1e-12]), options) == []
+    (difference,) = differences(expected, array.array("i", [1, 2, 3]))
+    assert "shape" in difference.detail
+
+
+class Unpicklable:
+    def __reduce__(self):
+        raise TypeError("no")
+
+
+class CountingCodec(PickleCodec):
+    def __init__(self):
+        super().__init__()
+        self.decoded = 0
+
+    def decode(self, data):
+        self.decoded += 1
+        return super().decode(data)
+
+
+def test_compare_golden_short_circuits_on_equal_encodings():
+    codec = CountingCodec()
+
+    assert compare_golden(GoldenValue(codec.encode({"a": [1, 2]}), codec), {"a": [1, 2]}) == []
+    assert codec.decoded == 0
+    golden = GoldenValue(codec.encode({"a": [1, 2]}), codec)
+    assert [d.path for d in compare_golden(golden, {"a": [1, 3]})] == ["return.a.1"]
+    assert codec.decoded == 1
+    # Values that can't be encoded are compared with the decoded recorded value
+    assert compare_golden(GoldenValue(codec.encode(None), codec), Unpicklable()) != []
@@ -0,0 +1,127 @@
+import os
+import sysconfig
+
+import pytest
+
+from goldenrun.config import CompiledCodeFilter, Config, DefaultConfig
+from goldenrun.db.base import (BACKPRESSURE_DROP_OLDEST, NO_RETENTION,
+                               AsyncFuncRecordStoreLogger, AsyncLogProfile,
+                               FuncRecordStoreLogger, parse_async_log_profile)
+from goldenrun.db.binlog import DEFAULT_LOG_PROFILE
+from goldenrun.db.sqlite import DEFAULT_PROFILE, SQLiteStore
+from goldenrun.serialization import DEFAULT_CODEC
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setenv(DefaultConfig.DB_PATH_VAR, str(tmp_path / "records.sqlite3"))
+    monkeypatch.delenv(DefaultConfig.COLLECTOR_VAR, raising=False)
+    monkeypatch.delenv(DefaultConfig.ASYNC_LOG_VAR, raising=False)
+    return DefaultConfig()
+
+
+class MinimalConfig(Config):
+    def __init__(self, path):
+        self.path = path
+
+    def trace_store(self):
+        return SQLiteStore.make_store(self.path)
+
+
+def test_config_hooks_have_defaults(tmp_path):
+    config = MinimalConfig(str(tmp_path / "records.sqlite3"))
+
+    assert config.codec() is DEFAULT_CODEC
+    assert config.sqlite_profile() == DEFAULT_PROFILE
+    assert config.log_profile() == DEFAULT_LOG_PROFILE
+    assert config.record_dedupe() is None
+    assert config.retention() == NO_RETENTION
+    assert config.async_log_profile() is None
+    assert isinstance(config.trace_logger(), FuncRecordStoreLogger)
+
+
+def test_trace_logger_is_synchronous_by_default(config):
+    assert config.async_log_profile() is None
+    assert isinstance(config.trace_logger(), FuncRecordStoreLogger)
+
+
+def test_trace_logger_is_asynchronous_when_configured(config, monkeypatch):
+    monkeypatch.setenv(
+        DefaultConfig.ASYNC_LOG_VAR,
+        "backpressure=drop-oldest,flush_size=50,flush_interval=0.5",
+    )
+
+    logger = config.trace_logger()
+    try:
+        assert isinstance(logger, AsyncFuncRecordStoreLogger)
+        assert logger.backpressure == BACKPRESSURE_DROP_OLDEST
+        assert logger.flush_size == 50
+        assert logger.flush_interval == 0.5
+        assert logger.max_queue_size == AsyncLogProfile().max_queue_size
+    finally:
+        logger.close()
+
+
+def test_parse_async_log_profile():
+    assert parse_async_log_profile("1") == AsyncLogProfile()
+    assert parse_async_log_profile("max-queue-size=10") == AsyncLogProfile(max_queue_size=10)
+    with pytest.raises(ValueError):
+        parse_async_log_profile("backpressure=wait")
+    with pytest.raises(ValueError):
+        parse_async_log_profile("flush_every=3")
+
+
+def code(filename):
+    return compile("pass", filename, "exec")
+
+
+def test_code_filter_excludes_lib_paths():
+    code_filter = CompiledCodeFilter(["/usr/lib/python3"])
+
+    assert code_filter(code("/srv/app/views.py"))
+    assert not code_filter(code("/usr/lib/python3/json/decoder.py"))
+    assert not code_filter(code("<string>"))
+    # A sibling directory sharing the prefix isn't a lib path
+    assert code_filter(code("/usr/lib/python3-extra/mod.py"))
+    # Decisions are cached per file name
+    assert code_filter.decisions["/srv/app/views.py"] is True
+
+
+def test_code_filter_globs():
+    code_filter = CompiledCodeFilter(
+        ["/venv/lib"],
+        include=["/venv/lib/*/vendored/*"],
+        exclude=["*/migrations/*", "/venv/lib/*/vendored/tests/*"],
+    )
+
+    assert code_filter(code("/srv/app/models.py"))
+    assert not code_filter(code("/srv/app/migrations/0001.py"))
+    assert code_filter(code("/venv/lib/pkg/vendored/mod.py"))
+    assert not code_filter(code("/venv/lib/pkg/vendored/tests/test_mod.py"))
+    assert not code_filter(code("/venv/lib/pkg/mod.py"))
+
+
+def test_code_filter_trace_modules():
+    code_filter = CompiledCodeFilter(["/venv/lib"], trace_modules=["pkg", "single"])
+
+    assert code_filter(code("/venv/lib/pkg/sub/mod.py"))
+    assert code_filter(code("/venv/lib/single.py"))
+    assert code_filter(code("/srv/pkg/mod.py"))
+    assert not code_filter(code("/venv/lib/other/mod.py"))
+    # Only names below the lib path count
+    code_filter = CompiledCodeFilter(["/home/pkg/venv"], trace_modules=["pkg"])
+    assert not code_filter(code("/home/pkg/venv/other/mod.py"))
+
+
+def test_code_filter_from_environment(monkeypatch):
+    stdlib_file = os.path.join(sysconfig.get_path("stdlib"), "json", "decoder.py")
+    monkeypatch.delenv("GOLDENRUN_TRACE_MODULES", raising=False)
+
+    code_filter = CompiledCodeFilter.from_environment()
+    assert not code_filter(code(stdlib_file))
+    assert code_filter(code(__file__))
+
+    monkeypatch.setenv("GOLDENRUN_TRACE_MODULES", "json,goldenrun")
+    code_filter = CompiledCodeFilter.from_environment()
+    assert code_filter(code(stdlib_file))
+    assert not code_filter(code(__file__))
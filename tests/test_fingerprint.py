@@ -0,0 +1,76 @@
+from goldenrun.db.base import FuncRecordStoreLogger
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.fingerprint import function_fingerprint
+from goldenrun.tracing import record, trace_calls
+from tests.conftest import in_tests
+
+SOURCE = """
+LIMIT = 10
+
+def helper(x):
+    return x + 1
+
+def func(x):
+    return min(helper(x), LIMIT)
+"""
+
+
+def define(source, filename="/srv/app/mod.py"):
+    namespace = {"__name__": "mod"}
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace
+
+
+def fingerprint(source, code_filter=None, **options):
+    return function_fingerprint(define(source, **options)["func"], code_filter)
+
+
+def test_fingerprint_ignores_file_names_and_line_numbers():
+    assert fingerprint(SOURCE) == fingerprint("\n\n# moved\n" + SOURCE, filename="/tmp/other.py")
+
+
+def test_fingerprint_follows_code_constants_and_callees():
+    original = fingerprint(SOURCE)
+
+    assert fingerprint(SOURCE.replace("min(", "max(")) != original
+    assert fingerprint(SOURCE.replace("LIMIT = 10", "LIMIT = 11")) != original
+    assert fingerprint(SOURCE.replace("x + 1", "x + 2")) != original
+    # Callees that the code filter rejects are left out
+    def only_func(code):
+        return code.co_name == "func"
+
+    assert fingerprint(SOURCE.replace("x + 1", "x + 2"), only_func) == fingerprint(
+        SOURCE, only_func
+    )
+
+
+def make_scaler(factor):
+    def scale(x, factor=factor):
+        return x * factor
+
+    return scale
+
+
+def test_functions_sharing_code_differ_by_their_defaults():
+    assert make_scaler(2).__code__ is make_scaler(3).__code__
+    assert function_fingerprint(make_scaler(2)) != function_fingerprint(make_scaler(3))
+    assert function_fingerprint(make_scaler(2)) == function_fingerprint(make_scaler(2))
+
+
+def test_fingerprint_of_functions_without_code():
+    assert function_fingerprint(len) is None
+
+
+@record
+def scaled(x):
+    return x * 3
+
+
+def test_fingerprints_are_stored_with_records(tmp_path):
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests):
+        scaled(1)
+
+    (module,) = store.list_modules()
+    assert store.get_fingerprint(module, "scaled") == function_fingerprint(scaled, in_tests)
+    assert store.get_fingerprint(module, "unknown") is None
@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from goldenrun.bench import HEAVY_MODULES, BenchOptions, bench_import
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_modules(statement):
+    """Run statement in a fresh interpreter, and return the HEAVY_MODULES it loaded."""
+    probe = "\n".join(
+        [
+            "import sys",
+            statement,
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))",
+        ]
+    )
+    env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+    process = subprocess.run(
+        [sys.executable, "-c", probe], env=env, capture_output=True, text=True, check=True
+    )
+    output = process.stdout.strip()
+    return output.split(",") if output else []
+
+
+@pytest.mark.parametrize(
+    "statement",
+    [
+        "import goldenrun",
+        "import goldenrun.cli",
+        "import goldenrun.config",
+        "import goldenrun.db",
+    ],
+)
+def test_imports_are_lazy(statement):
+    assert loaded_modules(statement) == []
+
+
+def test_lib_paths_are_computed_on_first_use():
+    statement = "import goldenrun.config as c; c.default_code_filter(compile('', 'x.py', 'exec'))"
+    assert loaded_modules(statement) == ["pathlib", "sysconfig"]
+
+
+def test_import_suite_reports_heavy_modules():
+    results = {result.name: result for result in bench_import(BenchOptions(repeat=1))}
+
+    assert set(results) == {"goldenrun", "goldenrun.cli"}
+    for result in results.values():
+        assert result.metrics["heavy_modules"] == 0
+        assert result.seconds > 0
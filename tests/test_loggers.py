@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+from goldenrun.db.base import (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_NEWEST,
+                               BACKPRESSURE_DROP_OLDEST,
+                               AsyncFuncRecordStoreLogger, FuncRecordStore,
+                               FuncRecordStoreLogger)
+from goldenrun.tracing import FuncRecord
+
+
+class MemoryStore(FuncRecordStore):
+    """Keeps added records in a list, optionally blocking the first write until
+    `release` is set."""
+
+    def __init__(self, block: bool = False) -> None:
+        self.records = []
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def add(self, traces):
+        self.add_serialized(self.serialize_all(traces))
+
+    def add_serialized(self, records):
+        self.writing.set()
+        self.release.wait()
+        self.records.extend(records)
+
+    def get_records(self, func_qualname, limit=2000, offset=0, module=None, since=None, until=None):
+        return iter(())
+
+    def returns(self):
+        return [self.codec.decode(record.serialized_return) for record in self.records]
+
+
+def trace(i):
+    return FuncRecord.from_stored("mod", "func", {"i": i}, i)
+
+
+def test_store_logger_stores_on_flush():
+    store = MemoryStore()
+    logger = FuncRecordStoreLogger(store)
+    logger.log(trace(0))
+    logger.log(trace(1))
+    assert store.records == []
+
+    logger.flush()
+    assert store.returns() == [0, 1]
+
+
+def test_async_logger_stores_in_batches():
+    store = MemoryStore()
+    logger = AsyncFuncRecordStoreLogger(store, flush_size=10, flush_interval=60)
+    try:
+        for i in range(25):
+            logger.log(trace(i))
+        logger.flush()
+        assert store.returns() == list(range(25))
+        assert logger.dropped == 0
+    finally:
+        logger.close()
+
+
+@pytest.mark.parametrize(
+    "backpressure, stored",
+    [
+        (BACKPRESSURE_DROP_NEWEST, [0, 1, 2]),
+        (BACKPRESSURE_DROP_OLDEST, [0, 3, 4]),
+    ],
+)
+def test_async_logger_backpressure(backpressure, stored):
+    store = MemoryStore(block=True)
+    logger = AsyncFuncRecordStoreLogger(
+        store, max_queue_size=2, flush_size=1, backpressure=backpressure
+    )
+    try:
+        logger.log(trace(0))
+        # The writer is stuck storing the first record, the others queue up
+        assert store.writing.wait(5)
+        for i in range(1, 5):
+            logger.log(trace(i))
+        assert logger.dropped == 2
+        store.release.set()
+        logger.flush()
+        assert store.returns() == stored
+    finally:
+        store.release.set()
+        logger.close()
+
+
+@pytest.mark.parametrize("method", ["flush", "close"])
+def test_async_logger_never_drops_flush_and_close_requests(method):
+    store = MemoryStore(block=True)
+    logger = AsyncFuncRecordStoreLogger(
+        store, max_queue_size=2, flush_size=1, backpressure=BACKPRESSURE_DROP_OLDEST
+    )
+    try:
+        logger.log(trace(0))
+        assert store.writing.wait(5)
+        waiting = threading.Thread(target=getattr(logger, method), daemon=True)
+        waiting.start()
+        # Flood the full queue while the request waits behind the stuck writer
+        for i in range(1, 100):
+            logger.log(trace(i))
+        store.release.set()
+        waiting.join(5)
+        assert not waiting.is_alive()
+        assert logger.dropped > 0
+    finally:
+        store.release.set()
+        logger.close()
+
+
+def test_async_logger_rejects_unknown_backpressure():
+    with pytest.raises(ValueError):
+        AsyncFuncRecordStoreLogger(MemoryStore(), backpressure="wait")
+    logger = AsyncFuncRecordStoreLogger(MemoryStore(), backpressure=BACKPRESSURE_BLOCK)
+    logger.close()
@@ -0,0 +1,150 @@
+import asyncio
+import functools
+import threading
+from types import CodeType
+
+import goldenrun.tracing
+from goldenrun.db.base import FuncRecordStoreLogger
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.replay import RecordedCalls
+from goldenrun.serialization import Unserializable
+from goldenrun.tracing import RECORDED_CODE, record, trace_calls
+from tests.conftest import in_tests
+
+
+def in_tests_or_goldenrun(code: CodeType) -> bool:
+    """Code filter also letting through the wrappers `@record` returns."""
+    return in_tests(code) or code.co_filename == goldenrun.tracing.__file__
+
+
+@record
+def boom(x):
+    raise ValueError(f"bad {x}")
+
+
+@record
+def outer():
+    try:
+        boom(3)
+    except ValueError:
+        pass
+    return 1
+
+
+class Client:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def query(self, sql):
+        return [sql]
+
+
+client = Client()
+
+
+@record
+def handler():
+    return client.query("select 1")
+
+
+@record
+def good(x):
+    return x + 1
+
+
+def test_wrappers_are_not_traced(tracing):
+    with tracing(code_filter=in_tests_or_goldenrun) as logger:
+        assert outer() == 1
+
+    assert [(t.qualname, t.exception and t.exception.type) for t in logger.traces] == [
+        ("boom", "ValueError"),
+        ("outer", None),
+    ]
+    (trace,) = logger.by_name("outer")
+    assert [child.qualname for child in trace.children] == ["boom"]
+
+
+def test_unserializable_child_does_not_lose_the_batch(backend, tmp_path):
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests, backend=backend):
+        assert handler() == ["select 1"]
+        assert good(1) == 2
+
+    assert [thunk.to_trace().return_value for thunk in store.get_records("good")] == [2]
+    (trace,) = [thunk.to_trace() for thunk in store.get_records("handler")]
+    assert trace.return_value == ["select 1"]
+    (child,) = trace.children
+    assert child.qualname == "Client.query"
+    assert isinstance(child.args["self"], Unserializable)
+    assert child.args["sql"] == "select 1"
+
+
+def test_unserializable_top_level_trace_is_skipped(backend, tmp_path):
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+
+    @record
+    def locked(lock):
+        return 1
+
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests, backend=backend):
+        locked(threading.Lock())
+        good(1)
+
+    assert list(store.get_records("locked")) == []
+    assert len(list(store.get_records("good"))) == 1
+
+
+def test_unserializable_results_are_not_replayed(tracing):
+    placeholder = Unserializable("Client", "TypeError: cannot pickle")
+    with tracing() as logger:
+        good(1)
+    (call,) = logger.traces
+    call.return_value = placeholder
+
+    stub = RecordedCalls(good, [call])
+    assert stub(1) == 2
+
+
+@record
+async def ticks(n):
+    for i in range(n):
+        sent = yield i
+        if sent is not None:
+            yield sent
+
+
+async def consume_ticks():
+    values = [value async for value in ticks(3)]
+    agen = ticks(3)
+    first = await agen.__anext__()
+    echoed = await agen.asend("echo")
+    await agen.aclose()
+    return values, first, echoed
+
+
+def test_async_generators_are_recorded(tracing):
+    with tracing(lazy=True) as logger:
+        assert asyncio.run(consume_ticks()) == ([0, 1, 2], 0, "echo")
+
+    traces = logger.by_name("ticks")
+    assert traces
+    assert traces[0].args == {"n": 3}
+    assert traces[0].exception is None
+
+
+class Adder:
+    def __call__(self, a, b):
+        return a + b
+
+
+def test_callables_without_code_can_be_decorated(tracing):
+    recorded_code = set(RECORDED_CODE)
+    partial = record(functools.partial(good, 1))
+    instance = record(Adder())
+    builtin = record(sample_rate=0.5)(len)
+
+    with tracing():
+        assert partial() == 2
+        assert instance(1, 2) == 3
+        assert builtin([1, 2]) == 2
+    assert RECORDED_CODE == recorded_code
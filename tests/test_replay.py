@@ -0,0 +1,172 @@
+import sys
+
+import pytest
+
+import goldenrun.replay
+from goldenrun.db.base import FuncRecordStoreLogger
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.replay import (ERROR, FAILED, PASSED, SKIPPED, RecordedCalls,
+                              ReplayCache, ReplayEngine)
+from goldenrun.tracing import FuncRecord, record, trace_calls
+from tests.conftest import in_tests
+
+
+@record
+def double(x):
+    return 2 * x
+
+
+def double_changed(x):
+    return 2 * x + (x == 3)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(goldenrun.replay, "_functions", {})
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests):
+        for x in range(5):
+            double(x)
+    return store
+
+
+OFFLINE = False
+
+
+def expensive(x):
+    if OFFLINE:
+        raise ConnectionError("offline")
+    return x + 100
+
+
+class Prices:
+    @staticmethod
+    def lookup(x):
+        if OFFLINE:
+            raise ConnectionError("offline")
+        return x * 10
+
+
+@record
+def total(x):
+    return expensive(x) + Prices.lookup(x)
+
+
+def replay(store, cache=None):
+    engine = ReplayEngine(store, workers=1, cache=cache, code_filter=in_tests)
+    (result,) = engine.replay("double")
+    return result.counts
+
+
+def test_replay_passes(store):
+    counts = replay(store)
+
+    assert counts[PASSED] == 5
+    assert counts[FAILED] == 0
+
+
+def test_results_tell_functions_changed_since_recorded(store, monkeypatch):
+    engine = ReplayEngine(store, workers=1, code_filter=in_tests)
+    (result,) = engine.replay("double")
+    assert result.changed is False
+    assert "changed" not in str(result)
+
+    monkeypatch.setattr(goldenrun.replay, "_functions", {})
+    monkeypatch.setattr(sys.modules[__name__], "double", double_changed)
+    engine = ReplayEngine(store, workers=1, code_filter=in_tests)
+    (result,) = engine.replay("double")
+    assert result.changed is True
+    assert str(result).endswith("(changed since recorded)")
+
+
+def test_replay_fails_when_results_change(store, monkeypatch):
+    monkeypatch.setattr(sys.modules[__name__], "double", double_changed)
+
+    counts = replay(store)
+
+    assert counts[PASSED] == 4
+    assert counts[FAILED] == 1
+
+
+def test_parallel_replay(store):
+    (module,) = store.list_modules()
+    store.add([FuncRecord.from_stored(module, "double", {"x": 3}, 7)])
+    engine = ReplayEngine(store, workers=2, chunk_size=2, code_filter=in_tests)
+
+    (result,) = engine.replay("double")
+
+    assert (result.counts[PASSED], result.counts[FAILED]) == (5, 1)
+
+
+def test_incremental_replay(store, tmp_path, monkeypatch):
+    cache = ReplayCache(str(tmp_path / "cache.sqlite3"))
+
+    # Nothing passed yet, even though the code is the one recorded
+    assert replay(store, cache)[PASSED] == 5
+    assert replay(store, cache)[SKIPPED] == 5
+
+    monkeypatch.setattr(goldenrun.replay, "_functions", {})
+    monkeypatch.setattr(sys.modules[__name__], "double", double_changed)
+    counts = replay(store, cache)
+    assert (counts[PASSED], counts[FAILED], counts[SKIPPED]) == (4, 1, 0)
+
+    counts = replay(store, cache)
+    assert (counts[PASSED], counts[FAILED], counts[SKIPPED]) == (0, 1, 4)
+    cache.close()
+
+
+@pytest.mark.parametrize("workers, cached", [(1, False), (1, True), (2, False)])
+def test_functions_failing_to_import_are_errors(tmp_path, monkeypatch, workers, cached):
+    monkeypatch.setattr(goldenrun.replay, "_functions", {})
+    source = "def f(x):\n    return x\n\nraise ImportError('no')\n"
+    (tmp_path / "broken_module.py").write_text(source)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    store.add([FuncRecord.from_stored("broken_module", "f", {"x": x}, x) for x in range(3)])
+    cache = ReplayCache(str(tmp_path / "cache.sqlite3")) if cached else None
+    engine = ReplayEngine(store, workers=workers, cache=cache)
+
+    (result,) = engine.replay("f")
+
+    assert result.counts[ERROR] == 3
+    assert result.failures[0].detail == "cannot load function: ImportError: no"
+
+
+@pytest.mark.parametrize(
+    "mock, passed",
+    [((), 0), (["*:expensive"], 0), (["*:expensive", "*:Prices.lookup"], 3)],
+)
+def test_replay_mocks_recorded_children(tmp_path, monkeypatch, mock, passed):
+    monkeypatch.setattr(goldenrun.replay, "_functions", {})
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests):
+        for x in range(3):
+            total(x)
+    (trace,) = [thunk.to_trace() for thunk in store.get_records("total", limit=1)]
+    assert [child.qualname for child in trace.children] == ["expensive", "Prices.lookup"]
+
+    monkeypatch.setattr(sys.modules[__name__], "OFFLINE", True)
+    engine = ReplayEngine(store, workers=1, mock=mock, code_filter=in_tests)
+    (result,) = engine.replay("total")
+
+    # The real functions raise
+    assert (result.counts[PASSED], result.counts[ERROR]) == (passed, 3 - passed)
+    # The mocked functions are restored
+    assert expensive.__name__ == "expensive" and not hasattr(expensive, "__wrapped__")
+    with pytest.raises(ConnectionError):
+        Prices.lookup(1)
+
+
+def test_recorded_calls_are_used_up():
+    calls = [
+        FuncRecord.from_stored("mod", "expensive", {"x": 1}, "first"),
+        FuncRecord.from_stored("mod", "expensive", {"x": 1}, "second"),
+        FuncRecord.from_stored("mod", "expensive", {"x": 2}, None, yields=[1], yield_count=2),
+    ]
+    stub = RecordedCalls(expensive, calls)
+
+    assert stub(1) == "first"
+    assert stub(x=1) == "second"
+    # Used up, or the recorded generator wasn't kept whole: the real function runs
+    assert stub(1) == 101
+    assert stub(2) == 102
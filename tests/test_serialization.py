@@ -0,0 +1,111 @@
+import array
+import pickle
+import threading
+
+import pytest
+
+from goldenrun.serialization import (DEFAULT_CODEC, CompressedCodec,
+                                     OutOfBandPickleCodec, PickleCodec,
+                                     Unserializable, get_codec)
+
+VALUES = [
+    None,
+    1,
+    "text",
+    {"a": [1, 2.5]},
+    b"abc" * 1000,
+    bytearray(b"abc" * 1000),
+    array.array("d", range(1000)),
+]
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [
+        PickleCodec(),
+        OutOfBandPickleCodec(),
+        CompressedCodec(PickleCodec(), "zlib"),
+        CompressedCodec(OutOfBandPickleCodec(), "lzma", level=1),
+        DEFAULT_CODEC,
+    ],
+    ids=lambda codec: codec.tag,
+)
+@pytest.mark.parametrize("value", VALUES, ids=lambda value: type(value).__name__)
+def test_round_trip(codec, value):
+    assert codec.decode(codec.encode(value)) == value
+    assert get_codec(codec.tag).decode(codec.encode(value)) == value
+
+
+@pytest.mark.parametrize(
+    "codec",
+    [OutOfBandPickleCodec(), CompressedCodec(OutOfBandPickleCodec(), "zlib")],
+    ids=lambda codec: codec.tag,
+)
+@pytest.mark.parametrize(
+    "view",
+    [memoryview(b"abc"), memoryview(b"abc" * 1000), memoryview(b"abc" * 1000)[::2]],
+    ids=["small", "large", "strided"],
+)
+def test_memoryview_round_trip(codec, view):
+    decoded = codec.decode(codec.encode(view))
+    assert isinstance(decoded, memoryview)
+    assert decoded == view
+
+
+def test_out_of_band_buffers_are_not_copied_into_the_pickle():
+    codec = OutOfBandPickleCodec()
+    data = bytearray(b"x" * 100)
+
+    assert codec.encode(data) == pickle.dumps(data, protocol=5)
+    header, pickled, buffer = codec.encode_parts(pickle.PickleBuffer(data))
+    assert len(pickled) < len(data)
+    assert bytes(buffer) == data
+    assert codec.decode(b"".join([header, pickled, buffer])) == data
+
+    values = array.array("d", range(1000))
+    view = memoryview(values)
+    header, pickled, view_buffer, array_buffer = codec.encode_parts({"v": view, "a": values})
+    assert len(pickled) < 200
+    assert bytes(view_buffer) == bytes(array_buffer) == values.tobytes()
+    decoded = codec.decode(codec.encode({"v": view, "a": values}))
+    assert decoded["v"].format == "d" and decoded["v"].tolist() == values.tolist()
+    assert decoded["a"] == values
+    # bytes can't be taken out of the stream, the pickler copies them in
+    assert codec.encode_parts(b"x" * 5000) == [pickle.dumps(b"x" * 5000, protocol=5)]
+
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_only_large_values_are_compressed(compression):
+    codec = CompressedCodec(PickleCodec(), compression, threshold=100)
+    small = "x" * 10
+    large = "x" * 1000
+
+    assert codec.encode(small) == b"\x00" + pickle.dumps(small)
+    assert len(codec.encode(large)) < len(pickle.dumps(large))
+    assert codec.decode(codec.encode(large)) == large
+
+
+def test_get_codec():
+    assert isinstance(get_codec(None), PickleCodec)
+    assert get_codec("zlib+pickle5") is get_codec("zlib+pickle5")
+    assert get_codec(DEFAULT_CODEC.tag).tag == DEFAULT_CODEC.tag
+    with pytest.raises(ValueError):
+        get_codec("json")
+    with pytest.raises(ValueError):
+        CompressedCodec(PickleCodec(), "bz2")
+
+
+def test_unserializable():
+    lock = threading.Lock()
+    try:
+        pickle.dumps(lock)
+    except TypeError as exc:
+        placeholder = Unserializable.of(lock, exc)
+
+    decoded = pickle.loads(pickle.dumps(placeholder))
+    assert isinstance(decoded, Unserializable)
+    assert decoded.type_name == "lock"
+    assert decoded.error.startswith("TypeError")
+    # Never equal to anything else, not even an identical placeholder
+    assert decoded != placeholder
+    assert "unserializable lock" in repr(decoded)
@@ -0,0 +1,182 @@
+import inspect
+import io
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+
+from goldenrun.db.sqlite import (DEDUPE_COUNT, DEDUPE_DISTINCT,
+                                 DEFAULT_PROFILE, ShardedSQLiteStore,
+                                 SQLiteProfile, SQLiteStore, find_shards,
+                                 shard_path)
+from goldenrun.cli import main
+from goldenrun.config import DefaultConfig
+from goldenrun.db.base import SerializedFuncRecord
+from goldenrun.tracing import FuncRecord
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "records.sqlite3")
+
+
+def traces(count, funcs=3):
+    return [
+        FuncRecord.from_stored("mod", f"func_{i % funcs}", {"i": i}, i) for i in range(count)
+    ]
+
+
+def test_batched_writes(path, monkeypatch):
+    monkeypatch.setattr(SQLiteStore, "BATCH_SIZE", 4)
+    store = SQLiteStore.make_store(path)
+
+    store.add(traces(10))
+    store.add(traces(5))
+
+    assert sorted(store.func_ids) == [("mod", "func_0"), ("mod", "func_1"), ("mod", "func_2")]
+    rows = store.conn.execute("SELECT COUNT(*) FROM goldenrun_func").fetchone()
+    assert rows == (3,)
+    returns = [thunk.to_trace().return_value for thunk in store.get_records("func_1")]
+    assert returns == [1, 4, 7, 1, 4]
+
+
+def test_profile_is_applied(path):
+    store = SQLiteStore.make_store(path)
+
+    assert store.conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    # NORMAL
+    assert store.conn.execute("PRAGMA synchronous").fetchone() == (1,)
+    assert store.read_conn is not store.conn
+    with pytest.raises(Exception, match="readonly"):
+        store.read_conn.execute("CREATE TABLE t (x)")
+
+
+def test_profile_without_read_only_readers(path):
+    profile = DEFAULT_PROFILE._replace(journal_mode="delete", read_only_readers=False)
+    store = SQLiteStore.make_store(path, profile)
+
+    assert store.conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    assert store.read_conn is store.conn
+
+
+@pytest.mark.parametrize(
+    "profile", [SQLiteProfile(journal_mode="fast"), SQLiteProfile(synchronous="always")]
+)
+def test_invalid_profiles_are_rejected(path, profile):
+    with pytest.raises(ValueError):
+        SQLiteStore.make_store(path, profile)
+
+
+def count(store, table):
+    return store.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def test_large_values_are_stored_once(path):
+    store = SQLiteStore.make_store(path)
+    large = "x" * 1000
+
+    store.add([FuncRecord.from_stored("mod", "func", {"i": i}, large) for i in range(3)])
+    store.add([FuncRecord.from_stored("mod", "func", {"i": 0}, 1)])
+
+    assert count(store, "goldenrun_record") == 4
+    # Only the large return value is referenced, the small ones are inlined
+    assert count(store, "goldenrun_blob") == 1
+    inlined = store.conn.execute(
+        "SELECT COUNT(*) FROM goldenrun_record WHERE serialized_return IS NOT NULL"
+    ).fetchone()
+    assert inlined == (1,)
+    returns = [thunk.to_trace().return_value for thunk in store.get_records("func")]
+    assert returns == [large, large, large, 1]
+
+
+@pytest.mark.parametrize(
+    "dedupe, occurrences",
+    [(None, [1, 1, 1, 1, 1]), (DEDUPE_DISTINCT, [1, 1]), (DEDUPE_COUNT, [3, 2])],
+)
+def test_dedupe(path, dedupe, occurrences):
+    store = SQLiteStore.make_store(path, dedupe=dedupe)
+
+    store.add([FuncRecord.from_stored("mod", "func", {"i": i % 2}, i % 2) for i in range(4)])
+    store.add([FuncRecord.from_stored("mod", "func", {"i": 0}, 0)])
+
+    rows = store.conn.execute(
+        "SELECT occurrences FROM goldenrun_record ORDER BY rowid"
+    ).fetchall()
+    assert [row[0] for row in rows] == occurrences
+    returns = [thunk.to_trace().return_value for thunk in store.get_records("func")]
+    assert returns == ([0, 1, 0, 1, 0] if dedupe is None else [0, 1])
+
+
+def test_unknown_dedupe_mode_is_rejected(path):
+    with pytest.raises(ValueError):
+        SQLiteStore.make_store(path, dedupe="first")
+
+
+def test_get_records_streams_thunks(path, monkeypatch):
+    monkeypatch.setattr(SQLiteStore, "FETCH_SIZE", 2)
+    store = SQLiteStore.make_store(path)
+    store.add(traces(7, funcs=1))
+    store.add_serialized(
+        [SerializedFuncRecord("mod", "func_0", datetime.now(), b"corrupt", b"corrupt")]
+    )
+
+    records = store.get_records("func_0", limit=None)
+    assert inspect.isgenerator(records)
+    thunks = list(records)
+    assert len(thunks) == 8
+    # Values are only decoded when asked for
+    assert [thunk.to_trace().return_value for thunk in thunks[:-1]] == list(range(7))
+    with pytest.raises(Exception):
+        thunks[-1].to_trace()
+
+    returns = [thunk.to_trace().return_value for thunk in store.get_records("func_0", 3, 2)]
+    assert returns == [2, 3, 4]
+    assert list(store.get_records("unknown")) == []
+
+
+def write_shard(store, funcs):
+    store.add([FuncRecord.from_stored("mod", func, {"pid": os.getpid()}, func) for func in funcs])
+
+
+def test_processes_write_their_own_shards(path):
+    store = ShardedSQLiteStore.make_store(path)
+    write_shard(store, ["a", "b"])
+    context = multiprocessing.get_context("fork")
+    # Functions are added in another order, so their ids differ between shards
+    child = context.Process(target=write_shard, args=(store, ["b", "c"]))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+
+    shards = find_shards(path)
+    assert shard_path(path, os.getpid()) in shards
+    assert len(shards) == 2
+    assert not os.path.exists(path)
+
+    merged = store.merged
+    assert sum(merged.merge_shard(shard) for shard in shards) == 4
+    returns = {
+        func: [thunk.to_trace().return_value for thunk in merged.get_records(func)]
+        for func in "abc"
+    }
+    assert returns == {"a": ["a"], "b": ["b", "b"], "c": ["c"]}
+    rows = merged.conn.execute("SELECT COUNT(*) FROM goldenrun_func").fetchone()
+    assert rows == (3,)
+
+
+def test_merge_command(path, monkeypatch):
+    monkeypatch.setenv(DefaultConfig.DB_PATH_VAR, path)
+    monkeypatch.setenv(DefaultConfig.SHARDED_VAR, "1")
+    for pid in (1, 2):
+        shard = SQLiteStore.make_store(shard_path(path, pid))
+        shard.add(traces(4, funcs=2))
+        shard.conn.close()
+    stdout = io.StringIO()
+
+    assert main(["merge"], stdout, io.StringIO()) == 0
+    assert f"Merged 8 records from 2 shards into {path}" in stdout.getvalue()
+    assert find_shards(path) == []
+    store = SQLiteStore.make_store(path)
+    returns = [thunk.to_trace().return_value for thunk in store.get_records("func_0")]
+    assert returns == [0, 2, 0, 2]
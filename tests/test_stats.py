@@ -0,0 +1,97 @@
+import io
+import json
+
+import pytest
+
+from goldenrun.cli import main
+from goldenrun.db.base import FuncRecordStoreLogger
+from goldenrun.db.sqlite import SQLiteStore
+from goldenrun.stats import Stats, disable_stats, enable_stats, get_stats
+from goldenrun.tracing import record, trace_calls
+from tests.conftest import in_tests
+
+
+@pytest.fixture
+def stats():
+    stats = enable_stats()
+    yield stats
+    disable_stats()
+
+
+@record
+def encode(x):
+    return json.dumps(x)
+
+
+def test_stats_round_trip():
+    stats = Stats()
+    stats.calls_seen = 10
+    stats.add_flush(5)
+    stats.add_flush(3)
+    other = Stats()
+    other.calls_seen = 1
+    other.add_flush(7)
+
+    stats.update(other)
+    f = io.StringIO()
+    stats.dump(f)
+    f.seek(0)
+    loaded = Stats.load(f)
+
+    assert loaded.to_dict() == stats.to_dict()
+    assert (loaded.calls_seen, loaded.flushes, loaded.flush_ns, loaded.max_flush_ns) == (
+        11,
+        3,
+        15,
+        7,
+    )
+    assert set(stats.to_dict()) == set(Stats.__slots__)
+    assert "calls seen" in stats.report()
+    assert "code filter time" in stats.report()
+    assert "function lookup time" in stats.report()
+
+
+def test_stats_are_counted_while_recording(stats, backend, tmp_path):
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests, backend=backend):
+        for i in range(3):
+            encode({"i": i})
+
+    assert stats.records_captured == 3
+    assert stats.records_stored == 3
+    assert stats.store_batches == 1
+    assert stats.flushes == 1
+    assert stats.calls_seen >= 3
+    # json.dumps isn't traced
+    assert stats.calls_filtered >= 1
+    assert stats.cache_misses >= 1
+    assert stats.cache_hits >= 2
+    assert stats.bytes_serialized > 0
+    assert stats.filter_ns > 0
+    assert stats.get_func_ns > 0
+
+
+def test_stats_are_off_by_default(tmp_path):
+    assert get_stats() is None
+    store = SQLiteStore.make_store(str(tmp_path / "records.sqlite3"))
+    with trace_calls(FuncRecordStoreLogger(store), code_filter=in_tests):
+        encode(1)
+    assert get_stats() is None
+    assert store.stats is None
+
+
+def test_stats_command_adds_up_files(tmp_path):
+    paths = []
+    for i in (1, 2):
+        stats = Stats()
+        stats.records_captured = i
+        path = tmp_path / f"stats-{i}.json"
+        with open(path, "w", encoding="utf-8") as f:
+            stats.dump(f)
+        paths.append(str(path))
+    stdout = io.StringIO()
+
+    assert main(["stats", *paths], stdout, io.StringIO()) == 0
+    expected = Stats()
+    expected.records_captured = 3
+    assert stdout.getvalue() == expected.report() + "\n"
@@ -0,0 +1,179 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from goldenrun.db.base import (NO_RETENTION, FuncRecordStore,
+                               RetentionPolicy, SerializedFuncRecord)
+from goldenrun.db.binlog import BinaryLogStore
+from goldenrun.db.sqlite import ShardedSQLiteStore, SQLiteStore, find_shards
+from goldenrun.serialization import PickleCodec
+from goldenrun.tracing import FuncRecord, RaisedException
+
+STORES = ["sqlite", "sharded", "binlog"]
+
+
+@pytest.fixture(params=STORES)
+def make_store(request, tmp_path):
+    """Return a function creating a store of each kind with a retention policy."""
+    stores = []
+
+    def make_store(retention: RetentionPolicy = NO_RETENTION) -> FuncRecordStore:
+        path = str(tmp_path / "records.db")
+        if request.param == "sqlite":
+            store = SQLiteStore.make_store(path, retention=retention)
+        elif request.param == "sharded":
+            store = ShardedSQLiteStore.make_store(path, retention=retention)
+        else:
+            store = BinaryLogStore.make_store(path, retention=retention)
+        stores.append(store)
+        return store
+
+    yield make_store
+    for store in stores:
+        if isinstance(store, BinaryLogStore):
+            store.close()
+
+
+@pytest.fixture
+def store(make_store):
+    return make_store()
+
+
+def readable(store: FuncRecordStore) -> FuncRecordStore:
+    """Merge the shards of a sharded store, so its records can be read."""
+    if isinstance(store, ShardedSQLiteStore):
+        for shard in find_shards(store.path):
+            store.merged.merge_shard(shard)
+    return store
+
+
+def test_round_trip(store):
+    child = FuncRecord.from_stored("mod", "helper", {"x": 1}, 2)
+    traces = [
+        FuncRecord.from_stored("mod", "func", {"a": 1, "b": [1, 2]}, {"sum": 3}),
+        FuncRecord.from_stored(
+            "mod", "func", {"a": 2, "b": []}, None,
+            exception=RaisedException("ValueError", "empty"),
+        ),
+        FuncRecord.from_stored("mod", "gen", {"n": 5}, None, yields=[0, 1], yield_count=5),
+        FuncRecord.from_stored("mod", "parent", {}, 2, children=[child]),
+    ]
+    store.add(traces)
+
+    decoded = [thunk.to_trace() for thunk in readable(store).get_records("func")]
+    assert [(t.args, t.return_value, t.exception) for t in decoded] == [
+        ({"a": 1, "b": [1, 2]}, {"sum": 3}, None),
+        ({"a": 2, "b": []}, None, RaisedException("ValueError", "empty")),
+    ]
+    (gen,) = [thunk.to_trace() for thunk in store.get_records("gen")]
+    assert (gen.yields, gen.yield_count) == ([0, 1], 5)
+    (parent,) = [thunk.to_trace() for thunk in store.get_records("parent")]
+    (decoded_child,) = parent.children
+    assert (decoded_child.qualname, decoded_child.args, decoded_child.return_value) == (
+        "helper",
+        {"x": 1},
+        2,
+    )
+
+
+def test_get_records_filters(store):
+    now = datetime.now()
+    codec = PickleCodec()
+    store.add_serialized(
+        SerializedFuncRecord(
+            module,
+            "func",
+            now - timedelta(hours=hours),
+            codec.encode({"i": i}),
+            codec.encode(i),
+            codec.tag,
+        )
+        for i, (module, hours) in enumerate([("a", 3), ("b", 2), ("a", 1), ("a", 0)])
+    )
+    readable(store)
+
+    def returns(**query):
+        thunks = store.get_records("func", **query)
+        return [thunk.to_trace().return_value for thunk in thunks]
+
+    # Records of a function are returned in the order they were added, those
+    # of different modules in no particular order
+    assert sorted(returns()) == [0, 1, 2, 3]
+    assert returns(module="a") == [0, 2, 3]
+    assert returns(module="a", limit=2, offset=1) == [2, 3]
+    assert sorted(returns(since=now - timedelta(hours=2, minutes=30))) == [1, 2, 3]
+    assert sorted(returns(until=now - timedelta(minutes=30))) == [0, 1, 2]
+
+
+def test_list_modules(store):
+    now = datetime.now()
+    codec = PickleCodec()
+    store.add_serialized(
+        SerializedFuncRecord(
+            module, "func", now - timedelta(hours=hours), codec.encode({}), codec.encode(None)
+        )
+        for module, hours in [("old", 3), ("new", 0), ("middle", 2), ("old", 5)]
+    )
+
+    assert readable(store).list_modules() == ["new", "middle", "old"]
+
+
+def add_records(store, ages, size=10):
+    """Add a record of `func` per age in hours, returning its index."""
+    now = datetime.now()
+    codec = PickleCodec()
+    store.add_serialized(
+        SerializedFuncRecord(
+            "mod",
+            "func",
+            now - timedelta(hours=hours),
+            codec.encode({"i": i}),
+            codec.encode((i, "x" * size)),
+            codec.tag,
+        )
+        for i, hours in enumerate(ages)
+    )
+
+
+def kept(store):
+    return [thunk.to_trace().return_value[0] for thunk in store.get_records("func", limit=None)]
+
+
+def test_retention_max_records(make_store):
+    store = make_store(RetentionPolicy(max_records=5))
+    for _ in range(4):
+        add_records(store, [0] * 25)
+    store.add([FuncRecord.from_stored("mod", "other", {}, None)])
+
+    stats = readable(store).vacuum()
+
+    assert len(kept(store)) == 5
+    assert len(list(store.get_records("other"))) == 1
+    # SQLite databases sample calls as they are added, logs when vacuumed
+    assert stats.records_deleted == (95 if isinstance(store, BinaryLogStore) else 0)
+
+
+def test_retention_max_age(make_store):
+    store = make_store(RetentionPolicy(max_age=timedelta(hours=2)))
+    add_records(store, [5, 3, 1, 0])
+
+    stats = readable(store).vacuum()
+
+    assert stats.records_deleted == 2
+    assert kept(store) == [2, 3]
+
+
+def test_retention_max_bytes(make_store):
+    store = make_store()
+    add_records(store, [100 - i for i in range(100)], size=2000)
+    size = readable(store).vacuum().size_after
+    store = make_store(RetentionPolicy(max_bytes=size // 2))
+
+    stats = store.vacuum()
+
+    assert stats.size_before == size
+    assert stats.size_after <= size // 2
+    remaining = kept(store)
+    # The oldest records go first
+    assert 0 < len(remaining) <= 50
+    assert remaining == list(range(100 - len(remaining), 100))
@@ -0,0 +1,521 @@
+import asyncio
+import sys
+import threading
+
+import pytest
+
+import goldenrun.tracing
+from goldenrun.tracing import (BACKEND_MONITORING, BACKEND_SETPROFILE,
+                               FUNCTION_INDEX, HAS_MONITORING, SAMPLE_HASH,
+                               CallTracer, FuncRecord, FunctionIndex,
+                               MonitoringCallTracer, RaisedException, Sampler,
+                               get_module_name, make_tracer, module_name_from_path,
+                               record, trace_calls)
+from tests.conftest import ListLogger, in_tests
+
+
+class Config:
+    @property
+    def missing(self) -> int:
+        raise AttributeError("missing")
+
+
+@record
+def gen(n):
+    for i in range(n):
+        yield i
+
+
+@record
+def boom(x):
+    raise ValueError(f"bad {x}")
+
+
+def inner():
+    try:
+        boom(2)
+    except ValueError:
+        raise ValueError("wrapped")
+
+
+@record
+def outer():
+    try:
+        inner()
+    except ValueError:
+        pass
+    try:
+        {}["missing"]
+    except KeyError:
+        return "ok"
+
+
+@record
+def probe(config):
+    # hasattr swallows the AttributeError, it never reaches this frame
+    found = hasattr(config, "missing")
+    try:
+        {}["missing"]
+    except KeyError:
+        pass
+    return found
+
+
+def test_closed_generator_records_generator_exit(tracing):
+    with tracing() as logger:
+        g = gen(10)
+        next(g)
+        g.close()
+        try:
+            {}["missing"]
+        except KeyError:
+            pass
+        try:
+            boom(1)
+        except ValueError:
+            pass
+    (gen_trace,) = logger.by_name("gen")
+    assert gen_trace.yields == [0]
+    assert gen_trace.exception == RaisedException("GeneratorExit", "")
+    (boom_trace,) = logger.by_name("boom")
+    assert boom_trace.exception == RaisedException("ValueError", "bad 1")
+
+
+@record
+async def fetch(x):
+    await asyncio.sleep(0)
+    return x * 2
+
+
+def test_yields_and_coroutine_results_are_captured(tracing):
+    with tracing(max_yields=3) as logger:
+        assert list(gen(10)) == list(range(10))
+        assert list(gen(2)) == [0, 1]
+        assert asyncio.run(fetch(4)) == 8
+
+    long_trace, short_trace = logger.by_name("gen")
+    assert (long_trace.yields, long_trace.yield_count) == ([0, 1, 2], 10)
+    assert (short_trace.yields, short_trace.yield_count) == ([0, 1], 2)
+    assert long_trace.exception is None
+    (fetch_trace,) = logger.by_name("fetch")
+    assert (fetch_trace.args, fetch_trace.return_value) == ({"x": 4}, 8)
+    assert fetch_trace.yields is None
+
+
+@record
+def delegate(inner):
+    yield from inner
+    return "done"
+
+
+def test_yield_from_is_a_suspension(tracing):
+    with tracing() as logger:
+        assert list(delegate(iter([1, 2]))) == [1, 2]
+        with pytest.raises(ValueError):
+            list(delegate(boom(x) for x in [3]))
+
+    done_trace, raised_trace = logger.by_name("delegate")
+    assert (done_trace.yields, done_trace.return_value) == ([1, 2], "done")
+    assert done_trace.exception is None
+    assert raised_trace.exception == RaisedException("ValueError", "bad 3")
+
+
+def test_swallowed_exception_is_not_attributed_to_a_later_one(tracing):
+    with tracing() as logger:
+        assert probe(Config()) is False
+    (trace,) = logger.by_name("probe")
+    assert trace.exception is None
+    assert trace.return_value is False
+    for child in trace.children or []:
+        assert child.exception is None or child.exception.type == "AttributeError"
+
+
+def test_nested_try_except(tracing):
+    with tracing() as logger:
+        assert outer() == "ok"
+    (trace,) = logger.by_name("outer")
+    assert trace.exception is None
+    assert trace.return_value == "ok"
+    (inner_trace,) = [child for child in trace.children if child.qualname == "inner"]
+    assert inner_trace.exception == RaisedException("ValueError", "wrapped")
+    (boom_trace,) = inner_trace.children
+    assert boom_trace.exception == RaisedException("ValueError", "bad 2")
+
+
+def test_exceptions_are_attributed_per_thread(tracing):
+    barrier = threading.Barrier(4)
+
+    def work(i):
+        barrier.wait()
+        for _ in range(20):
+            try:
+                boom(i)
+            except ValueError:
+                pass
+
+    with tracing() as logger:
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    traces = logger.by_name("boom")
+    assert len(traces) == 80
+    for trace in traces:
+        assert trace.exception == RaisedException("ValueError", f"bad {trace.args['x']}")
+
+
+def test_only_recorded_functions_are_fingerprinted(tracing, monkeypatch):
+    fingerprinted = []
+
+    def function_fingerprint(func, code_filter):
+        fingerprinted.append(func.__qualname__)
+        return func.__qualname__.encode()
+
+    monkeypatch.setattr(goldenrun.tracing, "function_fingerprint", function_fingerprint)
+    with tracing() as logger:
+        outer()
+        outer()
+    assert sorted(fingerprinted) == ["boom", "outer"]
+    (trace, _) = logger.by_name("outer")
+    assert trace.fingerprint == b"outer"
+    (inner_trace,) = [child for child in trace.children if child.qualname == "inner"]
+    assert inner_trace.fingerprint is None
+
+
+def helper(x):
+    return x * 2
+
+
+def skipped(x):
+    return x
+
+
+@record
+def handle(a, b=2):
+    return helper(a) + skipped(b)
+
+
+def not_recorded(a):
+    return helper(a)
+
+
+def profiler_installed():
+    """Whether either backend receives call events."""
+    if sys.getprofile() is not None:
+        return True
+    return HAS_MONITORING and any(
+        sys.monitoring.get_tool(tool) == MonitoringCallTracer.TOOL_NAME
+        and sys.monitoring.get_events(tool)
+        for tool in MonitoringCallTracer.TOOL_IDS
+    )
+
+
+def test_recorded_calls_and_children(tracing):
+    def code_filter(code):
+        return code.co_filename == __file__ and code.co_name != "skipped"
+
+    with tracing(code_filter=code_filter) as logger:
+        assert handle(3) == 8
+        assert not_recorded(1) == 2
+
+    (trace,) = logger.traces[-1:]
+    assert (trace.module, trace.qualname) == (__name__, "handle")
+    assert trace.args == {"a": 3, "b": 2}
+    assert trace.return_value == 8
+    (child,) = trace.children
+    assert (child.qualname, child.args, child.return_value) == ("helper", {"x": 3}, 6)
+    assert logger.by_name("not_recorded") == []
+    assert logger.flushes == 1
+    assert not profiler_installed()
+
+
+def test_make_tracer_backends():
+    logger = ListLogger()
+    assert type(make_tracer(logger, backend=BACKEND_SETPROFILE)) is CallTracer
+    if HAS_MONITORING:
+        assert isinstance(make_tracer(logger), MonitoringCallTracer)
+        tracer = make_tracer(logger, backend=BACKEND_MONITORING)
+        assert isinstance(tracer, MonitoringCallTracer)
+    else:
+        assert type(make_tracer(logger)) is CallTracer
+        with pytest.raises(ValueError):
+            make_tracer(logger, backend=BACKEND_MONITORING)
+    with pytest.raises(ValueError):
+        make_tracer(logger, backend="settrace")
+
+
+@pytest.fixture
+def tools_in_use():
+    """Return a function marking sys.monitoring tool ids as used by another tool."""
+    used = []
+
+    def use(*tool_ids):
+        for tool_id in tool_ids:
+            sys.monitoring.use_tool_id(tool_id, "other")
+            used.append(tool_id)
+
+    yield use
+    for tool_id in used:
+        sys.monitoring.free_tool_id(tool_id)
+
+
+@pytest.mark.skipif(not HAS_MONITORING, reason="requires sys.monitoring")
+@pytest.mark.parametrize("lazy", [False, True])
+def test_monitoring_uses_a_free_tool_id(tools_in_use, lazy):
+    tools_in_use(MonitoringCallTracer.TOOL_ID)
+    logger = ListLogger()
+    with trace_calls(logger, backend=BACKEND_MONITORING, code_filter=in_tests, lazy=lazy):
+        handle(3)
+        assert profiler_installed() is not lazy
+        assert sys.getprofile() is None
+
+    (trace,) = logger.by_name("handle")
+    assert [child.qualname for child in trace.children] == ["helper", "skipped"]
+    assert not profiler_installed()
+    assert sys.monitoring.get_tool(MonitoringCallTracer.TOOL_ID) == "other"
+
+
+@pytest.mark.skipif(not HAS_MONITORING, reason="requires sys.monitoring")
+@pytest.mark.parametrize("lazy", [False, True])
+def test_monitoring_falls_back_to_setprofile(tools_in_use, caplog, lazy):
+    tools_in_use(*MonitoringCallTracer.TOOL_IDS)
+    logger = ListLogger()
+    with trace_calls(logger, backend=BACKEND_MONITORING, code_filter=in_tests, lazy=lazy):
+        handle(3)
+        assert (sys.getprofile() is not None) is not lazy
+
+    (trace,) = logger.by_name("handle")
+    assert [child.qualname for child in trace.children] == ["helper", "skipped"]
+    assert "tracing with sys.setprofile" in caplog.text
+    assert not profiler_installed()
+
+
+class Shape:
+    def __init__(self, size):
+        self.size = size
+
+    def area(self):
+        return self.scale(self.size) ** 2
+
+    @staticmethod
+    def scale(size):
+        return size * 2
+
+    @classmethod
+    def unit(cls):
+        return cls(1)
+
+    @property
+    def perimeter(self):
+        return 4 * self.size
+
+    class Inner:
+        @staticmethod
+        def nested(x):
+            return x
+
+
+@record
+def measure(size):
+    def local(x):
+        return x + 1
+
+    shape = Shape.unit() if size == 1 else Shape(size)
+    return local(shape.area()) + shape.perimeter + Shape.Inner.nested(0)
+
+
+def test_functions_are_resolved_with_their_qualnames(tracing):
+    with tracing() as logger:
+        assert measure(3) == 49
+
+    (trace,) = logger.by_name("measure")
+    assert [child.qualname for child in trace.children] == [
+        "Shape.__init__",
+        "Shape.area",
+        "measure.<locals>.local",
+        "Shape.perimeter",
+        "Shape.Inner.nested",
+    ]
+    (area,) = [child for child in trace.children if child.qualname == "Shape.area"]
+    assert [child.qualname for child in area.children] == ["Shape.scale"]
+
+
+def test_function_index_caches_misses_and_holds_weak_references(monkeypatch):
+    index = FunctionIndex()
+    namespace = {}
+    exec("import sys\ndef f():\n    return sys._getframe()", namespace)
+    frame = namespace["f"]()
+
+    assert index.lookup(frame) is namespace["f"]
+    code = frame.f_code
+    del namespace["f"], frame
+    # The index keeps neither the function nor its code alive
+    assert index.functions[code]() is None
+
+    resolved = []
+    monkeypatch.setattr(index, "_resolve", lambda frame: resolved.append(frame))
+    frame = sys._getframe()
+    assert index.lookup(frame) is None
+    assert index.lookup(frame) is None
+    assert resolved == [frame]
+    assert FUNCTION_INDEX.lookup(frame).__code__ is frame.f_code
+
+
+@record
+def request(i, barrier):
+    barrier.wait()
+    for _ in range(i + 1):
+        helper(i)
+
+
+def test_threads_record_independently(tracing):
+    barrier = threading.Barrier(4)
+
+    with tracing() as logger:
+        threads = [threading.Thread(target=request, args=(i, barrier)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    traces = sorted(logger.by_name("request"), key=lambda trace: trace.args["i"])
+    assert [trace.args["i"] for trace in traces] == [0, 1, 2, 3]
+    for i, trace in enumerate(traces):
+        helpers = [child for child in trace.children if child.qualname == "helper"]
+        assert [child.args for child in helpers] == [{"x": i}] * (i + 1)
+
+
+async def pause():
+    await asyncio.sleep(0)
+
+
+@record
+async def handle_task(i):
+    for _ in range(i + 1):
+        await pause()
+        helper(i)
+    return i
+
+
+def test_asyncio_tasks_record_independently(tracing):
+    async def main():
+        return await asyncio.gather(*(handle_task(i) for i in range(3)))
+
+    with tracing() as logger:
+        assert asyncio.run(main()) == [0, 1, 2]
+
+    traces = sorted(logger.by_name("handle_task"), key=lambda trace: trace.args["i"])
+    assert [trace.return_value for trace in traces] == [0, 1, 2]
+    for i, trace in enumerate(traces):
+        helpers = [child for child in trace.children if child.qualname == "helper"]
+        assert [child.args for child in helpers] == [{"x": i}] * (i + 1)
+
+
+def test_func_record_has_no_dict():
+    trace = FuncRecord.from_stored("mod", "func", {}, None)
+    assert not hasattr(trace, "__dict__")
+
+
+def test_module_name_from_path(monkeypatch):
+    monkeypatch.setattr(sys, "path", ["/srv", "/srv/app"])
+
+    assert module_name_from_path("/srv/app/main.py") == "main"
+    assert module_name_from_path("/srv/lib/util.py") == "lib.util"
+    assert module_name_from_path("/srv/lib/__init__.py") == "lib"
+    assert module_name_from_path("/opt/tool.py") is None
+    assert module_name_from_path("/srv/my-scripts/run.py") is None
+
+
+def test_module_name_of_main_script(monkeypatch):
+    monkeypatch.setattr(sys, "path", ["/srv"])
+    namespace = {"__name__": "__main__", "__file__": "/srv/app/script.py"}
+    exec("def main():\n    pass", namespace)
+
+    assert get_module_name(namespace["main"]) == "app.script"
+    namespace["__file__"] = "/opt/tools/script.py"
+    assert get_module_name(namespace["main"]) == "script"
+    assert get_module_name(helper) == __name__
+
+
+@record
+def consume(items):
+    items.append(len(items))
+    return len(items)
+
+
+@pytest.mark.parametrize("snapshot, recorded", [(False, [1, 1]), (True, [1])])
+def test_snapshot_args(tracing, snapshot, recorded):
+    with tracing(snapshot_args=snapshot) as logger:
+        assert consume([1]) == 2
+
+    (trace,) = logger.by_name("consume")
+    assert trace.args == {"items": recorded}
+
+
+@record
+def check_installed(x):
+    return profiler_installed(), helper(x)
+
+
+def test_lazy_tracing_only_runs_during_recorded_calls(tracing):
+    with tracing(lazy=True) as logger:
+        assert not profiler_installed()
+        assert check_installed(2) == (True, 4)
+        assert not profiler_installed()
+        assert not_recorded(1) == 2
+        assert outer() == "ok"
+
+    (trace,) = logger.by_name("check_installed")
+    assert [child.qualname for child in trace.children] == ["profiler_installed", "helper"]
+    assert logger.by_name("not_recorded") == []
+    assert len(logger.by_name("outer")) == 1
+    (boom_trace,) = logger.by_name("boom")
+    assert boom_trace.exception == RaisedException("ValueError", "bad 2")
+    assert not profiler_installed()
+
+
+@record(sample_rate=0)
+def never_recorded(x):
+    return x
+
+
+@record(sample_rate=1)
+def always_recorded(x):
+    return x
+
+
+@record
+def sampled(x):
+    return x
+
+
+def test_sample_rates(tracing):
+    with tracing(sample_rate=Sampler(0.0, rates={"sampled": 1.0})) as logger:
+        for i in range(10):
+            never_recorded(i)
+            always_recorded(i)
+            sampled(i)
+            handle(i)
+
+    assert logger.by_name("never_recorded") == []
+    assert len(logger.by_name("always_recorded")) == 10
+    assert len(logger.by_name("sampled")) == 10
+    assert logger.by_name("handle") == []
+
+
+def test_hash_sampling_is_deterministic(tracing):
+    with tracing(sample_rate=Sampler(0.5, mode=SAMPLE_HASH)) as logger:
+        for _ in range(3):
+            for i in range(40):
+                sampled(i)
+
+    recorded = [trace.args["x"] for trace in logger.by_name("sampled")]
+    kept = set(recorded)
+    assert 0 < len(kept) < 40
+    assert sorted(recorded) == sorted(list(kept) * 3)
+
+
+def test_sampler_rejects_unknown_modes():
+    with pytest.raises(ValueError):
+        Sampler(0.5, mode="sometimes")